@@ -0,0 +1,142 @@
+"""
+Client library for the game server on an asyncio event loop.
+
+A Connection has the same requests and handle_* methods as a
+client.Connection (both being client.Sessions), but it never blocks: once
+connected, a task reads the server's messages and dispatches each one as
+it arrives, so one process can drive as many connections as it has
+sockets for.  A handle_* method may be a coroutine function, in which case
+the reader awaits it before going on to the next message.
+
+    async def main():
+        conn = await aclient.Connection.connect(username='alice')
+        conn.invite_game('bob')
+        await conn.wait_for(type='accept', frm='bob')
+        ...
+        conn.goodbye()
+        await conn.closed()
+
+A message matching a pending wait_for() goes to its waiter rather than to
+its handler; any other message is handled at once, rather than held back
+and re-read later as client.Connection.wait_for does.  Don't await
+wait_for() from a handler, as the reader won't read on until the handler
+returns.
+"""
+import asyncio
+
+import client
+from client import Croaked, SocketClosed, RECV_SIZE
+
+class ServerError(Exception): pass
+
+class Connection(client.Session):
+    """A Session on an asyncio stream"""
+    def __init__(self, **kwargs):
+        super(Connection, self).__init__(**kwargs)
+        self.reader = None
+        self.writer = None
+        self.task = None
+        # [(fields, future)] for wait_for(), oldest first
+        self.waiters = []
+    @classmethod
+    async def connect(cls, host='localhost', port=0x6666, *args, **kwargs):
+        """Connect and register (with the other arguments being for the
+        constructor), then start reading messages"""
+        self = cls(*args, **kwargs)
+        # asyncio sets TCP_NODELAY on its sockets for us
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        try:
+            self.welcome(await self.read_msg())
+        except BaseException:
+            self.close()
+            raise
+        self.task = asyncio.get_running_loop().create_task(self.run())
+        return self
+    async def read_msg(self):
+        while True:
+            d = self.next_msg()
+            if d is not None:
+                return d
+            data = await self.reader.read(RECV_SIZE)
+            if not data:
+                raise SocketClosed('End-of-file condition on socket')
+            self.feed(data)
+    async def run(self):
+        try:
+            while self.writer is not None:
+                msg = await self.read_msg()
+                if self.wake(msg):
+                    continue
+                result = self.handle(msg)
+                if asyncio.iscoroutine(result):
+                    await result
+        except (SocketClosed, OSError):
+            pass
+        except Exception as e:
+            self.fail(e)
+            if not isinstance(e, Croaked):
+                self.croak("reader: %r" % (e,), True)
+            raise
+        finally:
+            self.close()
+            self.fail(SocketClosed('Connection closed'))
+    def wake(self, msg):
+        """Give msg to the first waiter it matches, if any.  An error fails
+        all the waiters, as we can't tell which request it answers."""
+        for i, (fields, future) in enumerate(self.waiters):
+            if all(msg.get(k) == v for k, v in fields.items()):
+                del self.waiters[i]
+                if not future.done():
+                    future.set_result(msg)
+                return True
+        if msg.get('type') == 'error' and self.waiters:
+            self.fail(ServerError("Server error: %s" % (msg.get('message'),)))
+            return True
+        return False
+    def fail(self, exc):
+        waiters, self.waiters = self.waiters, []
+        for fields, future in waiters:
+            if not future.done():
+                future.set_exception(exc)
+    def wait_for(self, **d):
+        """A future for the next message whose fields include d"""
+        future = asyncio.get_running_loop().create_future()
+        if self.writer is None:
+            future.set_exception(SocketClosed('Connection closed'))
+        else:
+            self.waiters.append((d, future))
+        return future
+    async def closed(self):
+        """Wait for the reader to finish, raising what stopped it if that
+        wasn't the connection closing"""
+        if self.task is not None:
+            await self.task
+    def send(self, data):
+        if self.writer is None:
+            raise SocketClosed('Connection closed')
+        self.writer.write(data)
+    async def drain(self):
+        """Wait for our transmit buffer to drain below the high-water mark"""
+        if self.writer is not None:
+            await self.writer.drain()
+    def close(self):
+        if self.writer is not None:
+            # Closing the transport sends what's buffered first
+            self.writer.close()
+            self.writer = None
+    def croak(self, msg, swallow=False):
+        try:
+            self.write_msg({'type': 'error', 'error': str(msg)})
+        except Exception as e:
+            print("Failed to croak %r: %s" % (msg, e))
+        self.close()
+        if not swallow:
+            raise Croaked(msg)
+    def goodbye(self, msg=None):
+        if self.writer is None:
+            return
+        gb = {'type': 'goodbye'}
+        if msg is not None:
+            gb['message'] = msg
+        self.write_msg(gb)
+        self.close()
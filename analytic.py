@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+"""
+Exact outcome distributions, computed rather than sampled.
+
+The probabilities of each delivery outcome are found by exploring every
+branch of Ball.roll's dice tree, so they follow howzat.py's rules and
+constants exactly.  Innings totals then come from dynamic programming
+over (legal balls bowled, wickets, score), with Innings.bowl's all-out,
+twenty-over and chase termination rules.
+"""
+import argparse
+import functools
+from fractions import Fraction
+
+import howzat
+from commentary import NULL
+from coroutine import WaitingFor
+
+MAX_OVERS = 20
+# Scores beyond this are lumped together; their probability is negligible
+MAX_SCORE = 600
+
+class DieRoll(WaitingFor):
+    def __init__(self, player):
+        super(DieRoll, self).__init__(player, None)
+
+class TreePlayer(howzat.Player):
+    """Player whose every die roll is a branch point in the dice tree"""
+    def roll_d6(self, prompt=None):
+        return (yield DieRoll(self))
+    def roll_2d6(self, prompt=None):
+        a = yield DieRoll(self)
+        b = yield DieRoll(self)
+        return a + b
+
+def outcome(ball):
+    """Classify a Ball as (extra, runs, wicket)"""
+    for extra in ('nb', 'w', 'b', 'lb'):
+        if getattr(ball, extra):
+            break
+    else:
+        extra = None
+    return extra, ball.runs, ball.wicket.how if ball.wicket else None
+
+@functools.lru_cache()
+def delivery_distribution():
+    """Map each (extra, runs, wicket) outcome of a delivery to its exact
+    probability, as a Fraction."""
+    bowler = TreePlayer("Bowler")
+    batsman = TreePlayer("Batsman")
+    field = [bowler] + [TreePlayer("Fielder%d" % (i,)) for i in range(2, 12)]
+    dist = {}
+    # Each path through the tree is replayed from the start with its rolls
+    paths = [((), Fraction(1))]
+    while paths:
+        rolls, p = paths.pop()
+        thread = howzat.Ball.roll(bowler, batsman, field, commentary=NULL)
+        try:
+            next(thread)
+            for r in rolls:
+                thread.send(r)
+        except StopIteration as s:
+            k = outcome(s.value)
+            dist[k] = dist.get(k, 0) + p
+            continue
+        paths.extend((rolls + (r,), p / 6) for r in range(1, 7))
+    return dist
+
+def total_runs(extra, runs):
+    return runs + (extra in ('nb', 'w'))
+
+def is_legal(extra):
+    return extra not in ('nb', 'w')
+
+def split_outcomes():
+    """Return (non-legal, legal) outcome lists, as float probabilities.
+
+    Non-legal deliveries are [(runs, p)], always scoring at least the
+    one-run penalty; legal ones are [(runs, wicket, p)]."""
+    nl = {}
+    lg = {}
+    for (extra, runs, wicket), p in delivery_distribution().items():
+        tr = total_runs(extra, runs)
+        if is_legal(extra):
+            k = (tr, wicket is not None)
+            lg[k] = lg.get(k, 0) + p
+        else:
+            assert wicket is None and tr > 0, (extra, runs, wicket)
+            nl[tr] = nl.get(tr, 0) + p
+    return (sorted((r, float(p)) for r, p in nl.items()),
+            sorted((r, w, float(p)) for (r, w), p in lg.items()))
+
+@functools.lru_cache()
+def innings_outcomes(balls=MAX_OVERS * 6, wickets=10, chasing=None, max_score=MAX_SCORE):
+    """Distribution of an innings' end state.
+
+    Returns (final, overflow): final[w][s] is the probability that the
+    innings ends with w wickets down and a total of s, and overflow the
+    probability that it exceeds max_score.  The innings ends after balls
+    legal deliveries, when wickets have fallen, or (if chasing is not
+    None) once the total passes chasing."""
+    nl, lg = split_outcomes()
+    n = max_score + 1
+    limit = n if chasing is None else min(n, chasing + 1)
+    final = [[0.0] * n for w in range(wickets + 1)]
+    overflow = 0.0
+    # live[w][s]: probability of reaching this state after b legal balls
+    live = [[0.0] * n for w in range(wickets)]
+    live[0][0] = 1.0
+    for b in range(balls):
+        nxt = [[0.0] * n for w in range(wickets)]
+        for w in range(wickets):
+            m = live[w]
+            # Close under non-legal deliveries, which only ever add runs,
+            # so each score depends only on lower ones
+            for s in range(limit):
+                if m[s]:
+                    for r, p in nl:
+                        if s + r < n:
+                            m[s + r] += m[s] * p
+                        else:
+                            overflow += m[s] * p
+            # Chase won by extras
+            for s in range(limit, n):
+                final[w][s] += m[s]
+            seg = m[:limit]
+            for r, out, p in lg:
+                if out:
+                    # Wickets fall to legal balls, and score nothing
+                    dest = final[w + 1] if w + 1 == wickets else nxt[w + 1]
+                    dest[:limit] = [d + x * p for d, x in zip(dest, seg)]
+                    continue
+                dest = nxt[w]
+                dest[r:r + limit] = [d + x * p for d, x in zip(dest[r:], seg)]
+                overflow += sum(seg[n - r:]) * p
+            # Chase won off the bat
+            dest = nxt[w]
+            for s in range(limit, n):
+                final[w][s] += dest[s]
+                dest[s] = 0.0
+        live = nxt
+    # Overs up
+    for w in range(wickets):
+        for s in range(n):
+            final[w][s] += live[w][s]
+    return final, overflow
+
+def innings_totals(chasing=None, max_score=MAX_SCORE):
+    """Probability of each innings total, as a list indexed by score"""
+    final, overflow = innings_outcomes(chasing=chasing, max_score=max_score)
+    return [sum(col) for col in zip(*final)]
+
+def over_distribution():
+    """Map (runs, wickets) to its probability for a complete six-ball over"""
+    final, overflow = innings_outcomes(balls=6, wickets=7)
+    return dict(((s, w), p) for w, row in enumerate(final) for s, p in enumerate(row) if p)
+
+def win_probability(max_score=MAX_SCORE):
+    """Return (first, tie, second), the probabilities that the side
+    batting first wins, that the match is tied, and that the chasing side
+    wins."""
+    # Whether the chase stops once it passes the target makes no difference
+    # to whether it passes it, so one distribution serves both innings
+    t = innings_totals(max_score=max_score)
+    above = [0.0] * len(t)
+    acc = 1.0 - sum(t) # overflow
+    for s in reversed(range(len(t))):
+        above[s] = acc
+        acc += t[s]
+    second = sum(p * above[s] for s, p in enumerate(t))
+    tie = sum(p * p for p in t)
+    return 1.0 - second - tie, tie, second
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Exact Howzat outcome probabilities')
+    parser.add_argument('-c', '--chasing', type=int, default=None, help='print the chasing side\'s chances against this first-innings total')
+    args = parser.parse_args()
+    for (extra, runs, wicket), p in sorted(delivery_distribution().items(), key=lambda kv: -kv[1]):
+        print("%-4s %d %-8s %s (%.4f)" % (extra or '-', runs, wicket or '-', p, p))
+    t = innings_totals()
+    print("Expected innings total %.2f" % (sum(s * p for s, p in enumerate(t)),))
+    if args.chasing is None:
+        print("Batting first wins %.4f, tie %.4f, batting second wins %.4f" % win_probability())
+    else:
+        final, overflow = innings_outcomes(chasing=args.chasing)
+        won = overflow + sum(p for row in final for s, p in enumerate(row) if s > args.chasing)
+        tied = sum(row[args.chasing] for row in final)
+        print("Chasing %d: won %.4f, tied %.4f" % (args.chasing, won, tied))
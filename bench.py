@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+"""
+Benchmarks for the match engine, coroutine Reactor, scorecards and server.
+
+Each benchmark is a (setup, run, ops) triple; run(setup()) is timed over
+several repeats (best and median are kept),
+then run once more under tracemalloc for its peak memory.  Results are
+written as JSON so that runs from different commits can be compared with
+--compare.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import socket
+import statistics
+import sys
+import time
+import tracemalloc
+
+import howzat
+import server
+from coroutine import Reactor, WaitingFor, maybe_gen
+
+@contextlib.contextmanager
+def quiet():
+    with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
+        yield
+
+def bench_match(n=20):
+    """Full play_match between DeterministicPlayer teams, via the Reactor"""
+    def setup():
+        return [(howzat.Team.det("TA"), howzat.Team.det("TB")) for i in range(n)]
+    def run(teams):
+        with quiet():
+            for TA, TB in teams:
+                Reactor().start_thread(howzat.play_match(TA, TB))
+    return setup, run, n
+
+def bench_ball_roll(n=20000):
+    """Ball.roll alone, for one DeterministicPlayer bowler and batsman"""
+    T = howzat.Team.det("TA")
+    bowler, batsman = T.players[10], T.players[0]
+    def run(state):
+        with quiet():
+            for i in range(n):
+                thread = howzat.Ball.roll(bowler, batsman, T.field)
+                try:
+                    next(thread)
+                except StopIteration:
+                    pass
+    return None, run, n
+
+class SuspendingPlayer(howzat.Player):
+    def roll_d6(self, prompt=None):
+        return (yield WaitingFor(self, None))
+
+def bench_reactor(n=50000):
+    """Reactor.start_thread/progress/feed_value per suspended roll"""
+    p = SuspendingPlayer("P")
+    def thread():
+        for i in range(n):
+            yield from maybe_gen(p.roll_d6())
+    def run(state):
+        r = Reactor()
+        r.start_thread(thread())
+        while r.waiting:
+            wf = next(iter(r.waiting))
+            r.progress(wf, 1)
+    return None, run, n
+
+def bench_scorecard(n=200):
+    """Innings.batting_summary and bowling_summary for a whole match"""
+    with quiet():
+        IA, IB = Reactor().start_thread(howzat.play_match(howzat.Team.det("TA"), howzat.Team.det("TB")))
+    def run(state):
+        with quiet():
+            for i in range(n):
+                for inns in (IA, IB):
+                    inns.batting_summary()
+                    inns.bowling_summary()
+    return None, run, n
+
+def bench_server(clients=50, walls=20):
+    """server.Server handling lobby wall messages from in-process clients"""
+    marker = 'bench-msg'
+    expected = clients * walls * clients
+    def run(state):
+        with quiet():
+            srv = server.Server(port=0)
+            peers = []
+            for i in range(clients):
+                a, b = socket.socketpair()
+                c = server.Client(a, srv)
+                srv.clients[c.name] = c
+                b.setblocking(False)
+                peers.append(b)
+                b.sendall(('{"type": "hello", "username": "bench%d"}\n' % (i,)).encode('utf8'))
+            # Everyone must be in the lobby before the chatter starts
+            while len(srv.lobby.occupants) < clients:
+                srv.tick(timeout=0)
+            wall = (json.dumps({'type': 'wall', 'message': marker}) + '\n').encode('utf8')
+            for b in peers:
+                b.sendall(wall * walls)
+            seen = 0
+            while seen < expected:
+                srv.tick(timeout=0)
+                for b in peers:
+                    try:
+                        seen += b.recv(1 << 16).count(marker.encode('utf8'))
+                    except BlockingIOError:
+                        pass
+            for b in peers:
+                b.close()
+            for c in srv.clients.values():
+                c.sock.close()
+            srv.sock.close()
+    return None, run, clients * walls
+
+BENCHMARKS = {
+    'match': bench_match,
+    'ball_roll': bench_ball_roll,
+    'reactor': bench_reactor,
+    'scorecard': bench_scorecard,
+    'server': bench_server,
+}
+
+def measure(name, repeats):
+    setup, run, ops = BENCHMARKS[name]()
+    if setup is None:
+        setup = lambda: None
+    times = []
+    for i in range(repeats):
+        state = setup()
+        start = time.perf_counter()
+        run(state)
+        times.append(time.perf_counter() - start)
+    state = setup()
+    tracemalloc.start()
+    run(state)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    best = min(times)
+    return {'ops': ops, 'best_s': best, 'median_s': statistics.median(times),
+            'us_per_op': 1e6 * best / ops, 'peak_kib': peak / 1024.0}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Howzat benchmarks')
+    parser.add_argument('-o', '--output', default='bench.json')
+    parser.add_argument('-r', '--repeats', type=int, default=5)
+    parser.add_argument('-c', '--compare', help='earlier results file to compare against')
+    parser.add_argument('names', nargs='*', choices=[[]] + sorted(BENCHMARKS), help='benchmarks to run (default: all)')
+    args = parser.parse_args()
+    results = {}
+    for name in args.names or sorted(BENCHMARKS):
+        results[name] = r = measure(name, args.repeats)
+        print("%-10s %10.2f us/op  (median %.4fs, best %.4fs)  peak %.0f KiB" % (name, r['us_per_op'], r['median_s'], r['best_s'], r['peak_kib']))
+    with open(args.output, 'w') as f:
+        json.dump({'python': platform.python_version(), 'time': time.time(),
+                   'argv': sys.argv[1:], 'results': results}, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)['results']
+        for name, r in sorted(results.items()):
+            if name in old:
+                print("%-10s %6.2fx time, %6.2fx peak memory" % (name, r['us_per_op'] / old[name]['us_per_op'], r['peak_kib'] / old[name]['peak_kib']))
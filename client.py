@@ -1,27 +1,41 @@
 #!/usr/bin/python3
 import argparse
+import collections
 import getpass
 import json
 import select
 import shlex
 import socket
 import sys
+import zlib
+
+import framing
+
+RECV_SIZE = 1 << 16
 
 class Croaked(Exception): pass
 class SocketClosed(Exception): pass
 
-class Connection(object):
-    def __init__(self, host='localhost', port=0x6666, username=getpass.getuser(), playername=None):
-        self.buf = b''
-        self.sock = socket.socket()
-        try:
-            self.sock.connect((host, port))
-        except Exception as e:
-            self.sock = None
-            raise
+class Session(object):
+    """The protocol side of a connection to the server, whatever carries
+    it: framing, the welcome and hello, dispatch of each message to its
+    handle_* method, and the requests a client can make.  Subclasses
+    supply send(), and read and feed() the server's bytes in their own
+    way."""
+    def __init__(self, username=getpass.getuser(), playername=None, extensions=()):
+        # Received bytes; lines are cut from the front as they are read,
+        # and scan is how far we've already looked for a newline
+        self.buf = bytearray()
+        self.scan = 0
+        # Switched on by welcome(), if the server agrees
+        self.frames = False
+        self.codec = None
+        self.deflate = None
+        self.inflate = None
         self.username = username
         self.playername = playername
-        self.register()
+        # Those we'd like; welcome() cuts this down to what the server offers
+        self.extensions = set(extensions)
         self.room = set()
     def debug(self, cls, *args):
         pass
@@ -29,53 +43,38 @@ class Connection(object):
         self.debug('rx', *args)
     def debug_tx(self, *args):
         self.debug('tx', *args)
-    def try_shutdown(self):
-        if self.sock is None:
-            return
-        try:
-            self.sock.shutdown(socket.SHUT_RDWR)
-        except OSError:
-            pass
-    def read_msg(self):
-        while b'\n' not in self.buf:
-            self.buf += self.sock.recv(256)
-        msg, _, self.buf = self.buf.partition(b'\n')
-        d = json.loads(msg.decode('utf8'))
-        self.debug_rx(d)
-        return d
-    def maybe_read_msg(self, timeout=0.1):
-        if b'\n' not in self.buf:
-            r, w, x = select.select((self.sock.fileno(),), (), (), timeout)
-            if self.sock.fileno() in r:
-                data = self.sock.recv(256)
-                if not len(data):
-                    self.sock.close()
-                    self.sock = None
-                    raise SocketClosed('End-of-file condition on socket')
-                self.buf += data
-        if b'\n' not in self.buf:
+    def feed(self, data):
+        if self.inflate is not None:
+            data = self.inflate.decompress(data)
+        self.buf += data
+    def next_msg(self):
+        if self.frames:
+            d = self.codec.next_frame(self.buf)
+            if d is not None:
+                self.debug_rx(d)
+            return d
+        i = self.buf.find(b'\n', self.scan)
+        if i < 0:
+            self.scan = len(self.buf)
             return None
-        msg, _, self.buf = self.buf.partition(b'\n')
-        d = json.loads(msg.decode('utf8'))
+        msg = bytes(self.buf[:i])
+        del self.buf[:i + 1]
+        self.scan = 0
+        d = json.loads(msg)
         self.debug_rx(d)
         return d
+    def encode(self, d):
+        if self.frames:
+            return self.codec.frame(d)
+        return (json.dumps(d) + '\n').encode('utf8')
     def write_msg(self, d):
         self.debug_tx(d)
-        j = json.dumps(d) + '\n'
-        while j:
-            b = self.sock.send(j.encode('utf8'))
-            j = j[b:]
-    def croak(self, msg, swallow=False):
-        try:
-            self.write_msg({'type': 'error', 'error': str(msg)})
-        except Exception as e:
-            print("Failed to croak %r: %s" % (msg, e))
-        self.try_shutdown()
-        self.sock = None
-        if not swallow:
-            raise Croaked(msg)
-    def register(self):
-        welcome = self.read_msg()
+        data = self.encode(d)
+        if self.deflate is not None:
+            data = self.deflate.compress(data) + self.deflate.flush(zlib.Z_SYNC_FLUSH)
+        self.send(data)
+    def welcome(self, welcome):
+        """Check the server's welcome message, and answer it with our hello"""
         if welcome.get('type') != 'welcome':
             self.croak("Expected welcome message, got %s" % (welcome.get('type'),))
         version = welcome.get('version')
@@ -85,25 +84,21 @@ class Connection(object):
             self.croak("This client only supports protocol version 1 (not %r)" % (version[0],))
         self.server_version = version
         self.motd = welcome.get('message')
+        self.extensions.intersection_update(welcome.get('extensions', []))
         hello = {'type': 'hello', 'username': self.username}
         if self.playername is not None:
             hello['player'] = self.playername
+        if self.extensions:
+            hello['extensions'] = sorted(self.extensions)
         self.write_msg(hello)
-    def __del__(self):
-        self.goodbye("Client connection GCed")
-    def goodbye(self, msg=None):
-        if self.sock is None:
-            return
-        gb = {'type': 'goodbye'}
-        if msg is not None:
-            gb['message'] = msg
-        self.write_msg(gb)
-        self.try_shutdown()
-        self.sock = None
-    def maybe_read_and_handle(self, timeout=0.1):
-        msg = self.maybe_read_msg(timeout=timeout)
-        if msg is None:
-            return
+        # Everything after the 'hello' is framed and compressed as agreed
+        self.frames = 'frames' in self.extensions
+        if self.frames:
+            self.codec = framing.Codec()
+        if 'zlib' in self.extensions:
+            self.deflate = zlib.compressobj()
+            self.inflate = zlib.decompressobj()
+    def handle(self, msg):
         if 'type' not in msg:
             self.croak("Message without type: %s" % json.dumps(msg))
         typ = msg.pop('type')
@@ -122,6 +117,8 @@ class Connection(object):
             self.room = set()
         else:
             self.room.add(user)
+    def handle_roster(self, users):
+        self.room.update(users)
     def handle_exit(self, user):
         if user == self.username:
             self.room = set()
@@ -163,24 +160,6 @@ class Connection(object):
         if not hasattr(self, method):
             self.croak("Unhandled invitation type: %s" % json.dumps(d))
         return getattr(self, method)(**kwargs)
-    def wait_for(self, **d):
-        # Save all the messages we weren't waiting for, so that we can
-        # replay them afterwards
-        bottle = []
-        try:
-            while True:
-                msg = self.read_msg()
-                for k,v in d.items():
-                    if msg.get(k) != v:
-                        break
-                else:
-                    return msg
-                if msg.get('type') == 'error':
-                    raise Exception("Server error: %s" % (msg.get('message'),))
-                bottle.append(msg)
-        finally:
-            # Restore the bottled-up messages
-            self.buf = '\n'.join(map(json.dumps, bottle)) + self.buf
     def wall(self, msg):
         self.write_msg({'type': 'wall', 'message': str(msg)})
     def message(self, msg, to):
@@ -206,10 +185,18 @@ class Connection(object):
         #self.wait_for(**{'type': 'part', 'from': self.username})
     def rename_team(self, team_name):
         self.write_msg({'type': 'team name', 'name': team_name})
-    def claim_player(self, player_name):
-        self.write_msg({'type': 'claim', 'player': player_name})
-    def assign_player(self, player_name, username):
-        self.write_msg({'type': 'assign', 'player': player_name, 'to': username})
+    def claim_player(self, player_name, bot=None):
+        d = {'type': 'claim', 'player': player_name}
+        if bot is not None:
+            d['bot'] = bot
+        self.write_msg(d)
+    def assign_player(self, player_name, username=None, bot=None):
+        d = {'type': 'assign', 'player': player_name}
+        if bot is not None:
+            d['bot'] = bot
+        else:
+            d['to'] = username
+        self.write_msg(d)
     def disown_player(self, player_name):
         self.write_msg({'type': 'disown', 'player': player_name})
     def action(self, action, **d):
@@ -245,6 +232,111 @@ class Connection(object):
         self.action('field assign')
     def roll_dice(self):
         self.action('roll')
+    def delegate(self, span, player_name=None):
+        """Let the server trigger rolls until the end of span ('over' or
+        'innings'); None revokes"""
+        d = {'type': 'delegate', 'span': span}
+        if player_name is not None:
+            d['player'] = player_name
+        self.write_msg(d)
+    def handle_delegate(self, player, span):
+        pass
+
+
+class Connection(Session):
+    """A Session on a blocking socket"""
+    def __init__(self, host='localhost', port=0x6666, **kwargs):
+        super(Connection, self).__init__(**kwargs)
+        self.rxview = memoryview(bytearray(RECV_SIZE))
+        # Messages wait_for() read past, to be read again before any more
+        self.held = collections.deque()
+        self.sock = socket.socket()
+        try:
+            self.sock.connect((host, port))
+            # Each message is sent whole, so Nagle would only add delay
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except Exception as e:
+            self.sock = None
+            raise
+        self.register()
+    def try_shutdown(self):
+        if self.sock is None:
+            return
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    def recv(self):
+        n = self.sock.recv_into(self.rxview)
+        if not n:
+            self.sock.close()
+            self.sock = None
+            raise SocketClosed('End-of-file condition on socket')
+        self.feed(self.rxview[:n])
+    def next_msg(self):
+        if self.held:
+            return self.held.popleft()
+        return super(Connection, self).next_msg()
+    def read_msg(self):
+        while True:
+            d = self.next_msg()
+            if d is not None:
+                return d
+            self.recv()
+    def maybe_read_msg(self, timeout=0.1):
+        d = self.next_msg()
+        if d is not None:
+            return d
+        r, w, x = select.select((self.sock.fileno(),), (), (), timeout)
+        if self.sock.fileno() in r:
+            self.recv()
+        return self.next_msg()
+    def send(self, data):
+        self.sock.sendall(data)
+    def croak(self, msg, swallow=False):
+        try:
+            self.write_msg({'type': 'error', 'error': str(msg)})
+        except Exception as e:
+            print("Failed to croak %r: %s" % (msg, e))
+        self.try_shutdown()
+        self.sock = None
+        if not swallow:
+            raise Croaked(msg)
+    def register(self):
+        self.welcome(self.read_msg())
+    def __del__(self):
+        self.goodbye("Client connection GCed")
+    def goodbye(self, msg=None):
+        if self.sock is None:
+            return
+        gb = {'type': 'goodbye'}
+        if msg is not None:
+            gb['message'] = msg
+        self.write_msg(gb)
+        self.try_shutdown()
+        self.sock = None
+    def maybe_read_and_handle(self, timeout=0.1):
+        msg = self.maybe_read_msg(timeout=timeout)
+        if msg is None:
+            return
+        return self.handle(msg)
+    def wait_for(self, **d):
+        # Hold all the messages we weren't waiting for, to be read again
+        # afterwards
+        bottle = []
+        try:
+            while True:
+                msg = self.read_msg()
+                for k,v in d.items():
+                    if msg.get(k) != v:
+                        break
+                else:
+                    return msg
+                if msg.get('type') == 'error':
+                    raise Exception("Server error: %s" % (msg.get('message'),))
+                bottle.append(msg)
+        finally:
+            self.held.extendleft(reversed(bottle))
 
 class ConsoleClient(Connection):
     def __init__(self, **kwargs):
@@ -305,6 +397,10 @@ class ConsoleClient(Connection):
     def cmd_quit(self, *messages):
         self.goodbye(' '.join(messages) or 'Client quit')
         self.halt = True
+    def cmd_delegate(self, span=None, player_name=None):
+        if span in ('none', 'off'):
+            span = None
+        self.delegate(span, player_name)
     def cmd_invite(self, to):
         self.invite_game(to)
     def cmd_accept(self, to, what=None):
@@ -358,12 +454,20 @@ class ConsoleClient(Connection):
     def handle_enter(self, user):
         super(ConsoleClient, self).handle_enter(user)
         print("%s entered the room" % (self.tagify('=', user),))
+    def handle_roster(self, users):
+        super(ConsoleClient, self).handle_roster(users)
+        print("%s in the room: %s" % (self.tagify('='), ', '.join(users)))
     def handle_exit(self, user):
         super(ConsoleClient, self).handle_exit(user)
         print("%s left the room" % (self.tagify('=', user),))
         # Revoke any outstanding invites
         self.in_invite_new.discard(user)
         self.in_invite_join.discard(user)
+    def handle_delegate(self, player, span):
+        if span is None:
+            print("%s You trigger %s's rolls" % (self.tagify(), player))
+        else:
+            print("%s Server triggers %s's rolls for the %s" % (self.tagify(), player, span))
     def handle_invite_new(self, frm):
         print("%s invited you to start a game!  /accept or /reject it." % self.tagify('=', frm))
         self.in_invite_new.add(frm)
@@ -387,4 +491,4 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Command-line client for networked Howzat game')
     parser.add_argument('-u', '--username', default=getpass.getuser())
     args = parser.parse_args()
-    ConsoleClient(username=args.username, debug=True).main_loop()
+    ConsoleClient(username=args.username, debug=True, extensions=('delegate', 'frames', 'zlib')).main_loop()
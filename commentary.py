@@ -0,0 +1,153 @@
+"""
+Commentary sinks for the match engine.
+
+The engine reports everything that happens as out.event(kind, **fields),
+passing the objects involved rather than formatted text, and leaves it to
+the sink to decide what (if anything) to make of them:
+
+* ConsoleCommentary prints the traditional commentary and scorecards.
+* BufferedCommentary does the same into a buffer.
+* NullCommentary ignores everything, at no formatting cost.
+* EventCommentary hands each event to a callback as (kind, fields).
+* StreamCommentary turns them into coroutine.Event objects which the
+  engine yields to its caller; see howzat.match_events.
+
+Event kinds and their fields:
+    call     player, tails          toss called
+    coin     tails                  coin landed
+    toss     team, bat              toss winner's choice
+    roll     player, dice           dice rolled (a list of d6)
+    flip     player, tails          coin flipped by a remote player
+    appeal   (none)                 "Howzat?"
+    chance   fielder                catching chance
+    dropped  fielder                catch dropped
+    extra    extra                  'nb', 'w', 'b' or 'lb' called
+    over     inns                   new over about to start
+    ball     inns, ball             delivery completed
+    innings  inns                   innings complete
+    result   teams, winner, runs, wickets
+                                    match complete; teams in batting
+                                    order, winner None if tied
+
+StreamCommentary adds one more, after the 'ball' that took it:
+    wicket   inns, ball, how, who, batsman, bowler
+and, as inns goes on changing after the event is emitted, it copies the
+score into each event that has one as it stands then:
+    total, wickets, over, balls, striker, non_striker, bowler
+where over counts from 1 and balls is legal balls bowled in it; for a
+'ball' or 'wicket', the score includes that delivery, but striker and
+non_striker are who faced it and who was at the other end.
+"""
+import io
+
+from coroutine import Event
+
+class NullCommentary(object):
+    def event(self, kind, **fields):
+        pass
+    def drain(self):
+        """Iterable of events held back for the engine to yield"""
+        return ()
+
+class EventCommentary(NullCommentary):
+    def __init__(self, callback):
+        self.callback = callback
+    def event(self, kind, **fields):
+        self.callback(kind, fields)
+
+class StreamCommentary(NullCommentary):
+    def __init__(self, kinds=None):
+        # None means every kind
+        self.kinds = kinds
+        self.pending = []
+    def event(self, kind, **fields):
+        if self.kinds is None or kind in self.kinds:
+            if 'inns' in fields:
+                fields.update(score(fields['inns'], fields.get('ball')))
+            self.pending.append(Event(kind, **fields))
+        if kind == 'ball' and fields['ball'].wicket:
+            ball = fields['ball']
+            self.event('wicket', inns=fields['inns'], ball=ball,
+                       how=ball.wicket.how, who=ball.wicket.who,
+                       batsman=ball.batsman, bowler=ball.bowler)
+    def drain(self):
+        pending, self.pending = self.pending, []
+        return pending
+
+def score(inns, ball=None):
+    """Where inns stands, after ball if it's one Innings.bowl has yet to
+    add up"""
+    total, wickets = inns.total, len(inns.fow)
+    if ball is not None:
+        total += ball.total_runs
+        wickets += bool(ball.wicket)
+    return {'total': total, 'wickets': wickets, 'over': len(inns.overs), 'balls': 6 - inns.over.to_come,
+            'striker': inns.striker, 'non_striker': inns.non_striker, 'bowler': inns.bowling}
+
+class ConsoleCommentary(NullCommentary):
+    EXTRAS = {'nb': "No-Ball called", 'w': "Wide ball", 'b': "Byes taken", 'lb': "Leg Byes taken"}
+    def __init__(self, file=None):
+        # None means whatever sys.stdout is at the time
+        self.file = file
+    def say(self, *args):
+        print(*args, file=self.file)
+    def event(self, kind, **fields):
+        getattr(self, 'say_' + kind)(**fields)
+    def say_call(self, player, tails):
+        self.say("%s called %s" % (player.name, "tails" if tails else "heads"))
+    def say_coin(self, tails):
+        self.say("The coin landed %s up" % ("tails" if tails else "heads"))
+    def say_toss(self, team, bat):
+        self.say("%s won the toss and elected to %s" % (team.name, "bat" if bat else "field"))
+    def say_roll(self, player, dice):
+        faces = ''.join(chr(0x267f + d) for d in dice)
+        if len(dice) == 1:
+            self.say("%s rolled d6 %s" % (player.name, faces))
+        else:
+            self.say("%s rolled %dd6 %s -> %d" % (player.name, len(dice), faces, sum(dice)))
+    def say_flip(self, player, tails):
+        self.say("%s flipped %s" % (player.name, "tails" if tails else "heads"))
+    def say_appeal(self):
+        self.say("Howzat?")
+    def say_chance(self, fielder):
+        self.say("In the air to %s..." % (fielder.name,))
+    def say_dropped(self, fielder):
+        self.say("Dropped it!")
+    def say_extra(self, extra):
+        self.say(self.EXTRAS[extra])
+    def say_over(self, inns):
+        if inns.chasing is None:
+            chase = ""
+        else:
+            chase = " - %d required" % (inns.chasing + 1 - inns.total)
+        self.say("Over %d; %d/%d.  %s to %s (%s off strike)%s" % (len(inns.overs), inns.total, len(inns.fow), inns.bowling.name, inns.striker.name, inns.non_striker.name, chase))
+    def say_ball(self, inns, ball):
+        self.say(str(ball))
+    def say_innings(self, inns):
+        self.say()
+        inns.batting_summary(file=self.file)
+        inns.bowling_summary(file=self.file)
+        self.say()
+    def say_result(self, teams, winner, runs=None, wickets=None):
+        if winner is None:
+            self.say("%s and %s tied" % (teams[0].name, teams[1].name))
+            return
+        loser = teams[1] if winner == teams[0] else teams[0]
+        if runs is not None:
+            self.say("%s beat %s by %d runs" % (winner.name, loser.name, runs))
+        else:
+            self.say("%s beat %s by %d wickets" % (winner.name, loser.name, wickets))
+
+class BufferedCommentary(ConsoleCommentary):
+    def __init__(self):
+        super(BufferedCommentary, self).__init__(io.StringIO())
+    def getvalue(self):
+        return self.file.getvalue()
+    def flush(self, file=None):
+        """Write out and clear the buffered commentary"""
+        print(self.getvalue(), end='', file=file)
+        self.file.seek(0)
+        self.file.truncate()
+
+CONSOLE = ConsoleCommentary()
+NULL = NullCommentary()
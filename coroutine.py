@@ -5,40 +5,199 @@ vaguely inspired by Twisted.
 """
 from collections.abc import Iterable
 
+class TimedOut(object):
+    def __repr__(self):
+        return 'TIMED_OUT'
+
+# What a thread is resumed with when its WaitingFor's timeout expires
+TIMED_OUT = TimedOut()
+
 class WaitingFor(object):
-    def __init__(self, player, match_fn):
+    def __init__(self, player, match_fn, keys=(), timeout=None):
         self.player = player
         self.match_fn = match_fn
+        # Hashable keys under which the Reactor indexes this waiter, for
+        # Reactor.lookup; the first element of each key is its owner
+        self.keys = keys
+        # Seconds after which the thread is resumed with TIMED_OUT
+        self.timeout = timeout
+
+class Sleep(WaitingFor):
+    """Wait for nothing but the timeout"""
+    def __init__(self, seconds):
+        super(Sleep, self).__init__(None, None, timeout=seconds)
+
+class TimerWheel(object):
+    """Hierarchical timing wheel.
+
+    Time is counted in ticks of resolution seconds.  Level 0 has a slot
+    per tick; each slot of level n covers a whole turn of level n-1, and
+    is redistributed ("cascaded") into the levels below when that turn
+    begins.  Adding and removing a timer is O(1), and advance() costs
+    O(ticks elapsed + timers expiring) however many are pending.  Timers
+    beyond the top level wait in an overflow list."""
+    def __init__(self, resolution=0.01, bits=6, levels=4, now=0.0):
+        self.resolution = resolution
+        self.bits = bits
+        self.mask = (1 << bits) - 1
+        self.wheels = [[[] for i in range(1 << bits)] for l in range(levels)]
+        self.overflow = []
+        self.tick = int(now / resolution)
+        self.count = 0 # live timers
+        self.stale = False # whether removed timers may still be in slots
+    @property
+    def now(self):
+        return self.tick * self.resolution
+    def add(self, deadline, item):
+        """Arrange for advance() to return item once deadline is past.
+        Returns a handle for remove()."""
+        entry = [max(int(-(-deadline // self.resolution)), self.tick + 1), item]
+        self.place(entry)
+        self.count += 1
+        return entry
+    def remove(self, entry):
+        # Lazily; the entry is skipped when its slot comes round
+        if entry[1] is not None:
+            entry[1] = None
+            self.count -= 1
+            self.stale = True
+    def place(self, entry):
+        delta = entry[0] - self.tick
+        for level, wheel in enumerate(self.wheels):
+            if delta >> (self.bits * (level + 1)) == 0:
+                wheel[(entry[0] >> (self.bits * level)) & self.mask].append(entry)
+                return
+        self.overflow.append(entry)
+    def cascade(self, level):
+        if level == len(self.wheels):
+            entries, self.overflow = self.overflow, []
+        else:
+            slots = self.wheels[level]
+            i = (self.tick >> (self.bits * level)) & self.mask
+            entries, slots[i] = slots[i], []
+            if not i:
+                self.cascade(level + 1)
+        for entry in entries:
+            if entry[1] is not None:
+                self.place(entry)
+    def advance(self, now):
+        """Move time on to now, returning the items which have expired"""
+        target = int(now / self.resolution)
+        expired = []
+        while self.tick < target:
+            if not self.count:
+                # Nothing to wait for; jump straight there
+                if self.stale:
+                    self.wheels = [[[] for slot in wheel] for wheel in self.wheels]
+                    self.overflow = []
+                    self.stale = False
+                self.tick = target
+                break
+            self.tick += 1
+            i = self.tick & self.mask
+            if not i:
+                self.cascade(1)
+            slot, self.wheels[0][i] = self.wheels[0][i], []
+            for entry in slot:
+                if entry[1] is not None:
+                    expired.append(entry[1])
+                    entry[1] = None
+                    self.count -= 1
+        return expired
+
+class Event(object):
+    """Something a thread reports as it happens, without waiting for a
+    reply.  The Reactor hands these to its on_event callback and resumes
+    the thread at once."""
+    def __init__(self, kind, **fields):
+        self.kind = kind
+        self.__dict__.update(fields)
+    def __repr__(self):
+        return 'Event(%r, %s)' % (self.kind, ', '.join('%s=%r' % kv for kv in sorted(self.__dict__.items()) if kv[0] != 'kind'))
 
 def maybe_gen(value):
     if isinstance(value, Iterable):
-        yield from value
+        return (yield from value)
     return value
 
 class Reactor(object):
     class ThreadUsedBareYield(Exception):
         """Bare 'yield' should only be used to yield to a WaitingFor.
         To yield to another asynchronous function, use 'yield from'."""
-    def __init__(self):
+    def __init__(self, on_event=None, timers=None, on_timeout=None):
         self.waiting = {}
+        self.on_event = on_event
+        self.index = {} # key: [WaitingFor]
+        self.owners = {} # owner: {WaitingFor}
+        # May be shared between Reactors; whoever advances it calls the
+        # (fn, arg) items it returns
+        self.timers = TimerWheel() if timers is None else timers
+        self.deadlines = {} # WaitingFor: TimerWheel entry
+        # Called as on_timeout(wf, thread) instead of resuming the thread
+        # here, e.g. when something else drives it
+        self.on_timeout = on_timeout
     def start_thread(self, thread):
-        try:
-            v = next(thread)
-        except StopIteration as s:
-            return s.value
-        if isinstance(v, WaitingFor):
-            self.waiting[v] = thread
-            return None
-        raise self.ThreadUsedBareYield("Thread used 'yield' instead of 'yield from'.", v)
+        return self.feed_value(thread, None)
     def feed_value(self, thread, v):
         try:
             v = thread.send(v)
+            while isinstance(v, Event):
+                if self.on_event is not None:
+                    self.on_event(v)
+                v = thread.send(None)
         except StopIteration as s:
             return s.value
         if isinstance(v, WaitingFor):
-            self.waiting[v] = thread
+            self.suspend(v, thread)
             return None
         raise self.ThreadUsedBareYield("Thread used 'yield' instead of 'yield from'.", v)
     def progress(self, wf, value):
+        return self.feed_value(self.cancel(wf), value)
+    def suspend(self, wf, thread):
+        """Record that thread (or whatever will resume it) awaits wf"""
+        self.waiting[wf] = thread
+        for key in wf.keys:
+            self.index.setdefault(key, []).append(wf)
+            self.owners.setdefault(key[0], set()).add(wf)
+        if wf.timeout is not None:
+            # Relative to the wheel's time, to save reading the clock
+            self.deadlines[wf] = self.timers.add(self.timers.now + wf.timeout, (self.time_out, wf))
+    def cancel(self, wf):
+        """Stop waiting for wf, returning its thread"""
         thread = self.waiting.pop(wf)
-        return self.feed_value(thread, value)
+        entry = self.deadlines.pop(wf, None)
+        if entry is not None:
+            self.timers.remove(entry)
+        for key in wf.keys:
+            waiters = self.index[key]
+            waiters.remove(wf)
+            if not waiters:
+                del self.index[key]
+            owned = self.owners.get(key[0])
+            if owned is not None:
+                owned.discard(wf)
+                if not owned:
+                    del self.owners[key[0]]
+        return thread
+    def disarm(self, wf):
+        """Let wf wait without its timeout"""
+        entry = self.deadlines.pop(wf, None)
+        if entry is not None:
+            self.timers.remove(entry)
+    def time_out(self, wf):
+        del self.deadlines[wf]
+        thread = self.cancel(wf)
+        if self.on_timeout is not None:
+            return self.on_timeout(wf, thread)
+        return self.feed_value(thread, TIMED_OUT)
+    def advance(self, now):
+        """Move the timers on to now (e.g. time.monotonic()), resuming any
+        threads whose waits have timed out"""
+        for fn, arg in self.timers.advance(now):
+            fn(arg)
+    def lookup(self, key):
+        """The waiters indexed under key"""
+        return list(self.index.get(key, ()))
+    def waiting_for(self, owner):
+        """The waiters with a key owned by owner"""
+        return list(self.owners.get(owner, ()))
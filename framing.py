@@ -0,0 +1,311 @@
+"""
+Compact framing for the game protocol, negotiated by the 'frames'
+extension (see protocol.md).
+
+Each message is sent as a 4-byte big-endian length followed by that many
+bytes of JSON; but rather than an object, the JSON is an array
+    [code, mask, value, ...]
+where code stands for the message's type and the set bits of mask say
+which of that type's FIELDS are present, their values following in
+FIELDS order.  Any other fields go in an object after the values, flagged
+by the bit after the last field's.  Types not listed here are sent with
+code the type itself and no FIELDS.
+
+So {'type': 'choose bowler', 'team': 'bob', 'bowler': 'bob9', 'over': 3}
+becomes [5,7,"bob","bob9",3].
+
+The messages sent for every delivery ('roll', 'ball', and 'action'
+requests and replies such as {'type': 'action', 'action': 'roll'}) are
+instead given a binary body, when they fit one of BODIES: a byte for the
+body (below 0x20, which no JSON array starts with), a byte whose set bits
+say which of its fields are present, then each of those, a string as a
+2-byte index and a number as a byte, and any tail of bytes.  Strings are
+interned by each end for what it sends: the first time one is sent, a
+frame of a 0 byte and the UTF-8 string comes before, giving it the next
+index.  So interned strings are the state of a connection (a Codec), and
+each client's is different.
+
+So {'type': 'roll', 'player': 'bob3', 'dice': [4]} becomes, once bob3
+has been interned as 7, a frame of the 5 bytes 01 03 00 07 04.
+
+The 'zlib' extension, which may be used with or without frames, is a
+separate matter: it compresses each direction of the connection as one
+zlib stream, flushed (Z_SYNC_FLUSH) whenever the sender has no more to
+send for the moment.
+"""
+import json
+import struct
+
+# Most frequent first, so they get one-digit codes
+FIELDS = (
+    ('roll', ('player', 'dice', 'reason')),
+    ('ball', ('runs', 'bowler', 'striker', 'extra', 'wicket', 'catch')),
+    ('action', ('action', 'player', 'reason', 'dice', 'legal', 'current', 'tails',
+                'bat', 'bowler', 'keeper', 'batsman', 'swap', 'fielders', 'call')),
+    ('fow', ('out', 'score', 'not out', 'nscore', 'over', 'ball', 'wkts')),
+    ('over', ('over', 'total', 'for')),
+    ('choose bowler', ('team', 'bowler', 'over')),
+    ('delegate', ('player', 'span')),
+    ('wall', ('frm', 'message')),
+    ('message', ('frm', 'message', 'to')),
+    ('enter', ('user',)),
+    ('exit', ('user',)),
+    ('innings', ('team', 'over', 'ball', 'total', 'for')),
+    ('match', ('winner', 'loser', 'runs', 'wickets', 'abandoned')),
+    ('toss', ('caller', 'call', 'coin')),
+    ('choose first', ('batting',)),
+    ('choose keeper', ('team', 'keeper')),
+    ('next bat', ('team', 'batsman', 'order')),
+    ('field assign', ('team', 'fielders')),
+    ('checkpoint', ('teams', 'innings')),
+    ('begin', ()),
+    ('error', ('message',)),
+    ('roster', ('users',)),
+    ('invite', ('invitation', 'frm', 'to')),
+    ('accept', ('invitation', 'frm', 'to')),
+    ('reject', ('invitation', 'frm', 'to')),
+    ('revoke', ('invitation', 'frm', 'to')),
+    ('join', ('frm', 'player', 'team')),
+    ('assign', ('player', 'to', 'team', 'new')),
+    ('claim', ('player',)),
+    ('disown', ('player', 'frm', 'team')),
+    ('part', ('frm',)),
+    ('rename', ('frm', 'to')),
+    ('team name', ('name', 'team')),
+    ('hello', ('username', 'player', 'extensions')),
+    ('goodbye', ('message',)),
+    ('welcome', ('version', 'message', 'extensions')),
+)
+CODES = dict((typ, code) for code, (typ, fields) in enumerate(FIELDS))
+BITS = [dict((f, bit) for bit, f in enumerate(fields)) for typ, fields in FIELDS]
+
+# Binary bodies, numbered from 1: (type, fields, tail), each field being
+# (name, STR or BYTE), and tail the name of a list of bytes, if any
+STR, BYTE = 'H', 'B'
+BODIES = (
+    ('roll', (('player', STR),), 'dice'),
+    ('ball', (('runs', BYTE), ('bowler', STR), ('striker', STR), ('extra', STR),
+              ('wicket', STR), ('catch', STR)), None),
+    ('action', (('action', STR), ('player', STR), ('reason', STR), ('dice', BYTE)), None),
+)
+BINARY = dict((typ, tag) for tag, (typ, fields, tail) in enumerate(BODIES, 1))
+# Most strings a Codec will intern
+MAX_INTERNED = 0xffff
+
+# Largest frame we'll accept
+MAX_FRAME = 1 << 24
+# Caches, bounded as masks come from peers (and keys could from callers):
+# (type, keys): packing plan, for pack
+PLANS = {}
+# (code, mask): field names, for unpack
+NAMES = {}
+# keys: binary body plan or None, for Codec.frame
+BODY_PLANS = {}
+# first two bytes of a body: (type, field names, which are strings,
+# struct, tail), for Codec.unpack; there are few enough to need no bound
+LAYOUTS = {}
+MAX_CACHED = 4096
+LENGTH = struct.Struct('>I')
+# json.dumps would make a new encoder per call for the separators
+ENCODER = json.JSONEncoder(separators=(',', ':'))
+
+def plan(typ, keys):
+    """How to pack a message of type typ with keys, in that order: the
+    array's head, the keys whose values follow, and any extra keys"""
+    code = CODES.get(typ)
+    bits = BITS[code] if code is not None else {}
+    present = sorted((bits[k], k) for k in keys if k in bits)
+    extras = tuple(k for k in keys if k not in bits and k != 'type')
+    mask = sum(1 << bit for bit, k in present)
+    if extras:
+        mask |= 1 << len(bits)
+    return [typ if code is None else code, mask], tuple(k for bit, k in present), extras
+
+def pack(msg):
+    typ = msg['type']
+    key = (typ, tuple(msg))
+    p = PLANS.get(key)
+    if p is None:
+        p = plan(typ, key[1])
+        if len(PLANS) < MAX_CACHED:
+            PLANS[key] = p
+    head, fields, extras = p
+    arr = head + [msg[k] for k in fields]
+    if extras:
+        arr.append(dict((k, msg[k]) for k in extras))
+    return arr
+
+def unpack(arr):
+    code, mask = arr[0], arr[1]
+    names = NAMES.get((code, mask))
+    if names is None:
+        if isinstance(code, str):
+            typ, fields = code, ()
+        else:
+            typ, fields = FIELDS[code]
+        names = (typ, tuple(f for bit, f in enumerate(fields) if mask >> bit & 1), bool(mask >> len(fields) & 1))
+        if len(NAMES) < MAX_CACHED:
+            NAMES[(code, mask)] = names
+    typ, fields, extras = names
+    d = {'type': typ}
+    d.update(zip(fields, arr[2:]))
+    if extras:
+        d.update(arr[-1])
+    return d
+
+def frame(msg):
+    payload = ENCODER.encode(pack(msg)).encode('utf8')
+    return LENGTH.pack(len(payload)) + payload
+
+def cut_frame(buf):
+    """Cut the first whole frame's payload from bytearray buf, or return
+    None if there isn't one yet"""
+    if len(buf) < 4:
+        return None
+    n, = LENGTH.unpack_from(buf)
+    if n > MAX_FRAME:
+        raise ValueError("Frame of %d bytes is too large" % (n,))
+    if len(buf) < 4 + n:
+        return None
+    payload = bytes(buf[4:4 + n])
+    del buf[:4 + n]
+    return payload
+
+def decode(payload):
+    # Decoding first saves json.loads guessing the encoding
+    try:
+        arr = json.loads(payload.decode('utf8'))
+    except RecursionError:
+        # Too deeply nested; no message of ours is
+        raise ValueError("Frame nested too deeply")
+    if not isinstance(arr, list) or len(arr) < 2 or not isinstance(arr[1], int):
+        raise ValueError("Malformed frame")
+    try:
+        return unpack(arr)
+    except (IndexError, TypeError) as e:
+        raise ValueError("Malformed frame: %r" % (e,))
+
+def next_frame(buf):
+    """Cut the first whole frame from bytearray buf and decode it, or
+    return None if there isn't one yet.  Raises ValueError if buf doesn't
+    start with a valid frame.  Binary bodies need a Codec."""
+    payload = cut_frame(buf)
+    return None if payload is None else decode(payload)
+
+def body_plan(typ, keys):
+    """How to send a message of type typ with keys (other than 'type') as
+    a binary body: (struct, head, fields, tail); or None if it can't be"""
+    tag = BINARY.get(typ)
+    if tag is None:
+        return None
+    typ, fields, tail = BODIES[tag - 1]
+    present = [(bit, k, kind) for bit, (k, kind) in enumerate(fields) if k in keys]
+    has_tail = tail is not None and tail in keys
+    if len(present) + has_tail != len(keys):
+        return None
+    mask = sum(1 << bit for bit, k, kind in present) | has_tail << len(fields)
+    return (struct.Struct('>BB' + ''.join(kind for bit, k, kind in present)), (tag, mask),
+            tuple((k, kind == STR) for bit, k, kind in present), tail if has_tail else None)
+
+def is_byte(v):
+    return type(v) is int and 0 <= v < 256
+
+def body_layout(payload):
+    tag, mask = payload[0], payload[1] if len(payload) > 1 else 0
+    if tag > len(BODIES) or mask >> len(BODIES[tag - 1][1]) > (BODIES[tag - 1][2] is not None):
+        raise ValueError("Malformed frame: body %d, mask %d" % (tag, mask))
+    typ, fields, tail = BODIES[tag - 1]
+    present = [(k, kind) for bit, (k, kind) in enumerate(fields) if mask >> bit & 1]
+    layout = (typ, tuple(k for k, kind in present), tuple(k for k, kind in present if kind == STR),
+              struct.Struct('>BB' + ''.join(kind for k, kind in present)),
+              tail if mask >> len(fields) & 1 else None)
+    LAYOUTS[payload[:2]] = layout
+    return layout
+
+class Codec(object):
+    """One connection's framing: as frame() and next_frame(), but with
+    binary bodies, and the strings each end has interned for them"""
+    def __init__(self, interned=(), strings=()):
+        self.interned = dict((s, i) for i, s in enumerate(interned)) # sent
+        self.strings = list(strings) # received, by index
+    def export(self):
+        """What another process needs to carry on with this Codec"""
+        return {'interned': sorted(self.interned, key=self.interned.get), 'strings': self.strings}
+    def frame(self, msg):
+        # A message whose keys would fit a body is still sent as JSON if
+        # its values don't
+        keys = tuple(msg)
+        p = BODY_PLANS.get(keys)
+        if p is None:
+            p = body_plan(msg['type'], keys[1:]) if keys and keys[0] == 'type' else None
+            if len(BODY_PLANS) < MAX_CACHED:
+                BODY_PLANS[keys] = p
+        if p is None:
+            return frame(msg)
+        body, head, fields, tail = p
+        values = list(head)
+        new = {} # strings to intern, if it is sent as a body
+        for k, string in fields:
+            v = msg[k]
+            if string:
+                if type(v) is not str:
+                    return frame(msg)
+                i = self.interned.get(v)
+                if i is None:
+                    i = new.get(v)
+                    if i is None:
+                        i = new[v] = len(self.interned) + len(new)
+                        if i >= MAX_INTERNED:
+                            return frame(msg)
+                v = i
+            elif not is_byte(v):
+                return frame(msg)
+            values.append(v)
+        if tail is not None:
+            t = msg[tail]
+            if type(t) is not list or not all(is_byte(x) for x in t):
+                return frame(msg)
+            data = body.pack(*values) + bytes(t)
+        else:
+            data = body.pack(*values)
+        out = []
+        for v in new:
+            d = b'\0' + v.encode('utf8')
+            out.append(LENGTH.pack(len(d)) + d)
+        self.interned.update(new)
+        out.append(LENGTH.pack(len(data)) + data)
+        return b''.join(out)
+    def next_frame(self, buf):
+        """Cut the first whole message from bytearray buf and decode it, or
+        return None if there isn't one yet.  Raises ValueError if buf
+        doesn't start with a valid frame."""
+        while True:
+            payload = cut_frame(buf)
+            if payload is None or not payload or payload[0] >= 0x20:
+                return None if payload is None else decode(payload)
+            if payload[0]:
+                return self.unpack(payload)
+            if len(self.strings) >= MAX_INTERNED:
+                raise ValueError("Too many strings interned")
+            try:
+                self.strings.append(payload[1:].decode('utf8'))
+            except UnicodeDecodeError as e:
+                raise ValueError("Malformed string: %s" % (e,))
+    def unpack(self, payload):
+        layout = LAYOUTS.get(payload[:2])
+        if layout is None:
+            layout = body_layout(payload)
+        typ, names, strs, body, tail = layout
+        try:
+            values = body.unpack_from(payload)
+            d = {'type': typ}
+            d.update(zip(names, values[2:]))
+            for k in strs:
+                d[k] = self.strings[d[k]]
+        except (struct.error, IndexError) as e:
+            raise ValueError("Malformed frame: %r" % (e,))
+        if tail is not None:
+            d[tail] = list(payload[body.size:])
+        elif len(payload) != body.size:
+            raise ValueError("Malformed frame: %d bytes over" % (len(payload) - body.size,))
+        return d
@@ -0,0 +1,95 @@
+"""
+Append-only on-disk logs of networked games, one JSON record per line.
+
+The server writes a log for each Game once it begins.  Records are queued
+in memory and written out in batches, and only synced to disk every so
+often (see server.LOG_SYNC), so logging adds no disk latency per ball.
+
+Record kinds (the 'log' field) and their fields:
+    begin       captains, teams     teams: {captain: [[player, client], ...]}
+                                    in batting order
+    input       value               a value the match took from outside: a
+                                    client's action message, null for a
+                                    reconnection, 'timed out', a roll, or
+                                    a 'delegate' message for a trigger
+                                    delegated while it was requested
+    delegate    player, span        client delegated (or revoked) triggers
+                                    other than one requested
+    event       msg                 a game message broadcast to its room
+    checkpoint  state               where the match stood (see
+                                    Game.snapshot), sent to rejoiners
+    end                             the game is over
+
+A match is a suspended generator, so it can't be rebuilt from a
+checkpoint; instead the server replays the inputs through a fresh match
+(see Game.restore), which takes a few milliseconds.
+"""
+import json
+import os
+
+def encode(record):
+    return (json.dumps(record) + '\n').encode('utf8')
+
+class NullLog(object):
+    def write(self, record):
+        pass
+    def event(self, data):
+        pass
+    def flush(self):
+        pass
+    def sync(self):
+        pass
+    def close(self):
+        pass
+
+class GameLog(NullLog):
+    def __init__(self, f, dirty):
+        self.file = f
+        # Encoded records awaiting flush(); we add ourselves to dirty when
+        # the first arrives, for the server to flush at the end of its tick
+        self.pending = []
+        self.dirty = dirty
+    @classmethod
+    def create(cls, path, dirty):
+        return cls(open(path, 'xb'), dirty)
+    @classmethod
+    def recover(cls, path, dirty):
+        """Open an existing log for appending, returning it and its records.
+        A torn final record (from a crash mid-write) is cut off."""
+        f = open(path, 'r+b')
+        records = []
+        good = 0
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break
+            good += len(line)
+        f.truncate(good)
+        f.seek(good)
+        return cls(f, dirty), records
+    def queue(self, data):
+        if not self.pending:
+            self.dirty.add(self)
+        self.pending.append(data)
+    def write(self, record):
+        self.queue(encode(record))
+    def event(self, data):
+        """data is an encoded message line, which we wrap as it is"""
+        self.queue(b'{"log": "event", "msg": ' + data[:-1] + b'}\n')
+    def flush(self):
+        if self.pending:
+            self.file.writelines(self.pending)
+            self.file.flush()
+            self.pending = []
+    def sync(self):
+        os.fdatasync(self.file.fileno())
+    def close(self):
+        self.flush()
+        self.sync()
+        self.file.close()
+        self.dirty.discard(self)
+
+NULL = NullLog()
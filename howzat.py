@@ -1,7 +1,9 @@
 #!/usr/bin/python3
+import array
 import random
 import time
 
+from commentary import CONSOLE, StreamCommentary
 from coroutine import Reactor, maybe_gen, WaitingFor
 
 EXTRA_NB = 1
@@ -15,8 +17,8 @@ class Wicket(object):
         self.who = who
         self.cab = cab
     @classmethod
-    def roll(cls, bowl, bowler, batsman, field):
-        print("Howzat?")
+    def roll(cls, bowl, bowler, batsman, field, commentary=CONSOLE):
+        commentary.event('appeal')
         # Not Out, bowled, caught, stumped, lbw, run out
         if bowl == 1: # Not Out
             return
@@ -25,12 +27,12 @@ class Wicket(object):
         elif bowl == 3:
             # batsman: 2d6 to decide where he hits it.  12 goes to 1
             fielder = field[((yield from maybe_gen(batsman.roll_2d6(prompt="Roll 2d6 to pick fielder"))) - 1) % 11]
-            print("In the air to %s..." % (fielder.name,))
+            commentary.event('chance', fielder=fielder)
             # fielder: roll d6 to catch, drop on 1 or 2
             if (yield from maybe_gen(fielder.roll_d6(prompt="Roll to attempt the catch"))) > 2:
                 return cls("caught", fielder, fielder == bowler)
             else:
-                print("Dropped it!")
+                commentary.event('dropped', fielder=fielder)
                 return
         elif bowl == 4:
             # Wicketkeeper is a roll of 7 on the 2d6
@@ -49,7 +51,7 @@ class Wicket(object):
         return self.how
 
 class Ball(object):
-    def __init__(self, bowler, batsman, runs, wicket=None, extra=None):
+    def __init__(self, bowler, batsman, runs, wicket=None, extra=None, commentary=CONSOLE):
         self.bowler = bowler
         self.batsman = batsman
         self.runs = runs
@@ -59,9 +61,9 @@ class Ball(object):
         self.b = extra == EXTRA_B
         self.lb = extra == EXTRA_LB
         if extra == EXTRA_NB:
-            print("No-Ball called")
+            commentary.event('extra', extra='nb')
         elif extra == EXTRA_W:
-            print("Wide ball")
+            commentary.event('extra', extra='w')
         # No sixes off potential Extras; dot ball instead
         if (extra is not None) and self.runs == 6:
             self.runs = 0
@@ -69,30 +71,30 @@ class Ball(object):
             self.b = False
             self.lb = False
         if self.b:
-            print("Byes taken")
+            commentary.event('extra', extra='b')
         elif self.lb:
-            print("Leg Byes taken")
+            commentary.event('extra', extra='lb')
         self.total_runs = self.runs + int(self.nb) + int(self.w)
         self.bat_runs = 0 if self.b or self.lb else self.runs
         self.bwl_runs = 0 if self.b or self.lb else self.total_runs
         self.legal = not self.nb and not self.w
     @classmethod
-    def roll(cls, bowler, batsman, field):
+    def roll(cls, bowler, batsman, field, commentary=CONSOLE):
         bowl = yield from maybe_gen(bowler.roll_d6(prompt="Roll to bowl to "+batsman.name))
         extra = None
         if bowl == 1:
             # possible Extra; roll again
             extra = yield from maybe_gen(bowler.roll_d6(prompt="Roll for extras"))
         if extra == EXTRA_W: # Batsman does not roll
-            return cls(bowler, batsman, 0, extra=extra)
+            return cls(bowler, batsman, 0, extra=extra, commentary=commentary)
         else:
             bat = yield from maybe_gen(batsman.roll_d6(prompt="Roll to play the ball"))
             if bat == 5: # Wicket
-                return cls(bowler, batsman, 0, (yield from Wicket.roll(bowl, bowler, batsman, field)), extra=extra)
+                return cls(bowler, batsman, 0, (yield from Wicket.roll(bowl, bowler, batsman, field, commentary)), extra=extra, commentary=commentary)
             elif bat == 3: # No run
-                return cls(bowler, batsman, 0, extra=extra)
+                return cls(bowler, batsman, 0, extra=extra, commentary=commentary)
             else:
-                return cls(bowler, batsman, bat, extra=extra)
+                return cls(bowler, batsman, bat, extra=extra, commentary=commentary)
     def __str__(self):
         if self.wicket:
             if self.wicket.how == 'run out':
@@ -151,10 +153,153 @@ class Ball(object):
             return str(self.runs)
         return '.'
 
+class BallLog(object):
+    """Compact ball-by-ball record of an innings.
+
+    Each delivery is packed into one integer, rather than kept as a Ball
+    with its own __dict__.  PackedBall views, made on demand, provide the
+    same attributes and scorecard strings as the Ball they came from."""
+    HOWS = (None, 'bowled', 'caught', 'stumped', 'lbw', 'run out')
+    # Bit layout, from the bottom: runs (3), nb, w, b, lb, wicket how (3),
+    # caught & bowled, wicket fielder (4), bowler (4), batsman (4)
+    NB = 1 << 3
+    W = 1 << 4
+    B = 1 << 5
+    LB = 1 << 6
+    HOW_SHIFT = 7
+    CAB = 1 << 10
+    WHO_SHIFT = 11
+    BOWLER_SHIFT = 15
+    BATSMAN_SHIFT = 19
+    def __init__(self, batting, fielding):
+        self.bteam = batting
+        self.fteam = fielding
+        self.bat_idx = dict((p, i) for i, p in enumerate(batting.players))
+        self.fld_idx = dict((p, i) for i, p in enumerate(fielding.players))
+        self.codes = array.array('I')
+    def __len__(self):
+        return len(self.codes)
+    def __getitem__(self, i):
+        return PackedBall(self, i)
+    def __iter__(self):
+        for i in range(len(self.codes)):
+            yield PackedBall(self, i)
+    def append(self, ball):
+        """Pack ball into the log, returning a view of it"""
+        code = ball.runs
+        if ball.nb:
+            code |= self.NB
+        if ball.w:
+            code |= self.W
+        if ball.b:
+            code |= self.B
+        if ball.lb:
+            code |= self.LB
+        if ball.wicket:
+            code |= self.HOWS.index(ball.wicket.how) << self.HOW_SHIFT
+            if ball.wicket.cab:
+                code |= self.CAB
+            if ball.wicket.who:
+                code |= self.fld_idx[ball.wicket.who] << self.WHO_SHIFT
+        code |= self.fld_idx[ball.bowler] << self.BOWLER_SHIFT
+        code |= self.bat_idx[ball.batsman] << self.BATSMAN_SHIFT
+        self.codes.append(code)
+        return PackedBall(self, len(self.codes) - 1)
+
+class PackedBall(object):
+    """View of one delivery in a BallLog, standing in for a Ball"""
+    __slots__ = ('log', 'i')
+    def __init__(self, log, i):
+        self.log = log
+        self.i = i
+    @property
+    def code(self):
+        return self.log.codes[self.i]
+    @property
+    def bowler(self):
+        return self.log.fteam.players[(self.code >> BallLog.BOWLER_SHIFT) & 15]
+    @property
+    def batsman(self):
+        return self.log.bteam.players[(self.code >> BallLog.BATSMAN_SHIFT) & 15]
+    @property
+    def runs(self):
+        return self.code & 7
+    @property
+    def nb(self):
+        return bool(self.code & BallLog.NB)
+    @property
+    def w(self):
+        return bool(self.code & BallLog.W)
+    @property
+    def b(self):
+        return bool(self.code & BallLog.B)
+    @property
+    def lb(self):
+        return bool(self.code & BallLog.LB)
+    @property
+    def wicket(self):
+        code = self.code
+        how = BallLog.HOWS[(code >> BallLog.HOW_SHIFT) & 7]
+        if how is None:
+            return None
+        who = None
+        if how in ('caught', 'stumped'):
+            who = self.log.fteam.players[(code >> BallLog.WHO_SHIFT) & 15]
+        return Wicket(how, who, bool(code & BallLog.CAB))
+    @property
+    def total_runs(self):
+        return self.runs + int(self.nb) + int(self.w)
+    @property
+    def bat_runs(self):
+        return 0 if self.b or self.lb else self.runs
+    @property
+    def bwl_runs(self):
+        return 0 if self.b or self.lb else self.total_runs
+    @property
+    def legal(self):
+        return not self.nb and not self.w
+    __str__ = Ball.__str__
+    batstr = Ball.batstr
+    bowlstr = Ball.bowlstr
+
+class BallList(object):
+    """List of deliveries from one BallLog, stored as indices into it"""
+    __slots__ = ('log', 'idx')
+    def __init__(self, log):
+        self.log = log
+        self.idx = array.array('H')
+    def append(self, ball):
+        self.idx.append(ball.i)
+    def __len__(self):
+        return len(self.idx)
+    def __getitem__(self, i):
+        return PackedBall(self.log, self.idx[i])
+    def __iter__(self):
+        for i in self.idx:
+            yield PackedBall(self.log, i)
+
+class BallRange(object):
+    """Run of consecutive deliveries in a BallLog, such as an Over"""
+    __slots__ = ('log', 'start', 'stop')
+    def __init__(self, log):
+        self.log = log
+        self.start = self.stop = len(log)
+    def append(self, ball):
+        assert ball.i == self.stop, "BallRange must be appended in order"
+        self.stop += 1
+    def __len__(self):
+        return self.stop - self.start
+    def __getitem__(self, i):
+        return PackedBall(self.log, range(self.start, self.stop)[i])
+    def __iter__(self):
+        for i in range(self.start, self.stop):
+            yield PackedBall(self.log, i)
+
 class Over(object):
+    __slots__ = ('bowler', 'balls', 'nb', 'w', 'runs', 'wkts', 'to_come')
     def __init__(self, inns):
         self.bowler = inns.bowling
-        self.balls = []
+        self.balls = [] if inns.log is None else BallRange(inns.log)
         self.bowler.bowling.append(self)
         self.nb = 0
         self.w = 0
@@ -163,15 +308,23 @@ class Over(object):
         self.to_come = 6
     def deliver(self, ball):
         self.balls.append(ball)
+        # Keep the bowler's figures up to date as we go
+        bwl = self.bowler
         if ball.nb:
             self.nb += 1
+            bwl.nb += 1
         elif ball.w:
             self.w += 1
+            bwl.w += 1
         else:
             self.to_come -= 1
         if ball.wicket and ball.wicket.how != 'run out':
             self.wkts += 1
+            bwl.wkts += 1
         self.runs += ball.bwl_runs
+        bwl.conceded += ball.bwl_runs
+        if ball.legal and not self.to_come and not self.runs:
+            bwl.maidens += 1
     def ofrac(self, ps=False):
         if not self.to_come and not ps:
             return ""
@@ -182,12 +335,15 @@ class Over(object):
         return "%d%s" % (onum, self.ofrac(ps))
 
 class Innings(object):
-    def __init__(self, batting, fielding, chasing=None):
+    def __init__(self, batting, fielding, chasing=None, compact=False, commentary=CONSOLE):
         self.bteam = batting
         self.fteam = fielding
         self.chasing = chasing
         self.to_bat = list(self.bteam.players)
         self.border = []
+        # Compact mode keeps balls in a BallLog rather than as Ball objects
+        self.log = BallLog(batting, fielding) if compact else None
+        self.commentary = commentary
     def start(self):
         # These will swap ends before the first over
         self.non_striker = yield from self.choose_batsman()
@@ -205,6 +361,8 @@ class Innings(object):
         bat = yield from maybe_gen(self.bteam.captain.choose_batsman(self.to_bat))
         self.to_bat.remove(bat)
         self.border.append(bat)
+        if self.log is not None:
+            bat.innings = BallList(self.log)
         return bat
     def legal_bowlers(self):
         return [p for p in self.fteam.players if len(p.bowling) < 4 and p != self.resting]
@@ -226,15 +384,13 @@ class Innings(object):
             self.fteam.field[0], self.fteam.field[bi] = self.fteam.field[bi], self.fteam.field[0]
             self.bowling = bowl
         if self.bowling.keeper: # Local captains only
-            keep = yield from maybe_gen(self.fteam.captain.choose_keeper([p for p in self.fteam if p != self.bowling]))
+            keep = yield from maybe_gen(self.fteam.captain.choose_keeper([p for p in self.fteam.players if p != self.bowling]))
             self.choose_keeper(keep)
         self.swap_strike()
         self.overs.append(Over(self))
-        if self.chasing is None:
-            chase = ""
-        else:
-            chase = " - %d required" % (self.chasing + 1 - self.total)
-        print("Over %d; %d/%d.  %s to %s (%s off strike)%s" % (len(self.overs), self.total, len(self.fow), self.bowling.name, self.striker.name, self.non_striker.name, chase))
+        self.commentary.event('over', inns=self)
+        # Before the over's first ball waits on anyone's dice
+        yield from self.commentary.drain()
         if not self.bowling.first_over:
             self.bowling.first_over = len(self.overs)
     @property
@@ -246,10 +402,12 @@ class Innings(object):
     def bowl(self):
         if not self.over.to_come:
             yield from self.new_over()
-        ball = yield from Ball.roll(self.bowling, self.striker, self.fteam.field)
+        ball = yield from Ball.roll(self.bowling, self.striker, self.fteam.field, self.commentary)
+        if self.log is not None:
+            ball = self.log.append(ball)
         self.over.deliver(ball)
         self.striker.score(ball)
-        print(str(ball))
+        self.commentary.event('ball', inns=self, ball=ball)
         if ball.wicket:
             self.striker.out = ball
             self.fow.append((self.striker, self.total, self.odesc))
@@ -269,32 +427,32 @@ class Innings(object):
             self.in_play = False
         if self.chasing is not None and self.total > self.chasing:
             self.in_play = False
-    def batting_summary(self):
+    def batting_summary(self, file=None):
         if self.chasing is not None:
-            print("Chasing %d" % (self.chasing,))
+            print("Chasing %d" % (self.chasing,), file=file)
         for bat in self.border:
             stones = '' # Batting milestones
             if bat.fifty:
                 stones = ' [L%d]' % bat.fifty
             if bat.hundred:
                 stones += ' [C%d]' % bat.hundred
-            print("%s  %s  %s%d (%d%s)" % (bat.name, ''.join(b.batstr() for b in bat.innings).replace('..', ':'), '' if bat.out else 'not  out  ', bat.scored, bat.faced, stones))
+            print("%s  %s  %s%d (%d%s)" % (bat.name, ''.join(b.batstr() for b in bat.innings).replace('..', ':'), '' if bat.out else 'not  out  ', bat.scored, bat.faced, stones), file=file)
         for bat in self.to_bat:
-            print("%s  did not bat" % (bat.name,))
+            print("%s  did not bat" % (bat.name,), file=file)
         def sfow(fow):
             i, fow = fow
             bat, tot, ovs = fow
             return '%s %d/%d (%s)' % (bat.name, tot, i + 1, ovs)
         print("Extras: %dnb %dw %db %dlb" % (sum(o.nb for o in self.overs),
                                              sum(o.w for o in self.overs),
-                                             self.b, self.lb))
+                                             self.b, self.lb), file=file)
         if len(self.fow) == 10:
             fer = " all out"
         else:
             fer = "/%d" % (len(self.fow),)
-        print("Total: %d%s (%s ovs)" % (self.total, fer, self.odesc))
-        print("FOW: %s" % ('; '.join(map(sfow, enumerate(self.fow)))))
-    def bowling_summary(self):
+        print("Total: %d%s (%s ovs)" % (self.total, fer, self.odesc), file=file)
+        print("FOW: %s" % ('; '.join(map(sfow, enumerate(self.fow)))), file=file)
+    def bowling_summary(self, file=None):
         for bwl in sorted(self.fteam.field, key=lambda p:p.first_over):
             if bwl.bowling:
                 over = bwl.bowling[-1]
@@ -309,7 +467,7 @@ class Innings(object):
                     exs = ''
                 # Bowling Analysis
                 banal = ' '.join(''.join(b.bowlstr() for b in o.balls) for o in bwl.bowling)
-                print("%s: %s  %so %dm %d/%d%s" % (bwl.name, banal, over.over(len(bwl.bowling)), bwl.maidens, bwl.conceded, bwl.wkts, exs))
+                print("%s: %s  %so %dm %d/%d%s" % (bwl.name, banal, over.over(len(bwl.bowling)), bwl.maidens, bwl.conceded, bwl.wkts, exs), file=file)
 
 class Player(object):
     def __init__(self, name):
@@ -321,22 +479,31 @@ class Player(object):
         self.first_over = 0
         self.fifty = None
         self.hundred = None
+        self.commentary = CONSOLE
+        # Batting stats, updated by score()
+        self.scored = 0
+        self.faced = 0
+        # Bowling stats, updated by Over.deliver()
+        self.wkts = 0
+        self.conceded = 0
+        self.maidens = 0
+        self.nb = 0
+        self.w = 0
     def flip_coin(self, prompt=None):
         return bool(self.randint(0, 1))
     def do_roll_d6(self, prompt=None):
         return self.randint(1, 6, prompt=prompt)
     def roll_d6(self, prompt=None):
         r = self.do_roll_d6(prompt)
-        print("%s rolled d6 %s" % (self.name, chr(0x267f + r)))
+        self.commentary.event('roll', player=self, dice=[r])
         return r
     def roll_2d6(self, prompt=None):
         pa = prompt + " (1)" if prompt else None
         pb = prompt + " (2)" if prompt else None
         a = self.do_roll_d6(prompt=pa)
         b = self.do_roll_d6(prompt=pb)
-        r = a + b
-        print("%s rolled 2d6 %s%s -> %d" % (self.name, chr(0x267f + a), chr(0x267f + b), r))
-        return r
+        self.commentary.event('roll', player=self, dice=[a, b])
+        return a + b
     def maybe_choose_bowler(self, inns):
         curr = inns.bowling
         legal = inns.legal_bowlers()
@@ -348,33 +515,13 @@ class Player(object):
         return legal[0]
     def score(self, ball):
         self.innings.append(ball)
+        self.scored += ball.bat_runs
+        if ball.legal:
+            self.faced += 1
         if self.fifty is None and self.scored >= 50:
             self.fifty = self.faced
         if self.hundred is None and self.scored >= 100:
             self.hundred = self.faced
-    # Batting stats
-    @property
-    def scored(self):
-        return sum(b.bat_runs for b in self.innings)
-    @property
-    def faced(self):
-        return len([b for b in self.innings if b.legal])
-    # Bowling stats
-    @property
-    def wkts(self):
-        return sum(o.wkts for o in self.bowling)
-    @property
-    def conceded(self):
-        return sum(o.runs for o in self.bowling)
-    @property
-    def maidens(self):
-        return len([o for o in self.bowling if not o.runs and not o.to_come])
-    @property
-    def nb(self):
-        return sum(o.nb for o in self.bowling)
-    @property
-    def w(self):
-        return sum(o.w for o in self.bowling)
 
 class DeterministicPlayer(Player):
     def __init__(self, name):
@@ -483,14 +630,15 @@ class ConsolePlayer(Player):
                 print("Player not found.  Please choose a wicketkeeper from the available list.")
 
 class Team(object):
-    def __init__(self, name, players):
+    def __init__(self, name, players, keeper=None):
         assert len(players) == 11, players
         self.name = name
         self.players = players
         self.captain = self.players[0]
         # For now, hardcode the fielding-positions
         self.field = list(players)
-        keep = self.captain.choose_keeper(self.field)
+        # Remote captains must be asked beforehand, from a coroutine
+        keep = self.captain.choose_keeper(self.field) if keeper is None else keeper
         keep.keeper = True
         ki = self.field.index(keep)
         self.field[6], self.field[ki] = self.field[ki], self.field[6]
@@ -504,52 +652,63 @@ class Team(object):
     def cons(cls, prefix):
         return cls("Console player", [ConsolePlayer("%s%d" % (prefix, i + 1)) for i in range(11)])
 
-def toss(TA, TB):
+def toss(TA, TB, commentary=CONSOLE):
     # captains
     CA = TA.captain
     CB = TB.captain
     # True is Tails
     call = yield from maybe_gen(CA.call_toss())
-    print("%s called %s" % (CA.name, "tails" if call else "heads"))
+    commentary.event('call', player=CA, tails=call)
     coin = yield from maybe_gen(CB.flip_coin())
-    print("The coin landed %s up" % ("tails" if coin else "heads"))
+    commentary.event('coin', tails=coin)
     if call == coin:
         if (yield from maybe_gen(CA.choose_to_bat())):
-            print("%s won the toss and elected to bat" % (TA.name,))
+            commentary.event('toss', team=TA, bat=True)
             return TA, TB
-        print("%s won the toss and elected to field" % (TA.name,))
+        commentary.event('toss', team=TA, bat=False)
         return TB, TA
-        return
     if (yield from maybe_gen(CB.choose_to_bat())):
-        print("%s won the toss and elected to bat" % (TB.name,))
+        commentary.event('toss', team=TB, bat=True)
         return TB, TA
-    print("%s won the toss and elected to field" % (TB.name,))
+    commentary.event('toss', team=TB, bat=False)
     return TA, TB
 
-def play_match(TA, TB):
-    TA, TB = yield from toss(TA, TB)
-    IA = Innings(TA, TB)
+def play_match(TA, TB, compact=False, commentary=CONSOLE):
+    for p in TA.players + TB.players:
+        p.commentary = commentary
+    TA, TB = yield from toss(TA, TB, commentary)
+    yield from commentary.drain()
+    IA = Innings(TA, TB, compact=compact, commentary=commentary)
     yield from IA.start()
     while IA.in_play:
         yield from IA.bowl()
-    print()
-    IA.batting_summary()
-    IA.bowling_summary()
-    print()
-    IB = Innings(TB, TA, IA.total)
+        yield from commentary.drain()
+    commentary.event('innings', inns=IA)
+    yield from commentary.drain()
+    IB = Innings(TB, TA, IA.total, compact=compact, commentary=commentary)
     yield from IB.start()
     while IB.in_play:
         yield from IB.bowl()
-    print()
-    IB.batting_summary()
-    IB.bowling_summary()
-    print()
+        yield from commentary.drain()
+    commentary.event('innings', inns=IB)
+    yield from commentary.drain()
     if IA.total > IB.total:
-        print("%s beat %s by %d runs" % (TA.name, TB.name, IA.total - IB.total))
+        commentary.event('result', teams=(TA, TB), winner=TA, runs=IA.total - IB.total)
     elif IB.total > IA.total:
-        print("%s beat %s by %d wickets" % (TB.name, TA.name, 1 + len(IB.border)))
+        commentary.event('result', teams=(TA, TB), winner=TB, wickets=10 - len(IB.fow))
     else:
-        print("%s and %s tied" % (TA.name, TB.name))
+        commentary.event('result', teams=(TA, TB), winner=None)
+    yield from commentary.drain()
+    return IA, IB
+
+def match_events(TA, TB, compact=False, kinds=None):
+    """Play a match, yielding its events (see commentary.py) as they happen.
+
+    With local players this is a plain generator of coroutine.Event, one
+    ball at a time.  If any player waits for input it also yields their
+    WaitingFor; run it with Reactor(on_event=...) in that case.  Returns
+    (IA, IB) like play_match."""
+    return play_match(TA, TB, compact, StreamCommentary(kinds))
 
 def test():
     """Test-run: play a match between two placeholder teams"""
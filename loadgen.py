@@ -0,0 +1,276 @@
+#!/usr/bin/python3
+"""
+Load generator for the game server.
+
+Each worker process opens pairs of scripted clients (client.Connection)
+and has each pair play whole games against each other: one invites the
+other as soon as both are in the lobby, each claims ten more players, and
+every action request is answered at once.  It all runs in one selector
+loop per process (or, with --asyncio, as aclient.Connections on one event
+loop), so a few processes can drive thousands of clients.
+
+Reported are the rate at which connections were set up (connect, welcome
+and hello), the rate at which messages were received and sent, and the
+latency from a client answering an action request to the next action
+request in its game: how long the server takes to turn a game round.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import resource
+import selectors
+import time
+
+import aclient
+import client
+
+# Player names claimed by each captain, as '<username>_<n>'
+CLAIMS = range(2, 12)
+
+class Stats(object):
+    """Counts and latencies for a batch of clients, mergeable across
+    workers"""
+    def __init__(self):
+        self.connections = 0
+        self.connect_time = 0.0 # seconds spent setting them up
+        self.received = 0
+        self.sent = 0
+        self.games = 0
+        self.unfinished = 0
+        self.errors = 0
+        self.first_errors = []
+        self.latencies = []
+        self.elapsed = 0.0
+    def merge(self, other):
+        self.connections += other.connections
+        self.connect_time = max(self.connect_time, other.connect_time)
+        self.received += other.received
+        self.sent += other.sent
+        self.games += other.games
+        self.unfinished += other.unfinished
+        self.errors += other.errors
+        self.first_errors.extend(other.first_errors[:5 - len(self.first_errors)])
+        self.latencies.extend(other.latencies)
+        self.elapsed = max(self.elapsed, other.elapsed)
+    def percentile(self, lats, q):
+        return lats[min(int(q * len(lats)), len(lats) - 1)] if lats else 0.0
+    def __str__(self):
+        lats = sorted(self.latencies)
+        lines = ["%d connections in %.3fs (%.0f/s)" % (self.connections, self.connect_time, self.connections / self.connect_time if self.connect_time else 0)]
+        lines.append("%d games finished, %d not, in %.3fs (%.1f games/s)" % (self.games, self.unfinished, self.elapsed, self.games / self.elapsed if self.elapsed else 0))
+        lines.append("%d messages received (%.0f/s), %d sent (%.0f/s)" % (self.received, self.received / self.elapsed if self.elapsed else 0,
+                                                                     self.sent, self.sent / self.elapsed if self.elapsed else 0))
+        lines.append("Action latency over %d requests: p50 %.2fms, p99 %.2fms, max %.2fms" % (len(lats), 1000 * self.percentile(lats, 0.5),
+                                                                                             1000 * self.percentile(lats, 0.99), 1000 * (lats[-1] if lats else 0)))
+        lines.append("%d errors" % (self.errors,))
+        lines.extend("  %s" % (e,) for e in self.first_errors)
+        return '\n'.join(lines)
+
+class Pair(object):
+    """Two clients playing games against each other"""
+    def __init__(self, stats, games, bots=None, delegate=False):
+        self.stats = stats
+        self.games = games # left to play
+        self.bots = bots
+        self.delegate = delegate
+        self.inviter = None
+        self.invitee = None
+        self.playing = False
+        # When an action request in the current game was last answered
+        self.answered = None
+    def maybe_invite(self):
+        a, b = self.inviter, self.invitee
+        if not self.playing and self.games and b is not None and b.username in a.room:
+            self.playing = True
+            a.invite_game(b.username)
+    def claim(self, bot):
+        for i in CLAIMS:
+            bot.claim_player('%s_%d' % (bot.username, i), self.bots)
+    def finished(self, bot):
+        if bot is self.inviter:
+            self.stats.games += 1
+            self.games -= 1
+            self.playing = False
+            self.answered = None
+            if not self.games:
+                self.inviter.goodbye()
+                self.invitee.goodbye()
+
+class Script(object):
+    """How a scripted client, half of a Pair, plays: mixed in to a
+    client.Session"""
+    def __init__(self, pair, **kwargs):
+        self.pair = pair
+        self.keeper = None
+        super(Script, self).__init__(**kwargs)
+    def write_msg(self, d):
+        self.pair.stats.sent += 1
+        super(Script, self).write_msg(d)
+    def handle(self, msg):
+        pair = self.pair
+        pair.stats.received += 1
+        typ = msg.get('type')
+        if typ == 'action':
+            if pair.answered is not None:
+                pair.stats.latencies.append(time.perf_counter() - pair.answered)
+            self.act(msg)
+            pair.answered = time.perf_counter()
+        elif typ in ('enter', 'roster', 'exit', 'invite', 'accept'):
+            super(Script, self).handle(msg)
+            if self is pair.inviter:
+                pair.maybe_invite()
+        elif typ == 'match':
+            pair.finished(self)
+        elif typ == 'error':
+            pair.stats.errors += 1
+            if len(pair.stats.first_errors) < 5:
+                pair.stats.first_errors.append("%s: %s" % (self.username, msg.get('message')))
+    def handle_invite_new(self, frm):
+        if frm == self.pair.inviter.username:
+            self.accept_game(frm)
+            self.pair.claim(self)
+    def handle_accept_new(self, frm):
+        self.pair.claim(self)
+    def act(self, msg):
+        a = msg['action']
+        if a in ('roll', 'flip coin'):
+            # Delegating as asked, which covers this request too
+            if self.pair.delegate:
+                self.delegate('innings', msg.get('player'))
+            else:
+                self.roll_dice() if a == 'roll' else self.flip_coin()
+        elif a == 'call toss':
+            self.call_heads()
+        elif a == 'choose first':
+            self.choose_bat_first()
+        elif a == 'choose keeper':
+            self.keeper = msg['legal'][-1]
+            self.choose_keeper(self.keeper)
+        elif a == 'next bat':
+            self.choose_batsman(msg['legal'][0])
+        elif a == 'choose bowler':
+            self.choose_bowler([p for p in msg['legal'] if p != self.keeper][0])
+        elif a == 'field assign':
+            self.field_done()
+
+class Bot(Script, client.Connection):
+    """A scripted client on a blocking socket, read from a selector"""
+    def __init__(self, pair, sel, **kwargs):
+        self.sel = sel
+        super(Bot, self).__init__(pair, **kwargs)
+        sel.register(self.sock, selectors.EVENT_READ, self)
+    def goodbye(self, msg=None):
+        if self.sock is not None:
+            self.sel.unregister(self.sock)
+        super(Bot, self).goodbye(msg)
+
+class AsyncBot(Script, aclient.Connection):
+    """A scripted client on an asyncio stream"""
+
+def run_worker(job):
+    """Play job's games, returning their Stats"""
+    index, pairs, opts = job
+    # A socket per client, and the server's too if it's local
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    stats = Stats()
+    if opts['asyncio']:
+        asyncio.run(play(index, pairs, opts, stats))
+        return stats
+    sel = selectors.DefaultSelector()
+    extensions = opts['extensions']
+    everyone = []
+    start = time.perf_counter()
+    deadline = start + opts['timeout']
+    opened = 0
+    while time.perf_counter() < deadline:
+        # Open the pairs due by now, spread over the ramp
+        now = time.perf_counter()
+        due = pairs if not opts['ramp'] else min(pairs, int(pairs * (now - start) / opts['ramp']) + 1)
+        if opened < due:
+            t = time.perf_counter()
+            for i in range(opened, due):
+                pair = Pair(stats, opts['games'], opts['bots'], opts['delegate'])
+                for role in ('inviter', 'invitee'):
+                    bot = Bot(pair, sel, host=opts['host'], port=opts['port'], username='lg%d_%d%s' % (index, i, role[-1]), extensions=extensions)
+                    setattr(pair, role, bot)
+                    everyone.append(bot)
+                stats.connections += 2
+            stats.connect_time += time.perf_counter() - t
+            opened = due
+        elif opened == pairs and not sel.get_map():
+            break
+        for key, mask in sel.select(0.01 if opened < pairs else 1.0):
+            bot = key.data
+            if bot.sock is None: # said goodbye while handling another
+                continue
+            try:
+                bot.recv()
+            except (client.SocketClosed, OSError):
+                sel.unregister(key.fileobj)
+                continue
+            while bot.sock is not None:
+                msg = bot.next_msg()
+                if msg is None:
+                    break
+                bot.handle(msg)
+    stats.elapsed = time.perf_counter() - start
+    for bot in everyone:
+        if bot is bot.pair.inviter:
+            stats.unfinished += bot.pair.games
+        bot.goodbye()
+    return stats
+
+async def play(index, pairs, opts, stats):
+    """run_worker's loop, for AsyncBots"""
+    everyone = []
+    start = time.perf_counter()
+    for i in range(pairs):
+        # Open the pairs spread over the ramp
+        if opts['ramp']:
+            await asyncio.sleep(start + opts['ramp'] * i / pairs - time.perf_counter())
+        t = time.perf_counter()
+        pair = Pair(stats, opts['games'], opts['bots'], opts['delegate'])
+        for role in ('inviter', 'invitee'):
+            bot = await AsyncBot.connect(opts['host'], opts['port'], pair, username='lg%d_%d%s' % (index, i, role[-1]), extensions=opts['extensions'])
+            setattr(pair, role, bot)
+            everyone.append(bot)
+        stats.connections += 2
+        stats.connect_time += time.perf_counter() - t
+    if everyone:
+        await asyncio.wait([bot.task for bot in everyone], timeout=start + opts['timeout'] - time.perf_counter())
+    stats.elapsed = time.perf_counter() - start
+    for bot in everyone:
+        if bot is bot.pair.inviter:
+            stats.unfinished += bot.pair.games
+        bot.goodbye()
+    await asyncio.gather(*(bot.closed() for bot in everyone), return_exceptions=True)
+
+def run(clients, procs, **opts):
+    pairs = clients // 2
+    jobs = [(i, pairs // procs + (i < pairs % procs), opts) for i in range(procs)]
+    stats = Stats()
+    with multiprocessing.Pool(procs) as pool:
+        for s in pool.imap_unordered(run_worker, jobs):
+            stats.merge(s)
+    return stats
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load generator for the Howzat game server')
+    parser.add_argument('-H', '--host', default='localhost')
+    parser.add_argument('-p', '--port', type=int, default=0x6666)
+    parser.add_argument('-c', '--clients', type=int, default=1000, help='clients in all (two per game)')
+    parser.add_argument('-j', '--procs', type=int, default=4, help='processes to run them from')
+    parser.add_argument('-g', '--games', type=int, default=1, help='games each pair of clients plays')
+    parser.add_argument('-r', '--ramp', type=float, default=0.0, help='seconds over which to open the connections')
+    parser.add_argument('-b', '--bots', choices=('deterministic', 'random'), help='have the server play the players each captain claims')
+    parser.add_argument('-d', '--delegate', action='store_true', help='delegate rolls to the server')
+    parser.add_argument('-x', '--extensions', default='', help='comma-separated protocol extensions to ask for')
+    parser.add_argument('-a', '--asyncio', action='store_true', help='run the clients on asyncio event loops (see aclient.py)')
+    parser.add_argument('-t', '--timeout', type=float, default=300.0, help='seconds after which to give up on unfinished games')
+    args = parser.parse_args()
+    extensions = [e for e in args.extensions.split(',') if e]
+    if args.delegate and 'delegate' not in extensions:
+        extensions.append('delegate')
+    print(run(args.clients, args.procs, host=args.host, port=args.port, games=args.games, ramp=args.ramp,
+              bots=args.bots, delegate=args.delegate, extensions=extensions, asyncio=args.asyncio, timeout=args.timeout))
@@ -0,0 +1,120 @@
+"""
+Counters and latency histograms for the game server.
+
+With metrics on (server.py --metrics), the server keeps:
+    handled     {type: Histogram}   time spent in each handle_* method
+    actions     {method: Histogram} from a RemotePlayer method asking its
+                                    client for an action to the reply
+                                    (timeouts are counted, not timed)
+    tick        Histogram           Server.tick's work, after select()
+    counters    {name: int}         bytes in and out, action timeouts, ...
+and samples gauges (clients, games, pending action requests, queued bytes)
+from the server when asked for a snapshot: by /metrics on the console, or
+by connecting to the Unix socket given by --metrics-socket, which sends a
+snapshot as one line of JSON and closes.
+
+Each observation costs a bucket increment and a comparison; the clock
+reads around it are most of the overhead.  With metrics off, the server
+has a NullMetrics, whose histograms ignore what they're given.
+"""
+import collections
+import math
+
+# Each power of two microseconds is split into SPLIT buckets, so that the
+# top of a value's bucket is at most a fifth or so above it; the last
+# bucket also counts anything longer, from about 36 minutes
+SPLIT = 4
+BUCKETS = 32 * SPLIT
+
+def bucket(us):
+    m, e = math.frexp(us) # us = m * 2**e, with m in [0.5, 1)
+    i = e * SPLIT + int(m * 2 * SPLIT) - SPLIT
+    return 0 if i < 0 else i if i < BUCKETS else BUCKETS - 1
+
+def top(i):
+    """The upper bound of bucket i, in microseconds"""
+    e, sub = divmod(i, SPLIT)
+    return (SPLIT + sub + 1) * 2.0 ** e / (2 * SPLIT)
+
+class Histogram(object):
+    __slots__ = ('counts', 'total', 'max')
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.total = 0.0
+        self.max = 0.0
+    def observe(self, seconds):
+        self.counts[bucket(seconds * 1e6)] += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+    def count(self):
+        return sum(self.counts)
+    def percentile(self, q):
+        """An upper bound on the q-quantile, in seconds: the top of its
+        bucket, or the maximum if that's lower"""
+        rank = q * self.count()
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return min(top(i) / 1e6, self.max)
+        return 0.0
+    def snapshot(self):
+        n = self.count()
+        return {'count': n, 'mean': self.total / n if n else 0.0, 'max': self.max,
+                'p50': self.percentile(0.5), 'p90': self.percentile(0.9), 'p99': self.percentile(0.99),
+                # upper bound in microseconds: count
+                'buckets': dict((top(i), n) for i, n in enumerate(self.counts) if n)}
+
+class NullHistogram(object):
+    def observe(self, seconds):
+        pass
+
+class NullTable(object):
+    """Stands in for a table of Histograms"""
+    def __init__(self):
+        self.null = NullHistogram()
+    def __getitem__(self, key):
+        return self.null
+
+class NullMetrics(object):
+    def __init__(self):
+        self.handled = self.actions = NullTable()
+        self.tick = NullHistogram()
+    def count(self, name, n=1):
+        pass
+    def reset(self):
+        pass
+    def snapshot(self, gauges):
+        return {'gauges': gauges}
+    def report(self, gauges):
+        return "Metrics are off; run the server with --metrics\n" + format_gauges(gauges)
+
+class Metrics(NullMetrics):
+    def __init__(self):
+        self.reset()
+    def reset(self):
+        self.handled = collections.defaultdict(Histogram)
+        self.actions = collections.defaultdict(Histogram)
+        self.tick = Histogram()
+        self.counters = collections.Counter()
+    def count(self, name, n=1):
+        self.counters[name] += n
+    def snapshot(self, gauges):
+        return {'gauges': gauges, 'counters': dict(self.counters),
+                'tick': self.tick.snapshot(),
+                'handled': dict((k, h.snapshot()) for k, h in self.handled.items()),
+                'actions': dict((k, h.snapshot()) for k, h in self.actions.items())}
+    def report(self, gauges):
+        lines = ["%-24s %9s %9s %9s %9s %9s" % ('(ms)', 'count', 'p50', 'p90', 'p99', 'max')]
+        rows = [('tick', self.tick)]
+        rows.extend(('handle ' + k, h) for k, h in sorted(self.handled.items()))
+        rows.extend(('action ' + k, h) for k, h in sorted(self.actions.items()))
+        for name, h in rows:
+            lines.append("%-24s %9d %9.3f %9.3f %9.3f %9.3f" % (name, h.count(), 1000 * h.percentile(0.5), 1000 * h.percentile(0.9),
+                                                               1000 * h.percentile(0.99), 1000 * h.max))
+        lines.extend("%-24s %9d" % kv for kv in sorted(self.counters.items()))
+        return '\n'.join(lines) + '\n' + format_gauges(gauges)
+
+def format_gauges(gauges):
+    return '\n'.join("%-24s %9d" % kv for kv in sorted(gauges.items()))
@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+"""
+Multi-core Monte Carlo match runner.
+
+Spreads a batch of simulated matches (see simulate.py) over a process
+pool.  Every match reseeds its players from the batch seed and its own
+index, so a batch gives the same results whatever the number of workers
+or the order in which they finish.
+"""
+import argparse
+import collections
+import multiprocessing
+import os
+import time
+
+import howzat
+import simulate
+
+TEAM_KINDS = {'det': howzat.Team.det, 'rand': howzat.Team.rand}
+
+class Tally(object):
+    """Running totals for a batch of matches, mergeable across workers"""
+    def __init__(self, names):
+        self.names = names
+        self.matches = 0
+        self.wins = dict((n, 0) for n in names)
+        self.ties = 0
+        # Score distributions, batting first and second
+        self.first = collections.Counter()
+        self.second = collections.Counter()
+    def add(self, result):
+        self.matches += 1
+        if result.tied:
+            self.ties += 1
+        else:
+            self.wins[result.winner.name] += 1
+        self.first[result.first.total] += 1
+        self.second[result.second.total] += 1
+    def merge(self, other):
+        self.matches += other.matches
+        for n, w in other.wins.items():
+            self.wins[n] += w
+        self.ties += other.ties
+        self.first.update(other.first)
+        self.second.update(other.second)
+    @staticmethod
+    def mean(dist):
+        n = sum(dist.values())
+        return sum(k * v for k, v in dist.items()) / n if n else 0.0
+    def __str__(self):
+        lines = ["%s won %d (%.2f%%)" % (n, w, 100.0 * w / self.matches if self.matches else 0)
+                 for n, w in self.wins.items()]
+        lines.append("Tied %d" % (self.ties,))
+        lines.append("Average scores: batting first %.1f, batting second %.1f" % (self.mean(self.first), self.mean(self.second)))
+        return '\n'.join(lines)
+
+def make_teams(kind, names, seed, i):
+    """Build the teams for match i of the batch with the given seed"""
+    TA, TB = [TEAM_KINDS[kind](n) for n in names]
+    # Team.rand names every team "Randoms"
+    TA.name, TB.name = names
+    for p in TA.players + TB.players:
+        p.rng.seed("%s/%d/%s" % (seed, i, p.name))
+    return TA, TB
+
+def run_chunk(job):
+    kind, names, seed, start, stop = job
+    tally = Tally(names)
+    for i in range(start, stop):
+        tally.add(simulate.simulate_match(*make_teams(kind, names, seed, i)))
+    return tally
+
+def run(n, kind='rand', names=('TA', 'TB'), seed=None, workers=None, chunk=200):
+    """Simulate n matches across a pool of workers, returning (seed, Tally)"""
+    if seed is None:
+        seed = int.from_bytes(os.urandom(8), 'big')
+    names = tuple(names)
+    jobs = [(kind, names, seed, i, min(i + chunk, n)) for i in range(0, n, chunk)]
+    tally = Tally(names)
+    with multiprocessing.Pool(workers) as pool:
+        for t in pool.imap_unordered(run_chunk, jobs):
+            tally.merge(t)
+    return seed, tally
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Monte Carlo Howzat match runner')
+    parser.add_argument('-n', '--matches', type=int, default=10000)
+    parser.add_argument('-j', '--workers', type=int, default=None, help='worker processes (default: one per core)')
+    parser.add_argument('-s', '--seed', type=int, default=None)
+    parser.add_argument('-k', '--kind', choices=sorted(TEAM_KINDS), default='rand', help='captaincy of both teams')
+    parser.add_argument('--chunk', type=int, default=200, help='matches per job')
+    parser.add_argument('team_a', nargs='?', default='TA')
+    parser.add_argument('team_b', nargs='?', default='TB')
+    args = parser.parse_args()
+    start = time.time()
+    seed, tally = run(args.matches, args.kind, (args.team_a, args.team_b), args.seed, args.workers, args.chunk)
+    elapsed = time.time() - start
+    print("Seed %d" % (seed,))
+    print(tally)
+    print("Simulated %d matches in %.3fs (%.0f matches/s)" % (tally.matches, elapsed, tally.matches / elapsed if elapsed else 0))
@@ -0,0 +1,123 @@
+#!/usr/bin/python3
+"""
+Live win probability for a chasing side.
+
+WinOracle answers from a table of P(chase succeeds) keyed on (runs
+needed, legal balls left, wickets left), built lazily one balls-left
+layer at a time from analytic.py's exact delivery outcomes.  A lookup is
+a couple of index operations, cheap enough to make after every ball of
+Innings.bowl.  The table can be saved to and loaded from disk.
+"""
+import argparse
+import array
+import pickle
+
+import analytic
+
+class WinOracle(object):
+    """Table of chase success probabilities.
+
+    Memory is bounded by max_runs: each layer holds 11 * (max_runs + 1)
+    doubles, and there are at most balls + 1 layers.  Chases needing more
+    than max_runs are treated as hopeless; asking about more balls or
+    wickets than the table covers is a ValueError."""
+    def __init__(self, max_runs=400, balls=analytic.MAX_OVERS * 6, wickets=10):
+        self.max_runs = max_runs
+        self.balls = balls
+        self.wickets = wickets
+        self.stride = max_runs + 1
+        # layers[b][w * stride + r]: P(scoring r more runs with b legal
+        # balls and w wickets left).  With no balls left, no chance.
+        self.layers = [array.array('d', [1.0] + [0.0] * max_runs) * (wickets + 1)]
+    def layer(self, b):
+        if b > self.balls:
+            raise ValueError("%d balls is more than the table's %d" % (b, self.balls))
+        while len(self.layers) <= b:
+            self.layers.append(self.compute(self.layers[-1]))
+        return self.layers[b]
+    def compute(self, prev):
+        nl, lg = analytic.split_outcomes()
+        stride = self.stride
+        cur = array.array('d', bytes(8 * len(prev)))
+        for w in range(self.wickets + 1):
+            base = w * stride
+            cur[base] = 1.0
+            if not w: # all out
+                continue
+            for r in range(1, stride):
+                v = 0.0
+                # Extras leave balls and wickets unchanged, but always
+                # score, so depend only on smaller r in this layer
+                for k, p in nl:
+                    v += p * (cur[base + r - k] if k < r else 1.0)
+                for k, out, p in lg:
+                    if k >= r:
+                        v += p
+                    elif out:
+                        v += p * prev[base - stride + r]
+                    else:
+                        v += p * prev[base + r - k]
+                cur[base + r] = v
+        return cur
+    def chance(self, needed, balls, wickets):
+        """P(scoring needed runs from balls legal balls and wickets wickets)"""
+        if balls > self.balls or wickets > self.wickets:
+            raise ValueError("%d balls and %d wickets is beyond the table's %d and %d" % (balls, wickets, self.balls, self.wickets))
+        if needed <= 0:
+            return 1.0
+        if needed > self.max_runs or balls <= 0 or wickets <= 0:
+            return 0.0
+        return self.layer(balls)[wickets * self.stride + needed]
+    def innings(self, inns):
+        """Return the chasing side's probability of winning from the
+        current state of a live Innings."""
+        if inns.chasing is None:
+            raise ValueError("Innings is not a chase")
+        needed = inns.chasing + 1 - inns.total
+        if not inns.in_play:
+            return 1.0 if needed <= 0 else 0.0
+        bowled = 6 * (len(inns.overs) - 1) + 6 - inns.over.to_come
+        return self.chance(needed, self.balls - bowled, self.wickets - len(inns.fow))
+    def fill(self):
+        """Compute every layer up front"""
+        self.layer(self.balls)
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump({'max_runs': self.max_runs, 'balls': self.balls,
+                         'wickets': self.wickets,
+                         'layers': [l.tobytes() for l in self.layers]}, f)
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            d = pickle.load(f)
+        o = cls(d['max_runs'], d['balls'], d['wickets'])
+        o.layers = []
+        for b in d['layers']:
+            l = array.array('d')
+            l.frombytes(b)
+            o.layers.append(l)
+        return o
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute or query a Howzat win-probability table')
+    parser.add_argument('-f', '--file', help='table file to load if present, and save')
+    parser.add_argument('needed', nargs='?', type=int)
+    parser.add_argument('balls', nargs='?', type=int, default=120)
+    parser.add_argument('wickets', nargs='?', type=int, default=10)
+    args = parser.parse_args()
+    o = None
+    if args.file:
+        try:
+            o = WinOracle.load(args.file)
+        except FileNotFoundError:
+            pass
+    if o is None:
+        o = WinOracle()
+        o.fill()
+        if args.file:
+            o.save(args.file)
+    if args.needed is not None:
+        try:
+            print("%.4f" % (o.chance(args.needed, args.balls, args.wickets),))
+        except ValueError as e:
+            parser.error(str(e))
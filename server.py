@@ -1,82 +1,186 @@
 #!/usr/bin/python3
+import argparse
+import asyncio
+import collections
+import functools
+import itertools
 import json
-import select
+import os
+import random
+import selectors
 import socket
+import stat
 import sys
+import time
+import zlib
 
 import coroutine
+import framing
+import gamelog
 import howzat
+from commentary import EventCommentary
+from metrics import Metrics, NullMetrics
 
-SERVER_VERSION = [1, 0, 0]
+SERVER_VERSION = [1, 4, 0]
 DEFAULT_MOTD = "Welcome to the Howzat server."
+RECV_SIZE = 1 << 16
+# Most a client's compressed input is inflated by at a time, and most it
+# may have received and not yet handled: room for the largest frame, and
+# for what arrives or is inflated while it's being cut
+INFLATE_STEP = RECV_SIZE
+RX_LIMIT = framing.MAX_FRAME + 2 * RECV_SIZE
+# Protocol extensions this server offers in 'welcome'
+EXTENSIONS = ('delegate', 'frames', 'zlib')
+# How far a 'delegate' may extend, and the actions it covers
+DELEGATE_SPANS = ('over', 'innings')
+TRIGGERS = ('roll', 'flip coin')
+# For delegated rolls; see RemotePlayer.trigger
+DELEGATE_RNG = random.SystemRandom()
+# Bytes queued for a client beyond which DROPPABLE broadcasts to it are
+# dropped, and beyond which it is disconnected
+TX_HIGH = 1 << 18
+TX_LIMIT = 1 << 20
+# Broadcasts a client can miss without losing track of its game
+DROPPABLE = ('wall', 'enter', 'exit')
+# Seconds allowed for clients' txqs to drain at shutdown
+HALT_DRAIN = 1.0
+# Seconds between syncs of game logs to disk
+LOG_SYNC = 1.0
+# How often timers are checked while any are pending
+TIMER_POLL = 0.1
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16 # POSIX minimum
+
+def encode(d):
+    return (json.dumps(d) + '\n').encode('utf8')
 
 class WaitForAction(coroutine.WaitingFor):
-    def __init__(self, player, *actions):
+    """Indexed by (client, player name, action), and also with a player
+    name of None, since clients needn't say which player is acting"""
+    def __init__(self, player, *actions, timeout=None):
         def match(**d):
-            return d.get('type') == 'action' and d.get('action' in actions)
-        super(WaitForAction, self).__init__(player, match)
+            return d.get('type') == 'action' and d.get('action') in actions
+        keys = [(player.client, name, a) for a in actions for name in (player.name, None)]
+        super(WaitForAction, self).__init__(player, match, keys, timeout)
 
 class RemotePlayer(howzat.Player):
-    def __init__(self, name, client):
+    def __init__(self, name, client, game):
         self.client = client
+        self.game = game
         if name is None:
             name = client.name
         super(RemotePlayer, self).__init__(name)
+        # Span for which the client has left triggering rolls to us
+        self.delegated = None
+    def absent(self):
+        """Has our client disconnected mid-game, and not yet rejoined?"""
+        return self.game.absent.get(self.client.name) is self.client
     def wait_for_action(self, *actions):
-        return WaitForAction(self, *actions)
+        # The game is paused while our client is away, so it can't time
+        # out; Game.rejoin asks again, with the timeout
+        timeout = None if self.absent() else self.game.server.action_timeout
+        return WaitForAction(self, *actions, timeout=timeout)
+    def wait(self, method, *actions):
+        """Wait for one of actions from the client, recording what the
+        match was resumed with; while the game is being replayed from its
+        log, take that from the log instead.  How long the client took is
+        timed in the server's metrics under method, the one asking."""
+        if self.game.replayed():
+            return self.game.record(None)
+        start = time.perf_counter()
+        d = yield self.wait_for_action(*actions)
+        if d is coroutine.TIMED_OUT:
+            self.game.server.metrics.count('action timeouts')
+        elif d is not None:
+            self.game.server.metrics.actions[method].observe(time.perf_counter() - start)
+        return self.game.record(d)
+    def action(self, action, **d):
+        if not self.absent(): # Game.rejoin will ask again
+            self.client.action(action, player=self.name, **d)
+    def timed_out(self, action, choice, desc=None):
+        """Tell the client what was chosen for it when it took too long"""
+        if desc is None:
+            desc = choice.name
+        self.client.send('message', message="%s: timed out waiting for %r; chose %s" % (self.name, action, desc))
+        return choice
+    def trigger(self, method, action, reason, **d):
+        """Wait for the client to trigger action (or for the request to
+        time out).  Returns True if the client has delegated triggering to
+        the server, in which case nothing is sent or awaited; or if it does
+        so while we wait (see Game.delegate)."""
+        while True:
+            # A delegation (or revocation) logged since the last input must
+            # be applied before we look, on replay as it was live
+            self.game.replayed()
+            if self.delegated:
+                return True
+            self.action(action, reason=reason, **d)
+            reply = yield from self.wait(method, action)
+            if isinstance(reply, dict) and reply.get('type') == 'delegate':
+                # Delegated while we waited, which is logged as the reply
+                self.delegated = reply['span']
+                return True
+            if reply is not None:
+                return False
     def randint(self, a, b, prompt=None):
         # Should never be called, we've overridden all the methods that call it
         raise NotImplementedError()
     def flip_coin(self, prompt=None):
-        # Wait for client to trigger
-        while True:
-            self.client.action('flip coin', reason=prompt if prompt else "Flip coin")
-            if (yield self.wait_for_action('flip coin')) is not None:
-                break
-        # Two-part millisecond wheel
-        t = time.time() % 0.001
-        r = bool(int((t * 2000.0) % 2))
-        print("%s flipped %s" % (self.name, "tails" if r else "heads"))
+        if (yield from self.trigger('flip_coin', 'flip coin', prompt if prompt else "Flip coin")):
+            # Back-to-back delegated rolls would read the millisecond
+            # wheels at almost the same phase, so use a proper RNG
+            r = bool(DELEGATE_RNG.getrandbits(1))
+        else:
+            # Two-part millisecond wheel
+            t = time.time() % 0.001
+            r = bool(int((t * 2000.0) % 2))
+        r = self.game.record(r)
+        self.commentary.event('flip', player=self, tails=r)
         return r
     def roll_d6(self, prompt=None):
-        # Wait for client to trigger
-        while True:
-            self.client.action('roll', dice=1, reason=prompt if prompt else "Roll")
-            if (yield self.wait_for_action('roll')) is not None:
-                break
-        # Six-part millisecond wheel
-        t = time.time() % 0.001
-        r = (int(t * 6000.0) % 6) + 1
-        print("%s rolled d6 %s" % (self.name, chr(0x267f + r)))
+        if (yield from self.trigger('roll_d6', 'roll', prompt if prompt else "Roll", dice=1)):
+            r = DELEGATE_RNG.randint(1, 6)
+        else:
+            # Six-part millisecond wheel
+            t = time.time() % 0.001
+            r = (int(t * 6000.0) % 6) + 1
+        r = self.game.record(r)
+        self.commentary.event('roll', player=self, dice=[r])
         return r
     def roll_2d6(self, prompt=None):
-        # Wait for client to trigger
-        while True:
-            self.client.action('roll', dice=2, reason=prompt if prompt else "Roll")
-            if (yield self.wait_for_action('roll')) is not None:
-                break
-        # Thirty-six-part millisecond wheel
-        t = time.time() % 0.001
-        a = (int(t * 6000.0) % 6) + 1
-        b = (int(t * 36000.0) % 6) + 1
+        if (yield from self.trigger('roll_2d6', 'roll', prompt if prompt else "Roll", dice=2)):
+            a = DELEGATE_RNG.randint(1, 6)
+            b = DELEGATE_RNG.randint(1, 6)
+        else:
+            # Thirty-six-part millisecond wheel
+            t = time.time() % 0.001
+            a = (int(t * 6000.0) % 6) + 1
+            b = (int(t * 36000.0) % 6) + 1
+        a, b = self.game.record([a, b])
         r = a + b
-        print("%s rolled 2d6 %s%s -> %d" % (self.name, chr(0x267f + a), chr(0x267f + b), r))
+        self.commentary.event('roll', player=self, dice=[a, b])
         return r
     def call_toss(self):
         while True:
-            self.client.action('call toss')
-            d = yield self.wait_for_action('call toss')
+            self.action('call toss')
+            d = yield from self.wait('call_toss', 'call toss')
             if d is None: # reconnected
                 continue
+            if d is coroutine.TIMED_OUT:
+                return self.timed_out('call toss', False, 'heads')
             if isinstance(d.get('tails'), bool):
                 return d['tails']
             self.client.error("'call toss' requires 'tails': bool")
     def choose_to_bat(self):
         while True:
-            self.client.action('choose first')
-            d = yield self.wait_for_action('choose first')
+            self.action('choose first')
+            d = yield from self.wait('choose_to_bat', 'choose first')
             if d is None: # reconnected
                 continue
+            if d is coroutine.TIMED_OUT:
+                return self.timed_out('choose first', True, 'to bat')
             if isinstance(d.get('bat'), bool):
                 return d['bat']
             self.client.error("'choose first' requires 'bat': bool")
@@ -85,11 +189,14 @@ class RemotePlayer(howzat.Player):
         legal = inns.legal_bowlers()
         legal_names = dict((p.name, p) for p in legal)
         keeper_names = dict((p.name, p) for p in inns.fteam.field)
+        current = {} if curr is None else {'current': curr.name}
         while True:
-            self.client.action('choose bowler', legal=legal_names.keys(), current=curr.name)
-            d = yield self.wait_for_action('choose bowler', 'choose keeper')
+            self.action('choose bowler', legal=list(legal_names), **current)
+            d = yield from self.wait('maybe_choose_bowler', 'choose bowler', 'choose keeper')
             if d is None: # reconnected
                 continue
+            if d is coroutine.TIMED_OUT:
+                return self.timed_out('choose bowler', [p for p in legal if not p.keeper][0])
             if d['action'] == 'choose keeper':
                 if d.get('keeper') in keeper_names:
                     inns.choose_keeper(keeper_names[d['keeper']])
@@ -106,37 +213,92 @@ class RemotePlayer(howzat.Player):
     def choose_keeper(self, legal):
         legal_names = dict((p.name, p) for p in legal)
         while True:
-            self.client.action('choose keeper', legal=legal_names.keys())
-            d = yield self.wait_for_action('choose keeper')
+            self.action('choose keeper', legal=list(legal_names))
+            d = yield from self.wait('choose_keeper', 'choose keeper')
             if d is None: # reconnected
                 continue
+            if d is coroutine.TIMED_OUT:
+                return self.timed_out('choose keeper', legal[-1])
             if d.get('keeper') in legal_names:
                 return legal_names[d['keeper']]
             self.client.error("'choose keeper' requires a 'keeper' from legal list")
     def choose_batsman(self, legal):
         legal_names = dict((p.name, p) for p in legal)
         while True:
-            self.client.action('next bat', legal=legal_names.keys())
-            d = yield self.wait_for_action('next bat')
+            self.action('next bat', legal=list(legal_names))
+            d = yield from self.wait('choose_batsman', 'next bat')
             if d is None: # reconnected
                 continue
+            if d is coroutine.TIMED_OUT:
+                return self.timed_out('next bat', legal[0])
             if d.get('batsman') in legal_names:
                 return legal_names[d['batsman']]
             self.client.error("'next bat' requires a 'batsman' from legal list")
 
+class Bot(object):
+    """A player the server plays itself, within its match's thread: it
+    rolls as soon as asked, with nothing sent or awaited.  Its dice come
+    from its own RNG, seeded so that replaying the game's log (see
+    Game.restore) rolls them again.  Bots are never captains, so never
+    have decisions to make."""
+    client = None
+    delegated = None
+    seed = None
+
+class DeterministicBot(Bot, howzat.DeterministicPlayer):
+    kind = 'deterministic'
+
+class RandomBot(Bot, howzat.RandomPlayer):
+    kind = 'random'
+    def __init__(self, name, seed=None):
+        super(RandomBot, self).__init__(name)
+        if seed is None:
+            seed = DELEGATE_RNG.getrandbits(64)
+        self.seed = seed
+        self.rng = random.Random(seed)
+
+# For 'assign' and 'claim'; see Game.assign
+BOTS = {'deterministic': DeterministicBot, 'random': RandomBot}
+
 class SocketClosed(Exception): pass
 
 class Client(object):
-    def __init__(self, sock, server, debug=False):
+    def __init__(self, sock, server, debug=False, greet=True):
         self.sock = sock
         self.server = server
         self.dbg = debug
-        self.rxbuf = b''
-        self.txbuf = b''
+        # Received bytes; lines are cut from the front as they are parsed,
+        # and rxscan is how far we've already looked for a newline
+        self.rxbuf = bytearray()
+        self.rxscan = 0
+        # Encoded messages awaiting send, possibly shared with other
+        # clients' queues; the first may be a memoryview of the unsent
+        # tail of a message
+        self.txq = collections.deque()
+        self.txbytes = 0 # queued in txq
+        self.txsent = 0
+        self.txdropped = 0 # messages
+        self.rxbytes = 0
         self.name = sock.fileno()
         self.playername = None
         self.room = None
-        self.send('welcome', version=SERVER_VERSION, message=self.server.motd)
+        self.extensions = set() # agreed in 'hello'
+        self.agreed = False
+        # Per the extensions: length-prefixed frames (see framing.py)
+        # rather than lines, with the strings interned for them (codec),
+        # and zlib streams each way
+        self.frames = False
+        self.codec = None
+        self.deflate = None
+        self.inflate = None
+        self.deflating = False # deflate holds data not yet flushed
+        self.watching = False # for EVENT_WRITE
+        sock.setblocking(False)
+        server.register(self)
+        server.watch_idle(self)
+        # Not if it was greeted by another process (see shard.py)
+        if greet:
+            self.send('welcome', version=SERVER_VERSION, message=self.server.motd, extensions=list(self.server.extensions))
         self.in_invites = {'new': set(), 'game': set()}
     def debug(self, cls, *args):
         if self.dbg:
@@ -146,40 +308,222 @@ class Client(object):
     def debug_tx(self, *args):
         self.debug('tx', *args)
     def maybe_read_msg(self):
-        data = self.sock.recv(256)
-        if not len(data):
+        # One large read into the server's scratch buffer
+        view = self.server.rxview
+        n = self.sock.recv_into(view)
+        if not n:
             raise SocketClosed('End-of-file condition on socket')
-        self.rxbuf += data
+        self.rxbytes += n
+        self.server.metrics.count('bytes in', n)
+        self.feed(view[:n])
+        self.last_rx = self.server.timers.now
+    def feed(self, data):
+        """Add data received to rxbuf.  Raises ValueError if the client has
+        sent more than RX_LIMIT without our being able to handle it, or
+        garbled its zlib stream."""
+        if self.inflate is not None:
+            self.inflate_more(data)
+        else:
+            self.rxbuf += data
+            self.check_rx()
+    def inflate_more(self, data=b''):
+        """Inflate data, after any left over from last time, by no more
+        than INFLATE_STEP; what's left waits in the inflater, for rx()"""
+        tail = self.inflate.unconsumed_tail
+        try:
+            self.rxbuf += self.inflate.decompress(tail + data if tail else data, INFLATE_STEP)
+        except zlib.error as e:
+            self.error("Bad zlib stream: %s" % e)
+            raise ValueError("Bad zlib stream from %s: %s" % (self.name, e))
+        self.check_rx()
+    def check_rx(self):
+        if len(self.rxbuf) > RX_LIMIT:
+            self.error("More than %d bytes received without a whole message" % (RX_LIMIT,))
+            raise ValueError("Receive buffer overflow for %s" % (self.name,))
+    def agree(self, extensions):
+        """Settle which extensions to use.  Framing and compression switch
+        over for everything after the 'hello' that asked for them."""
+        self.agreed = True
+        if isinstance(extensions, list):
+            self.extensions = set(self.server.extensions).intersection(extensions)
+        self.frames = 'frames' in self.extensions
+        if self.frames:
+            self.codec = framing.Codec()
+        if 'zlib' in self.extensions:
+            self.deflate = zlib.compressobj()
+            self.inflate = zlib.decompressobj()
+            # Whatever followed the 'hello' is already compressed
+            rest = bytes(self.rxbuf)
+            del self.rxbuf[:]
+            self.feed(rest)
+        self.rxscan = 0
     def rx(self):
-        if b'\n' not in self.rxbuf:
+        """Cut the next whole message from what's been received, inflating
+        more as needed; None if there isn't one"""
+        while True:
+            d = self.cut()
+            if d is not None or self.inflate is None or not self.inflate.unconsumed_tail:
+                return d
+            self.inflate_more()
+    def cut(self):
+        if self.frames:
+            try:
+                d = self.codec.next_frame(self.rxbuf)
+            except ValueError as e:
+                # No way to find the next frame
+                del self.rxbuf[:]
+                self.send('error', message="Malformed frame: %s" % e)
+                return None
+            if d is not None:
+                self.debug_rx(d)
+            return d
+        i = self.rxbuf.find(b'\n', self.rxscan)
+        if i < 0:
+            self.rxscan = len(self.rxbuf)
             return None
-        msg, _, self.rxbuf = self.rxbuf.partition(b'\n')
+        msg = bytes(self.rxbuf[:i])
+        # Deleting from the front of a bytearray doesn't move the rest
+        del self.rxbuf[:i + 1]
+        self.rxscan = 0
+        return self.parse(msg)
+    def parse(self, msg):
         try:
-            d = json.loads(msg.decode('utf8'))
+            d = json.loads(msg)
             self.debug_rx(d)
             return d
         except Exception as e:
             self.send('error', message="Malformed message: %r" % e)
             return None
-    def write_all_msg(self):
-        try:
-            while self.txbuf:
-                self.maybe_write_msg()
-        except:
-            self.txbuf = b''
     def maybe_write_msg(self):
-        if not self.txbuf:
+        if not self.txq:
+            return
+        # Gather as much of the queue as one sendmsg will take
+        try:
+            b = self.sock.sendmsg(itertools.islice(self.txq, IOV_MAX))
+        except BlockingIOError:
             return
-        b = self.sock.send(self.txbuf)
-        self.txbuf = self.txbuf[b:]
+        self.txbytes -= b
+        self.txsent += b
+        self.server.metrics.count('bytes out', b)
+        while b:
+            head = self.txq[0]
+            if b < len(head):
+                self.txq[0] = memoryview(head)[b:]
+                break
+            b -= len(head)
+            self.txq.popleft()
+        if not self.txq and self.watching:
+            self.server.watch_write(self, False)
     def send(self, typ, **d):
         msg = {'type': typ}
         msg.update(d)
         self.tx(msg)
+    def action(self, action, **d):
+        self.send('action', action=action, **d)
+    def error(self, message):
+        self.send('error', message=message)
     def tx(self, d):
         self.debug_tx(d)
-        j = json.dumps(d) + '\n'
-        self.txbuf += j.encode('utf8')
+        self.queue(self.codec.frame(d) if self.frames else encode(d))
+    def recode(self, data):
+        """data, an encoded line, as this client's framing would have it"""
+        return self.codec.frame(json.loads(data)) if self.frames else data
+    def queue(self, data, droppable=False):
+        if droppable and self.txbytes >= TX_HIGH:
+            self.txdropped += 1
+            return
+        if self.deflate is not None:
+            if not self.deflating:
+                self.deflating = True
+                self.server.dirty.add(self)
+            data = self.deflate.compress(data)
+            if not data:
+                return
+        if not self.txq:
+            self.server.dirty.add(self)
+        self.txq.append(data)
+        self.txbytes += len(data)
+        if self.txbytes > TX_LIMIT:
+            # Not now, we may be in the middle of a broadcast; flush()
+            # will disconnect it if it's still over
+            self.server.dirty.add(self)
+    def seal(self):
+        """Flush the compressor, so that the client can decompress all
+        that's queued; once per tick, rather than per message"""
+        if self.deflating:
+            self.deflating = False
+            data = self.deflate.flush(zlib.Z_SYNC_FLUSH)
+            if not self.txq:
+                self.server.dirty.add(self)
+            self.txq.append(data)
+            self.txbytes += len(data)
+    def backlog(self):
+        """Bytes queued and not yet taken by the kernel"""
+        return self.txbytes
+    def stats(self):
+        return {'queued': len(self.txq), 'bytes': self.backlog(),
+                'sent': self.txsent, 'dropped': self.txdropped, 'received': self.rxbytes}
+
+class Absentee(object):
+    """Stands in for a client which was in a game when the server stopped,
+    until it reconnects; see Game.restore"""
+    sock = None
+    frames = False
+    def __init__(self, server, name, playername=None):
+        self.server = server
+        self.name = name
+        self.playername = playername
+        self.room = None
+        self.extensions = set()
+    def send(self, typ, **d):
+        pass
+    def action(self, action, **d):
+        pass
+    def error(self, message):
+        pass
+    def debug_tx(self, *args):
+        pass
+    def recode(self, data):
+        return data
+    def queue(self, data, droppable=False):
+        pass
+
+class AsyncClient(Client):
+    """A Client on an asyncio stream, for AsyncServer"""
+    def __init__(self, reader, writer, server, debug=False):
+        self.reader = reader
+        self.writer = writer
+        super(AsyncClient, self).__init__(writer.get_extra_info('socket'), server, debug)
+    def queue(self, data, droppable=False):
+        if self.writer is None:
+            return
+        depth = self.backlog()
+        if droppable and depth >= TX_HIGH:
+            self.txdropped += 1
+            return
+        if depth + len(data) > TX_LIMIT:
+            self.server.debug('Transmit queue overflow for', self.name)
+            self.server.overflows += 1
+            # connected() will see the connection go, and drop us
+            self.writer.transport.abort()
+            return
+        if self.deflate is not None:
+            if not self.deflating:
+                self.deflating = True
+                asyncio.get_running_loop().call_soon(self.seal)
+            data = self.deflate.compress(data)
+        self.writer.write(data)
+        self.txsent += len(data)
+        self.server.metrics.count('bytes out', len(data))
+    def seal(self):
+        if self.deflating and self.writer is not None:
+            self.deflating = False
+            data = self.deflate.flush(zlib.Z_SYNC_FLUSH)
+            self.writer.write(data)
+            self.txsent += len(data)
+            self.server.metrics.count('bytes out', len(data))
+    def backlog(self):
+        return self.writer.transport.get_write_buffer_size() if self.writer is not None else 0
 
 class Room(object):
     def __init__(self, server):
@@ -187,73 +531,548 @@ class Room(object):
         self.occupants = set()
     def enter(self, c):
         c.send('enter', user=c.name)
-        for o in self.occupants:
-            o.send('enter', user=c.name)
-            c.send('enter', user=o.name)
+        # One message for the newcomer, rather than an 'enter' apiece
+        if self.occupants:
+            c.send('roster', users=[o.name for o in self.occupants])
+        self.broadcast('enter', user=c.name)
         self.occupants.add(c)
         c.room = self
     def exit(self, c):
         if c.room != self:
             raise Exception("Not in room", c.name, "tried to exit")
-        for o in self.occupants:
-            o.send('exit', user=c.name)
+        self.broadcast('exit', user=c.name)
         self.occupants.remove(c)
         c.room = None
     def __contains__(self, c):
         return c in self.occupants
     def wall(self, frm, message):
+        self.broadcast('wall', frm=frm.name, message=message)
+    def broadcast(self, typ, **d):
+        msg = {'type': typ}
+        msg.update(d)
+        self.send_all(msg)
+    def send_all(self, msg):
+        """Send msg to everyone in the room, encoding it only once for each
+        framing in use (but for each framed client, if it has a binary
+        body, as their interned strings differ).  Returns it encoded as a
+        line, if anyone wanted that, or else None."""
+        data = frame = None
+        # Never binary, so a dropped frame never interns a string
+        droppable = msg['type'] in DROPPABLE
+        binary = msg['type'] in framing.BINARY
         for client in self.occupants:
-            client.send('wall', frm=frm.name, message=message)
+            client.debug_tx(msg)
+            if client.frames:
+                if binary:
+                    client.queue(client.codec.frame(msg))
+                    continue
+                if frame is None:
+                    frame = framing.frame(msg)
+                client.queue(frame, droppable)
+            else:
+                if data is None:
+                    data = encode(msg)
+                client.queue(data, droppable)
+        return data
+
+class GameCommentary(EventCommentary):
+    """Relays a Game's match events to its room as protocol messages.
+    Teams are named after their captains' usernames."""
+    def __init__(self, game):
+        super(GameCommentary, self).__init__(self.relay)
+        self.game = game
+        self.call = None
+        self.dropped = None
+        self.innings = [] # as each begins
+    def relay(self, kind, fields):
+        method = getattr(self, 'relay_' + kind, None)
+        if method is not None:
+            method(**fields)
+    def relay_call(self, player, tails):
+        self.call = (player, tails)
+    def relay_coin(self, tails):
+        player, call = self.call
+        self.game.broadcast('toss', caller=player.client.name, call=call, coin=tails)
+    def relay_toss(self, team, bat):
+        if not bat:
+            team, = [t for t in self.game.match if t is not team]
+        self.game.broadcast('choose first', batting=team.name)
+    def relay_roll(self, player, dice):
+        self.game.broadcast('roll', player=player.name, dice=dice)
+    def relay_dropped(self, fielder):
+        self.dropped = fielder
+    def relay_over(self, inns):
+        if inns not in self.innings:
+            self.innings.append(inns)
+        if len(inns.overs) > 1:
+            self.game.end_delegations('over')
+            self.game.broadcast('over', over=len(inns.overs) - 2, total=inns.total, **{'for': len(inns.fow)})
+        self.game.broadcast('choose bowler', team=inns.fteam.name, bowler=inns.bowling.name, over=len(inns.overs) - 1)
+        if len(inns.overs) > 1:
+            self.game.checkpoint()
+    def relay_ball(self, inns, ball):
+        d = {'runs': ball.total_runs, 'bowler': ball.bowler.name, 'striker': ball.batsman.name}
+        for extra in ('nb', 'w', 'b', 'lb'):
+            if getattr(ball, extra):
+                d['extra'] = extra
+                break
+        if ball.wicket:
+            d['wicket'] = ball.wicket.how
+            if ball.wicket.how == 'caught':
+                d['catch'] = ball.wicket.who.name
+        elif self.dropped is not None:
+            d['catch'] = self.dropped.name
+        self.dropped = None
+        self.game.broadcast('ball', **d)
+        if ball.wicket:
+            # Innings.bowl hasn't recorded the wicket yet
+            self.game.broadcast('fow', out=inns.striker.name, score=inns.striker.scored,
+                                nscore=inns.non_striker.scored, over=len(inns.overs) - 1,
+                                ball=6 - inns.over.to_come, wkts=len(inns.fow) + 1,
+                                **{'not out': inns.non_striker.name})
+    def relay_innings(self, inns):
+        self.game.end_delegations('over')
+        self.game.end_delegations('innings')
+        self.game.broadcast('innings', team=inns.bteam.name, over=len(inns.overs) - 1,
+                            ball=6 - inns.over.to_come, total=inns.total, **{'for': len(inns.fow)})
+        self.game.checkpoint()
+    def relay_result(self, teams, winner, runs=None, wickets=None):
+        if winner is None:
+            # The protocol has no tie; report it as a no-result
+            return self.game.broadcast('match', abandoned=True)
+        loser = teams[1] if winner == teams[0] else teams[0]
+        if runs is not None:
+            self.game.broadcast('match', winner=winner.name, loser=loser.name, runs=runs)
+        else:
+            self.game.broadcast('match', winner=winner.name, loser=loser.name, wickets=wickets)
 
 class Game(Room):
+    # Room traffic, rather than game history
+    CHATTER = ('enter', 'exit', 'wall')
     def __init__(self, server, *captains):
         super(Game, self).__init__(server)
-        self.teams = {c: set() for c in captains}
-        self.clients = set(captains)
+        self.captains = captains
+        self.teams = {c: [] for c in captains}
+        # Which team each client is on
+        self.clients = {c: c for c in captains}
+        self.match = None
+        self.reactor = None # indexes waiters, once the game has begun
+        # Players' clients which disconnected mid-match, by username
+        self.absent = {}
+        self.commentary = GameCommentary(self)
+        self.log = gamelog.NULL
+        # Logged inputs and delegations yet to be replayed, while restoring
+        self.replay = None
+        # Where the match stood at the last checkpoint, and the game
+        # messages broadcast since, for clients which rejoin
+        self.state = None
+        self.history = None
         for c in captains:
-            p = RemotePlayer(c.playername, c)
-            self.teams[c].add(p)
             self.enter(c)
-            for d in self.clients:
-                d.send('join', frm=c.name, player=p.name, team=c.name)
+        for c in captains:
+            self.add_player(c, c, c.playername)
         self.server.games.add(self)
+    def player(self, name):
+        for team in self.teams.values():
+            for p in team:
+                if p.name == name:
+                    return p
+        return None
+    def add_player(self, captain, client, name):
+        p = RemotePlayer(name, client, self)
+        self.teams[captain].append(p)
+        self.broadcast('join', frm=client.name, player=p.name, team=captain.name)
+        return p
+    def add_bot(self, captain, name, kind, seed=None):
+        p = BOTS[kind](name, seed) if seed is not None else BOTS[kind](name)
+        self.teams[captain].append(p)
+        self.broadcast('assign', player=p.name, to=None, bot=kind, team=captain.name, new=True)
+        return p
+    def assign(self, captain, client, name, bot=None):
+        """Give client player name on captain's team, adding it if need
+        be; or with bot (a kind in BOTS) rather than client, make it a
+        Bot of that kind"""
+        if self.match is not None:
+            return captain.error("Can't assign players once the game has begun")
+        team = self.teams[captain]
+        p = self.player(name)
+        if p is None:
+            if len(team) >= 11:
+                return captain.error("Team is full")
+            if bot is not None:
+                self.add_bot(captain, name, bot)
+            else:
+                team.append(RemotePlayer(name, client, self))
+                self.broadcast('assign', player=name, to=client.name, team=captain.name, new=True)
+        elif p not in team:
+            return captain.error("Player %s is on the other team" % (name,))
+        elif bot is not None:
+            if p is team[0]:
+                return captain.error("The captain's own player can't be a bot")
+            team[team.index(p)] = BOTS[bot](name)
+            self.broadcast('assign', player=name, to=None, bot=bot, team=captain.name, new=False)
+        else:
+            if p.client is None: # was a bot
+                team[team.index(p)] = RemotePlayer(name, client, self)
+            else:
+                p.client = client
+            self.broadcast('assign', player=name, to=client.name, team=captain.name, new=False)
+        if all(len(team) == 11 for team in self.teams.values()):
+            self.begin()
+    def begin(self):
+        self.log = self.server.open_log()
+        self.log.write({'log': 'begin', 'captains': [c.name for c in self.captains],
+                        'teams': dict((c.name, [self.roster_entry(p) for p in self.teams[c]]) for c in self.captains)})
+        self.start()
+    def roster_entry(self, p):
+        if p.client is None:
+            return [p.name, None, p.kind, p.seed]
+        return [p.name, p.client.name]
+    def start(self):
+        self.checkpoint()
+        self.broadcast('begin')
+        self.server.start_game(self, self.play())
+    @classmethod
+    def restore(cls, server, log, records):
+        """Rebuild a game from its log after a server restart, replaying its
+        match up to where it stopped.  All of its clients are absent until
+        they reconnect."""
+        begin = records[0]
+        absentees = {}
+        for c in begin['captains']:
+            absentees[c] = Absentee(server, c, begin['teams'][c][0][0])
+        captains = [absentees[c] for c in begin['captains']]
+        game = cls(server, *captains)
+        for c in captains:
+            for entry in begin['teams'][c.name][1:]:
+                name, client = entry[:2]
+                if client is None:
+                    game.add_bot(c, name, *entry[2:])
+                    continue
+                if client not in absentees:
+                    absentees[client] = Absentee(server, client)
+                    game.clients[absentees[client]] = c
+                game.add_player(c, absentees[client], name)
+        for a in absentees.values():
+            game.exit(a)
+            game.absent[a.name] = a
+            server.absent[a.name] = game
+        game.log = log
+        game.replay = collections.deque(r for r in records if r['log'] in ('input', 'delegate'))
+        game.start()
+        return game
+    def broadcast(self, typ, **d):
+        msg = {'type': typ}
+        msg.update(d)
+        data = self.send_all(msg)
+        if self.history is not None and typ not in self.CHATTER:
+            # History and logs keep lines, whatever the clients' framing
+            if data is None:
+                data = encode(msg)
+            self.history.append(data)
+            if self.replay is None:
+                self.log.event(data)
+    def replayed(self):
+        """Are there logged inputs left to replay?  Logged delegations
+        are applied as we reach them."""
+        while self.replay and self.replay[0]['log'] == 'delegate':
+            d = self.replay.popleft()
+            self.player(d['player']).delegated = d['span']
+        if self.replay:
+            return True
+        self.replay = None
+        return False
+    def record(self, value):
+        """The match has taken value from outside; log it, or while
+        replaying, return the logged value in its place"""
+        if self.replayed():
+            value = self.replay.popleft()['value']
+            return coroutine.TIMED_OUT if value == 'timed out' else value
+        self.log.write({'log': 'input', 'value': 'timed out' if value is coroutine.TIMED_OUT else value})
+        return value
+    def checkpoint(self):
+        self.state = self.snapshot()
+        self.history = []
+        if self.replay is None:
+            self.log.write({'log': 'checkpoint', 'state': self.state})
+    def snapshot(self):
+        """Where the match stands, as of the last completed over"""
+        teams = []
+        for c in self.captains:
+            team = self.teams[c]
+            keeper = [p.name for p in team if p.keeper]
+            teams.append({'team': c.name, 'players': [p.name for p in team],
+                          'keeper': keeper[0] if keeper else None})
+        return {'teams': teams, 'innings': [self.innings_state(inns) for inns in self.commentary.innings]}
+    def innings_state(self, inns):
+        batting = [{'player': p.name, 'scored': p.scored, 'faced': p.faced,
+                    'out': str(p.out.wicket) if p.out else None} for p in inns.border]
+        bowling = [{'player': p.name, 'balls': sum(6 - o.to_come for o in p.bowling),
+                    'maidens': p.maidens, 'conceded': p.conceded, 'wkts': p.wkts,
+                    'nb': p.nb, 'w': p.w} for p in inns.fteam.players if p.bowling]
+        return {'team': inns.bteam.name, 'total': inns.total, 'for': len(inns.fow),
+                'over': len(inns.overs) - 1, 'ball': 6 - inns.over.to_come,
+                'b': inns.b, 'lb': inns.lb, 'striker': inns.striker.name,
+                'non-striker': inns.non_striker.name, 'bowler': inns.bowling.name,
+                'batting': batting, 'bowling': bowling,
+                'fow': [{'out': bat.name, 'total': tot, 'overs': ovs} for bat, tot, ovs in inns.fow]}
+    def play(self):
+        teams = []
+        for c in self.captains:
+            players = self.teams[c]
+            keeper = yield from coroutine.maybe_gen(players[0].choose_keeper(players))
+            teams.append(howzat.Team(c.name, players, keeper=keeper))
+        self.match = teams
+        return (yield from howzat.play_match(*teams, commentary=self.commentary))
+    def delegate(self, client, players, span):
+        pending = []
+        for p in players:
+            p.delegated = span
+            client.send('delegate', player=p.name, span=span)
+            # A trigger already requested is delegated too.  That delegation
+            # is logged as the request's reply, not as a record of its own:
+            # replay applies those before each trigger (as RemotePlayer.trigger
+            # looks at delegated), and so would skip the request.
+            wfs = []
+            if span is not None and self.reactor is not None:
+                wfs = [wf for action in TRIGGERS for wf in self.reactor.lookup((client, p.name, action))
+                       if wf.player is p]
+            if not wfs:
+                self.log.write({'log': 'delegate', 'player': p.name, 'span': span})
+            pending.extend((p, wf) for wf in wfs)
+        # Last, as the match may run on to its end
+        for p, wf in pending:
+            self.server.wake(self, self.reactor.cancel(wf), {'type': 'delegate', 'player': p.name, 'span': span})
+    def end_delegations(self, span):
+        """span is over; clients must trigger their own rolls again"""
+        for team in self.teams.values():
+            for p in team:
+                if p.delegated == span:
+                    p.delegated = None
+                    p.client.send('delegate', player=p.name, span=None)
+    def controls(self, client):
+        return any(p.client is client for team in self.teams.values() for p in team)
+    def leave(self, client):
+        """client has disconnected; if it controls any players, the game
+        waits for it to reconnect"""
+        if self.reactor is not None and self.controls(client):
+            self.absent[client.name] = client
+            self.server.absent[client.name] = self
+            # Paused until it rejoins, rather than deciding for it
+            for wf in self.reactor.waiting_for(client):
+                self.reactor.disarm(wf)
+        self.exit(client)
+    def rejoin(self, client):
+        """Hand everything old client controlled to its reconnection, and
+        re-request any actions it owed"""
+        old = self.absent.pop(client.name)
+        del self.server.absent[client.name]
+        self.captains = tuple(client if c is old else c for c in self.captains)
+        self.teams = dict((client if c is old else c, team) for c, team in self.teams.items())
+        self.clients = dict((client if c is old else c, client if t is old else t) for c, t in self.clients.items())
+        for team in self.teams.values():
+            for p in team:
+                if p.client is old:
+                    p.client = client
+        self.enter(client)
+        # Catch it up from the last checkpoint
+        client.send('checkpoint', **self.state)
+        for data in self.history:
+            client.queue(client.recode(data))
+        for wf in self.reactor.waiting_for(old):
+            # RemotePlayer takes None to mean "ask again"
+            self.server.wake(self, self.reactor.cancel(wf), None)
+    def finish(self):
+        """The match is over; everyone goes back to the lobby"""
+        self.server.games.discard(self)
+        self.log.write({'log': 'end'})
+        self.server.close_log(self.log)
+        self.server.game_over(self)
+        for c in list(self.occupants):
+            self.exit(c)
+            self.server.lobby.enter(c)
 
-class Server(object):
-    def __init__(self, port=0x6666, motd=DEFAULT_MOTD, debug=0):
-        self.sock = socket.socket()
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock.bind(('localhost', port))
-        self.sock.listen(5)
+class BaseServer(object):
+    """Lobby and game logic, independent of how clients are connected"""
+    extensions = EXTENSIONS
+    def __init__(self, motd=DEFAULT_MOTD, debug=0, action_timeout=None, idle_timeout=None, log_dir=None, metrics=False, metrics_socket=None):
         self.motd = motd
         self.dbg = debug
         self.clients = {}
         self.lobby = Room(self)
         self.games = set()
+        self.absent = {} # username: Game awaiting its reconnection
+        # Seconds before an unanswered action request is decided for the
+        # client (dice rolled, defaults chosen), and before a client that
+        # has sent nothing is disconnected; None for never
+        self.action_timeout = action_timeout
+        self.idle_timeout = idle_timeout
+        # Shared by every Game's Reactor; advanced once per tick
+        self.timers = coroutine.TimerWheel(now=time.monotonic())
+        # Where each Game's log is kept; None for no logs
+        self.log_dir = log_dir
+        # Logs with records to write, and written logs yet to be synced
+        self.logs = set()
+        self.unsynced = set()
+        self.next_sync = self.timers.now + LOG_SYNC
+        # Clients disconnected for exceeding TX_LIMIT
+        self.overflows = 0
+        # Kept if asked for, or to be served on metrics_socket (a path)
+        self.metrics_socket = metrics_socket
+        self.metrics = Metrics() if metrics or metrics_socket is not None else NullMetrics()
     def debug(self, *args):
         if self.dbg:
             print(' '.join(map(str, args)))
-    def try_shutdown(self, sock):
+    def command(self, inp):
+        """Operator console command; returns True to halt the server"""
+        if inp.startswith('/halt'):
+            return True
+        if inp.startswith('/queues'):
+            print("%d clients, %d overflowed" % (len(self.clients), self.overflows))
+            for name, c in sorted(self.clients.items(), key=lambda kv: str(kv[0])):
+                print("%(name)16s %(queued)6d msgs %(bytes)9d bytes queued, %(sent)12d sent, %(received)12d received, %(dropped)6d dropped" % dict(c.stats(), name=str(name)))
+        if inp.startswith('/metrics'):
+            print(self.metrics.report(self.gauges()))
+            if inp.split()[1:] == ['reset']:
+                self.metrics.reset()
+        return False
+    def gauges(self):
+        """How things stand, for metrics snapshots"""
+        backlogs = [c.backlog() for c in self.clients.values()]
+        return {'clients': len(self.clients), 'games': len(self.games), 'absent': len(self.absent),
+                'pending actions': sum(len(g.reactor.waiting) for g in self.games if g.reactor is not None),
+                'queued bytes': sum(backlogs), 'max queued bytes': max(backlogs, default=0),
+                'overflows': self.overflows}
+    def snapshot(self):
+        """Metrics and gauges, with each client's traffic, as served on
+        metrics_socket"""
+        d = self.metrics.snapshot(self.gauges())
+        d['clients'] = dict((str(name), c.stats()) for name, c in self.clients.items())
+        return d
+    def listen_metrics(self):
+        """A Unix socket bound to metrics_socket, replacing any left by a
+        server that didn't halt cleanly"""
         try:
-            sock.shutdown(socket.SHUT_RDWR)
-        except OSError:
+            if stat.S_ISSOCK(os.stat(self.metrics_socket).st_mode):
+                os.unlink(self.metrics_socket)
+        except FileNotFoundError:
             pass
+        sock = socket.socket(socket.AF_UNIX)
+        sock.bind(self.metrics_socket)
+        sock.listen(5)
+        return sock
+    def expire(self, now):
+        for fn, arg in self.timers.advance(now):
+            fn(arg)
+    def make_reactor(self, game):
+        return coroutine.Reactor(timers=self.timers, on_timeout=lambda wf, thread: self.wake(game, thread, coroutine.TIMED_OUT))
+    def new_game(self, *captains):
+        return Game(self, *captains)
+    def game_over(self, game):
+        """game has finished; its absent clients' usernames are free"""
+        for name in game.absent:
+            del self.absent[name]
+    def taken(self, username):
+        return username in self.clients
+    def open_log(self):
+        if self.log_dir is None:
+            return gamelog.NULL
+        return gamelog.GameLog.create(os.path.join(self.log_dir, '%d.jsonl' % (time.time_ns(),)), self.logs)
+    def flush_logs(self, now):
+        """Write out what the logs have queued, and every LOG_SYNC seconds,
+        sync them to disk"""
+        for log in self.logs:
+            log.flush()
+        self.unsynced |= self.logs
+        self.logs.clear()
+        if self.unsynced and now >= self.next_sync:
+            for log in self.unsynced:
+                log.sync()
+            self.unsynced = set()
+            self.next_sync = now + LOG_SYNC
+    def close_log(self, log):
+        self.unsynced.discard(log)
+        log.close()
+    def close_logs(self):
+        """Save every game's log, as it stands, for restore_games"""
+        for game in self.games:
+            game.log.close()
+        self.logs.clear()
+        self.unsynced.clear()
+    def restore_games(self):
+        """Resume the games in log_dir which hadn't ended when the server
+        last stopped"""
+        if self.log_dir is None:
+            return
+        for name in sorted(os.listdir(self.log_dir)):
+            if name.endswith('.jsonl'):
+                self.restore_game(os.path.join(self.log_dir, name))
+    def restore_game(self, path):
+        """Resume the game logged at path, if it hadn't ended; returns the
+        Game, or None"""
+        log, records = gamelog.GameLog.recover(path, self.logs)
+        if not records or records[0]['log'] != 'begin' or records[-1]['log'] == 'end':
+            log.file.close()
+            return None
+        self.debug('Restoring game from', path)
+        try:
+            return Game.restore(self, log, records)
+        except Exception as e:
+            print("Failed to restore game from %s: %r" % (path, e))
+            return None
+    def watch_idle(self, client):
+        client.last_rx = self.timers.now
+        if self.idle_timeout is not None:
+            self.timers.add(client.last_rx + self.idle_timeout, (self.check_idle, client))
+    def check_idle(self, client):
+        if client.sock is None: # already gone
+            return
+        until = client.last_rx + self.idle_timeout
+        if until > self.timers.now:
+            self.timers.add(until, (self.check_idle, client))
+            return
+        self.debug('Idle timeout for', client.name)
+        client.error('Disconnected for inactivity')
+        self.drop(client)
+    def forget(self, client):
+        if self.clients.get(client.name) is client:
+            del self.clients[client.name]
+        if isinstance(client.room, Game):
+            client.room.leave(client)
+        elif client.room:
+            client.room.exit(client)
+    def feed_action(self, game, client, msg):
+        key = (client, msg.get('player'), msg.get('action'))
+        for wf in game.reactor.lookup(key):
+            if wf.match_fn(**msg):
+                self.wake(game, game.reactor.cancel(wf), msg)
+                return True
+        return False
     def handle(self, client, msg):
         typ = msg.get('type')
         if isinstance(typ, str):
             method = 'handle_'+typ
             if hasattr(self, method):
+                start = time.perf_counter()
                 try:
                     return getattr(self, method)(client, msg)
                 except Exception as e:
                     return print("Failed to handle message %s: %r" % (json.dumps(msg), e))
+                finally:
+                    self.metrics.handled[typ].observe(time.perf_counter() - start)
+        self.metrics.count('unhandled messages')
         print("Unhandled message type: %s %s" % (typ, json.dumps(msg)))
     def handle_hello(self, client, msg):
         if client.room:
             return client.send('error', message='Already registered')
+        # Only the first 'hello' can ask for extensions, as its reply may
+        # already be framed or compressed
+        if not client.agreed:
+            client.agree(msg.get('extensions', []))
         username = msg.get('username')
         if not isinstance(username, str):
             return client.send('error', message="Bad 'username' in 'hello'")
-        if username in self.clients:
+        if self.taken(username):
             return client.send('error', message="Username already in use")
         playername = msg.get('player')
         self.debug('Renamed', client.name, 'to', username)
@@ -263,14 +1082,12 @@ class Server(object):
         if playername is not None:
             client.playername = str(playername)
         self.clients[client.name] = client
+        if username in self.absent:
+            return self.absent[username].rejoin(client)
         self.lobby.enter(client)
     def handle_goodbye(self, client, msg):
         self.debug('Goodbye', client.name)
-        self.try_shutdown(client.sock)
-        client.sock = None
-        del self.clients[client.name]
-        if client.room:
-            client.room.exit(client)
+        self.drop(client)
     def handle_wall(self, client, msg):
         if not client.room:
             return client.send('error', message="Not in a room, can't wall")
@@ -311,15 +1128,16 @@ class Server(object):
             return client.send('error', message="No such 'to' %r in 'accept'" % (to,))
         if to not in client.in_invites.get(invitation, set()):
             return client.send('error', message="No outstanding %r invitation from %s for accept" % (invitation, to.name))
-        if invitation == 'new':
-            self.lobby.exit(client)
-            self.lobby.exit(to)
-            g = Game(self, client, to)
-        elif invitation == 'join':
+        if invitation == 'join':
             return client.send('error', message="Can't accept to 'join'; target is not in a game")
-        else: # can't happen
+        elif invitation != 'new': # can't happen
             return client.send('error', message="Bad 'accept': unhandled 'invitation' %r" % (invitation,))
+        # Before the game starts, which may take them elsewhere (see shard.py)
         to.send('accept', invitation=invitation, frm=client.name)
+        self.lobby.exit(client)
+        self.lobby.exit(to)
+        # The inviter captains the side that calls the toss
+        self.new_game(to, client)
     def handle_reject(self, client, msg):
         invitation = msg.get('invitation')
         to = self.clients.get(msg.get('to'))
@@ -329,60 +1147,400 @@ class Server(object):
             return client.send('error', message="No outstanding %r invitation from %s for reject" % (invitation, to.name))
         client.in_invites[invitation].remove(to)
         to.send('reject', invitation=invitation, frm=client.name)
+    def handle_claim(self, client, msg):
+        return self.handle_assign(client, dict(msg, to=client.name))
+    def handle_assign(self, client, msg):
+        game = client.room
+        if not isinstance(game, Game):
+            return client.error("Not in a game, can't %s" % (msg['type'],))
+        bot = msg.get('bot')
+        if bot is not None:
+            if bot not in BOTS:
+                return client.error("Bad 'bot' %r in %r" % (bot, msg['type']))
+            if client not in game.teams:
+                return client.error("Only the captain can assign players to bots")
+            to = None
+        else:
+            to = self.clients.get(msg.get('to'))
+            if game.clients.get(to) is not game.clients[client]:
+                return client.error("No such 'to' %r on your team in %r" % (msg.get('to'), msg['type']))
+            if client not in game.teams and client is not to:
+                return client.error("Only the captain can assign players")
+        player = msg.get('player')
+        if not isinstance(player, str):
+            return client.error("Bad 'player' in %r" % (msg['type'],))
+        game.assign(game.clients[client], to, player, bot)
+    def handle_delegate(self, client, msg):
+        if 'delegate' not in client.extensions:
+            return client.error("'delegate' extension was not agreed in 'hello'")
+        game = client.room
+        if not isinstance(game, Game):
+            return client.error("Not in a game, can't 'delegate'")
+        span = msg.get('span')
+        if span is not None and span not in DELEGATE_SPANS:
+            return client.error("Bad 'span' %r in 'delegate'" % (span,))
+        players = [p for team in game.teams.values() for p in team if p.client is client]
+        name = msg.get('player')
+        if name is not None:
+            players = [p for p in players if p.name == name]
+            if not players:
+                return client.error("No player %r of yours to 'delegate'" % (name,))
+        game.delegate(client, players, span)
+    def handle_action(self, client, msg):
+        game = client.room
+        if not isinstance(game, Game):
+            return client.error("Not in a game, can't 'action'")
+        if not self.feed_action(game, client, msg):
+            client.error("Action %r was not requested" % (msg.get('action'),))
+
+class Server(BaseServer):
+    def __init__(self, port=0x6666, motd=DEFAULT_MOTD, debug=0, **options):
+        """With port None, there's neither a listening socket nor a
+        console; clients are handed to us instead (see shard.py)"""
+        super(Server, self).__init__(motd, debug, **options)
+        # Each socket is registered once.  Output is written at the end of
+        # each tick, and clients are only watched for write while the
+        # kernel won't take all of their txq.  Anything else registered
+        # has a callback, called with the events
+        self.sel = selectors.DefaultSelector()
+        self.dirty = set()
+        self.rxview = memoryview(bytearray(RECV_SIZE))
+        self.sock = None
+        if port is not None:
+            self.sock = socket.socket()
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind(('localhost', port))
+            self.sock.listen(5)
+            self.sel.register(self.sock, selectors.EVENT_READ, 'accept')
+            try:
+                self.sel.register(sys.stdin, selectors.EVENT_READ, 'console')
+            except (ValueError, PermissionError):
+                pass # no console (stdin closed, or a regular file)
+        self.metrics_sock = None
+        if self.metrics_socket is not None:
+            self.metrics_sock = self.listen_metrics()
+            self.metrics_sock.setblocking(False)
+            self.sel.register(self.metrics_sock, selectors.EVENT_READ, self.serve_metrics)
+        self.restore_games()
+    def register(self, client):
+        self.sel.register(client.sock, selectors.EVENT_READ, client)
+    def serve_metrics(self, mask):
+        try:
+            conn, _ = self.metrics_sock.accept()
+        except BlockingIOError:
+            return
+        conn.setblocking(False)
+        self.sel.register(conn, selectors.EVENT_WRITE, functools.partial(self.send_metrics, conn, [encode(self.snapshot())]))
+    def send_metrics(self, conn, rest, mask):
+        """Write what conn will take of a snapshot, rest[0], closing it
+        once it's all sent"""
+        try:
+            n = conn.send(rest[0])
+        except BlockingIOError:
+            return
+        except OSError:
+            n = len(rest[0])
+        rest[0] = rest[0][n:]
+        if not rest[0]:
+            self.sel.unregister(conn)
+            conn.close()
+    def watch_write(self, client, write):
+        events = selectors.EVENT_READ
+        if write:
+            events |= selectors.EVENT_WRITE
+        self.sel.modify(client.sock, events, client)
+        client.watching = write
+    def flush(self):
+        dirty, self.dirty = self.dirty, set()
+        for c in dirty:
+            if c.sock is None:
+                continue
+            c.seal()
+            try:
+                c.maybe_write_msg()
+            except Exception as e:
+                self.debug('Lost connection to', c.name)
+                self.drop(c)
+                continue
+            if c.txbytes > TX_LIMIT:
+                self.debug('Transmit queue overflow for', c.name)
+                self.overflows += 1
+                self.drop(c)
+                continue
+            if c.txq and not c.watching:
+                self.watch_write(c, True)
+    def drain(self, deadline):
+        """Write out what we can of every client's txq until deadline,
+        without waiting on any one client"""
+        sel = selectors.DefaultSelector()
+        for c in self.clients.values():
+            c.seal()
+            sel.register(c.sock, selectors.EVENT_WRITE, c)
+        pending = len(self.clients)
+        while pending:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            for key, mask in sel.select(timeout):
+                c = key.data
+                try:
+                    c.maybe_write_msg()
+                except OSError:
+                    c.txq.clear()
+                if not c.txq:
+                    sel.unregister(c.sock)
+                    pending -= 1
+        sel.close()
+    def drop(self, client):
+        """Forget a client whose connection has gone, or is going"""
+        if client.sock is not None:
+            client.seal()
+            try:
+                client.maybe_write_msg() # any last words
+            except OSError:
+                pass
+            self.sel.unregister(client.sock)
+            self.try_shutdown(client.sock)
+            client.sock.close()
+            client.sock = None
+        self.forget(client)
+    def receive(self, c):
+        """Handle each whole message c has sent, until it goes"""
+        while c.sock is not None:
+            try:
+                msg = c.rx()
+            except ValueError as e:
+                self.debug(e)
+                self.drop(c)
+                break
+            if msg is None:
+                break
+            try:
+                self.handle(c, msg)
+            except Exception as e:
+                print(e)
+    def start_game(self, game, thread):
+        game.reactor = self.make_reactor(game)
+        self.resume(game, game.reactor.start_thread(thread))
+    def wake(self, game, thread, value):
+        self.resume(game, game.reactor.feed_value(thread, value))
+    def resume(self, game, result):
+        if not game.reactor.waiting:
+            game.finish()
+    def try_shutdown(self, sock):
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
     def halt(self):
         self.debug('Shutting down')
-        self.sock.close()
+        if self.sock is not None:
+            self.sock.close()
+        if self.metrics_sock is not None:
+            self.metrics_sock.close()
+            os.unlink(self.metrics_socket)
         for c in self.clients.values():
             self.debug('Closing', c.name)
             c.send('error', message='Server halted by operator')
-            c.write_all_msg()
+        self.drain(time.monotonic() + HALT_DRAIN)
+        for c in self.clients.values():
             self.try_shutdown(c.sock)
+        self.sel.close()
+        self.close_logs()
         self.debug('Shutdown complete')
     def tick(self, timeout=1.0):
-        cfds = tuple(client.sock.fileno() for client in self.clients.values())
-        r, w, x = select.select((sys.stdin.fileno(), self.sock.fileno()) + cfds, cfds, (), timeout)
-        if sys.stdin.fileno() in r:
-            inp = sys.stdin.readline().rstrip('\n')
-            if inp.startswith('/halt'):
-                return True
-        if self.sock.fileno() in r:
-            ns, _ = self.sock.accept()
-            c = Client(ns, self, debug=self.dbg>1)
-            self.debug('Accepted a new connection', c.name)
-            self.clients[c.name] = c
-        for c in list(self.clients.values()):
-            fd = c.sock.fileno()
-            if fd in r:
+        if self.timers.count:
+            timeout = min(timeout, TIMER_POLL)
+        events = self.sel.select(timeout)
+        start = time.perf_counter()
+        for key, mask in events:
+            c = key.data
+            if c == 'console':
+                if self.command(sys.stdin.readline().rstrip('\n')):
+                    return True
+                continue
+            if c == 'accept':
+                ns, _ = self.sock.accept()
+                # We write once per tick, so Nagle would only add delay
+                ns.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                c = Client(ns, self, debug=self.dbg>1)
+                self.debug('Accepted a new connection', c.name)
+                self.clients[c.name] = c
+                continue
+            if callable(c):
+                c(mask)
+                continue
+            if c.sock is None: # dropped earlier in this tick
+                continue
+            if mask & selectors.EVENT_READ:
                 try:
                     c.maybe_read_msg()
                 except SocketClosed:
                     self.debug('Connection closed by', c.name)
-                    del self.clients[c.name]
+                    self.drop(c)
+                except ValueError as e: # see Client.feed
+                    self.debug(e)
+                    self.drop(c)
                 except Exception as e:
                     self.debug('Lost connection to', c.name)
-                    self.try_shutdown(c.sock)
-                    del self.clients[c.name]
+                    self.drop(c)
                 else:
-                    while True:
-                        msg = c.rx()
-                        if msg is None:
-                            break
-                        try:
-                            self.handle(c, msg)
-                        except Exception as e:
-                            print(e)
+                    self.receive(c)
             if c.sock is None:
                 continue
-            if fd in w:
+            if mask & selectors.EVENT_WRITE:
                 try:
                     c.maybe_write_msg()
                 except Exception as e:
                     self.debug('Lost connection to', c.name)
-                    self.try_shutdown(c.sock)
-                    del self.clients[c.name]
+                    self.drop(c)
+        now = time.monotonic()
+        self.expire(now)
+        self.flush()
+        self.flush_logs(now)
+        self.metrics.tick.observe(time.perf_counter() - start)
 
-s = Server(debug=True)
-while True:
-    if s.tick():
-        break
-s.halt()
+class AsyncServer(BaseServer):
+    """Runs the same lobby and games on an asyncio event loop.  Each
+    client's connection is a task, as is each Game's match, which awaits
+    a future for each action it waits for."""
+    def __init__(self, port=0x6666, motd=DEFAULT_MOTD, debug=0, **options):
+        super(AsyncServer, self).__init__(motd, debug, **options)
+        self.port = port
+        self.server = None
+        self.halted = None
+        self.metrics_server = None
+        self.tasks = set()
+    def register(self, client):
+        pass
+    async def serve(self):
+        self.halted = asyncio.get_running_loop().create_future()
+        self.restore_games()
+        self.server = await asyncio.start_server(self.connected, 'localhost', self.port, reuse_address=True)
+        if self.metrics_socket is not None:
+            self.metrics_server = await asyncio.start_unix_server(self.serve_metrics, sock=self.listen_metrics())
+        try:
+            asyncio.get_running_loop().add_reader(sys.stdin, self.console)
+        except (ValueError, PermissionError):
+            pass # no console
+        clock = asyncio.get_running_loop().create_task(self.clock())
+        async with self.server:
+            await self.halted
+        clock.cancel()
+        await self.halt()
+    async def clock(self):
+        while True:
+            await asyncio.sleep(TIMER_POLL)
+            now = time.monotonic()
+            self.expire(now)
+            self.flush_logs(now)
+    def console(self):
+        if self.command(sys.stdin.readline().rstrip('\n')) and not self.halted.done():
+            self.halted.set_result(None)
+    async def serve_metrics(self, reader, writer):
+        writer.write(encode(self.snapshot()))
+        try:
+            await writer.drain()
+        except OSError:
+            pass
+        writer.close()
+    async def connected(self, reader, writer):
+        c = AsyncClient(reader, writer, self, debug=self.dbg>1)
+        self.debug('Accepted a new connection', c.name)
+        self.clients[c.name] = c
+        try:
+            while c.writer is not None:
+                data = await reader.read(RECV_SIZE)
+                c.last_rx = self.timers.now
+                if not data:
+                    self.debug('Connection closed by', c.name)
+                    break
+                c.rxbytes += len(data)
+                self.metrics.count('bytes in', len(data))
+                c.feed(data)
+                while c.writer is not None:
+                    msg = c.rx()
+                    if msg is None:
+                        break
+                    try:
+                        self.handle(c, msg)
+                    except Exception as e:
+                        print(e)
+        except ValueError as e: # see Client.feed
+            self.debug(e)
+        except OSError as e:
+            self.debug('Lost connection to', c.name)
+        finally:
+            self.drop(c)
+    def drop(self, client):
+        if client.writer is not None:
+            client.writer.close()
+            client.writer = None
+            client.sock = None
+        self.forget(client)
+    def start_game(self, game, thread):
+        # The Reactor only indexes the waiters; play() resumes the thread
+        game.reactor = self.make_reactor(game)
+        task = asyncio.get_running_loop().create_task(self.play(game, thread))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+    async def play(self, game, thread):
+        value = None
+        while True:
+            try:
+                wf = thread.send(value)
+            except StopIteration:
+                break
+            except Exception as e:
+                print("Game failed: %r" % (e,))
+                game.broadcast('match', abandoned=True)
+                break
+            future = asyncio.get_running_loop().create_future()
+            game.reactor.suspend(wf, future)
+            value = await future
+        game.finish()
+    def wake(self, game, future, value):
+        future.set_result(value)
+    async def halt(self):
+        self.debug('Shutting down')
+        self.server.close()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            try:
+                os.unlink(self.metrics_socket)
+            except FileNotFoundError:
+                pass # asyncio may have done it
+        for task in list(self.tasks):
+            task.cancel()
+        self.close_logs()
+        writers = []
+        for c in list(self.clients.values()):
+            self.debug('Closing', c.name)
+            c.error('Server halted by operator')
+            writers.append(c.writer)
+            self.drop(c)
+        if writers:
+            # Give the goodbyes a moment to get out
+            await asyncio.wait([asyncio.ensure_future(w.wait_closed()) for w in writers], timeout=1.0)
+        self.debug('Shutdown complete')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Howzat game server')
+    parser.add_argument('-p', '--port', type=int, default=0x6666)
+    parser.add_argument('-a', '--asyncio', action='store_true', help='run on an asyncio event loop')
+    parser.add_argument('-t', '--action-timeout', type=float, help='seconds to wait for a player\'s action before deciding it for them')
+    parser.add_argument('-i', '--idle-timeout', type=float, help='seconds after which a silent client is disconnected')
+    parser.add_argument('-l', '--log-dir', help='directory for game logs, from which unfinished games are resumed on restart')
+    parser.add_argument('-m', '--metrics', action='store_true', help='keep counters and latency histograms (see /metrics)')
+    parser.add_argument('-M', '--metrics-socket', help='Unix socket on which to serve metrics as JSON (implies -m)')
+    args = parser.parse_args()
+    options = {'action_timeout': args.action_timeout, 'idle_timeout': args.idle_timeout, 'log_dir': args.log_dir,
+               'metrics': args.metrics, 'metrics_socket': args.metrics_socket}
+    if args.asyncio:
+        asyncio.run(AsyncServer(port=args.port, debug=True, **options).serve())
+    else:
+        s = Server(port=args.port, debug=True, **options)
+        while True:
+            if s.tick():
+                break
+        s.halt()
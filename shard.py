@@ -0,0 +1,424 @@
+#!/usr/bin/python3
+"""
+Sharded game hosting: a lobby process, which accepts connections and runs
+the lobby, and worker processes which play the games.
+
+When an invitation is accepted, the lobby hands both captains' sockets to
+the worker with fewest games, passing them over a Unix socket (SCM_RIGHTS)
+along with what the worker needs to carry on serving them: their names,
+agreed extensions, and any bytes received but not yet handled or queued
+but not yet sent.  From then on the game, and all of its clients' traffic,
+is the worker's alone; when it finishes, the worker hands its clients
+back to the lobby in the same way.
+
+All lobby state (usernames, invitations, the lobby room and its walls)
+stays in the lobby process.  Workers tell it which usernames are still in
+use and which are absent from a game; when an absent client reconnects,
+the lobby hands its new connection to that game's worker for rejoin.
+
+Control messages between the lobby and a worker are sent as frames (see
+framing.py), with a field 'fds' giving the number of sockets passed with
+each.  From the lobby:
+    game        clients             the captains of a new game
+    rejoin      clients             an absent client reconnecting
+    restore     path                resume the game logged at path
+    halt
+From a worker:
+    home        clients             clients whose game has finished
+    absent      name                a client has left a game mid-match
+    gone        name                a client has left for good
+    over        names               a game has finished, freeing the
+                                    usernames of its absent clients
+    restored    names               the game asked for was restored, and
+                                    names are absent (or null, it wasn't)
+
+zlib compression isn't offered when sharding, as a zlib stream's state
+can't be handed to another process.
+"""
+import argparse
+import base64
+import collections
+import functools
+import os
+import selectors
+import signal
+import socket
+import sys
+import time
+import traceback
+
+import framing
+import server
+
+# Most sockets passed with one control message
+MAX_FDS = 16
+# Seconds allowed for workers to halt
+HALT_WAIT = 2.0
+
+def export(client):
+    """What another process needs to carry on serving client"""
+    return {'name': client.name, 'playername': client.playername,
+            'extensions': sorted(client.extensions), 'frames': client.frames,
+            'codec': client.codec.export() if client.codec is not None else None,
+            'rx': base64.b64encode(bytes(client.rxbuf)).decode('ascii'),
+            'tx': base64.b64encode(b''.join(client.txq)).decode('ascii')}
+
+def adopt(srv, sock, state):
+    """A Client for sock, carrying on where another process left off"""
+    c = server.Client(sock, srv, debug=srv.dbg>1, greet=False)
+    c.name = state['name']
+    c.playername = state['playername']
+    c.extensions = set(state['extensions'])
+    c.agreed = True
+    c.frames = state['frames']
+    if state['codec'] is not None:
+        c.codec = framing.Codec(**state['codec'])
+    c.rxbuf += base64.b64decode(state['rx'])
+    tx = base64.b64decode(state['tx'])
+    if tx:
+        c.queue(tx)
+    srv.clients[c.name] = c
+    return c
+
+class Link(object):
+    """One end of the control connection between the lobby and a worker.
+    on_msg is called with each message and the sockets passed with it,
+    and on_close when the other end has gone."""
+    def __init__(self, sock, on_msg, on_close):
+        self.sock = sock
+        self.on_msg = on_msg
+        self.on_close = on_close
+        self.sel = None
+        self.rxbuf = bytearray()
+        # Received fds whose messages we haven't yet parsed
+        self.fds = collections.deque()
+        # [data, socks]: the socks go with the first of data to be sent,
+        # and are closed once they have
+        self.txq = collections.deque()
+        self.watching = False
+        sock.setblocking(False)
+    def watch(self, sel):
+        self.sel = sel
+        sel.register(self.sock, selectors.EVENT_READ, self.ready)
+    def send(self, typ, socks=(), **d):
+        msg = {'type': typ, 'fds': len(socks)}
+        msg.update(d)
+        self.txq.append([framing.frame(msg), list(socks)])
+    def ready(self, mask):
+        if mask & selectors.EVENT_READ:
+            try:
+                data, fds, flags, addr = socket.recv_fds(self.sock, server.RECV_SIZE, MAX_FDS)
+            except BlockingIOError:
+                data, fds = None, []
+            except OSError:
+                data, fds = b'', []
+            self.fds.extend(fds)
+            if data == b'':
+                return self.close()
+            if data:
+                self.rxbuf += data
+                while self.sock is not None:
+                    msg = framing.next_frame(self.rxbuf)
+                    if msg is None:
+                        break
+                    socks = [socket.socket(fileno=self.fds.popleft()) for i in range(msg.pop('fds', 0))]
+                    self.on_msg(msg, socks)
+        if mask & selectors.EVENT_WRITE and self.sock is not None:
+            self.flush()
+    def flush(self):
+        while self.txq:
+            data, socks = self.txq[0]
+            try:
+                if socks:
+                    n = socket.send_fds(self.sock, [data], [s.fileno() for s in socks])
+                else:
+                    n = self.sock.send(data)
+            except BlockingIOError:
+                break
+            except OSError:
+                return self.close()
+            for s in socks:
+                s.close()
+            if n < len(data):
+                self.txq[0] = [memoryview(data)[n:], []]
+            else:
+                self.txq.popleft()
+        if self.sel is not None and bool(self.txq) != self.watching:
+            self.watching = bool(self.txq)
+            events = selectors.EVENT_READ
+            if self.watching:
+                events |= selectors.EVENT_WRITE
+            self.sel.modify(self.sock, events, self.ready)
+    def finish(self):
+        """Send all that's queued, however long it takes"""
+        if self.sock is not None:
+            self.sock.setblocking(True)
+            self.flush()
+        if self.sock is not None:
+            self.sock.setblocking(False)
+    def close(self):
+        if self.sock is None:
+            return
+        if self.sel is not None:
+            self.sel.unregister(self.sock)
+        self.sock.close()
+        self.sock = None
+        for data, socks in self.txq:
+            for s in socks:
+                s.close()
+        self.txq.clear()
+        while self.fds:
+            os.close(self.fds.popleft())
+        self.on_close()
+
+def hand_over(srv, link, typ, clients, **d):
+    """Pass clients, and their sockets, to the other end of link"""
+    states = []
+    socks = []
+    for c in clients:
+        # The less left to hand over, the better
+        try:
+            c.maybe_write_msg()
+        except OSError:
+            pass
+        srv.sel.unregister(c.sock)
+        srv.dirty.discard(c)
+        if srv.clients.get(c.name) is c:
+            del srv.clients[c.name]
+        states.append(export(c))
+        socks.append(c.sock)
+        c.sock = None
+    link.send(typ, socks, clients=states, **d)
+
+class Shard(object):
+    """The lobby's record of a worker process"""
+    def __init__(self, pid, link):
+        self.pid = pid
+        self.link = link
+        self.games = 0
+        self.restoring = 0 # games asked for and not yet answered
+
+class Remote(object):
+    """Stands in the lobby for a game on a worker, awaiting the
+    reconnection of an absent client"""
+    def __init__(self, lobby, shard):
+        self.lobby = lobby
+        self.shard = shard
+    def rejoin(self, client):
+        del self.lobby.absent[client.name]
+        self.lobby.hand_over(self.shard, 'rejoin', [client])
+
+class Lobby(server.Server):
+    """Runs the lobby, and hands games to workers forked for them"""
+    extensions = tuple(e for e in server.EXTENSIONS if e != 'zlib')
+    def __init__(self, port=0x6666, motd=server.DEFAULT_MOTD, debug=0, workers=None, **options):
+        # Usernames in use on a worker: the Shard they're on
+        self.away = {}
+        self.shards = []
+        for i in range(workers or os.cpu_count() or 1):
+            self.shards.append(self.spawn(debug, options))
+        # Forked first, so that workers don't inherit our listening socket
+        super(Lobby, self).__init__(port, motd, debug, **options)
+        for shard in self.shards:
+            shard.link.watch(self.sel)
+    def spawn(self, debug, options):
+        if options.get('metrics_socket') is not None:
+            # Each worker serves its own metrics, beside the lobby's
+            options = dict(options, metrics_socket='%s.%d' % (options['metrics_socket'], len(self.shards)))
+        ours, theirs = socket.socketpair()
+        sys.stdout.flush() # lest the child print it again
+        pid = os.fork()
+        if pid == 0:
+            ours.close()
+            for shard in self.shards:
+                shard.link.sock.close()
+            status = 1
+            try:
+                # The lobby decides when to halt
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                w = Worker(theirs, debug=debug, **options)
+                while not w.tick():
+                    pass
+                w.halt()
+                status = 0
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                os._exit(status)
+        theirs.close()
+        shard = Shard(pid, None)
+        shard.link = Link(ours, functools.partial(self.control, shard), functools.partial(self.lost, shard))
+        return shard
+    def least_loaded(self):
+        return min((s for s in self.shards if s.link.sock is not None), key=lambda s: s.games, default=None)
+    def hand_over(self, shard, typ, clients, **d):
+        for c in clients:
+            self.away[c.name] = shard
+        hand_over(self, shard.link, typ, clients, **d)
+    def new_game(self, *captains):
+        shard = self.least_loaded()
+        if shard is None:
+            return super(Lobby, self).new_game(*captains)
+        shard.games += 1
+        self.hand_over(shard, 'game', captains)
+    def restore_games(self):
+        """Have the workers restore the games, and wait until they have,
+        lest a client reconnect before its game is restored"""
+        super(Lobby, self).restore_games()
+        sel = selectors.DefaultSelector()
+        for shard in self.shards:
+            shard.link.finish()
+            if shard.link.sock is not None:
+                sel.register(shard.link.sock, selectors.EVENT_READ, shard.link)
+        while any(shard.restoring for shard in self.shards):
+            for key, mask in sel.select():
+                key.data.ready(mask)
+        sel.close()
+    def restore_game(self, path):
+        shard = self.least_loaded()
+        if shard is None:
+            return super(Lobby, self).restore_game(path)
+        # Assume it's to be restored, until we hear otherwise
+        shard.games += 1
+        shard.restoring += 1
+        shard.link.send('restore', path=path)
+    def taken(self, username):
+        return username in self.clients or (username in self.away and username not in self.absent)
+    def command(self, inp):
+        if inp.startswith('/shards'):
+            for shard in self.shards:
+                print("%8d %s %4d games" % (shard.pid, 'up' if shard.link.sock is not None else 'down', shard.games))
+            print("%d usernames on workers, %d absent" % (len(self.away), len(self.absent)))
+            return False
+        return super(Lobby, self).command(inp)
+    def control(self, shard, msg, socks):
+        method = getattr(self, 'control_' + str(msg.get('type')), None)
+        if method is None:
+            return print("Unhandled control message: %r" % (msg,))
+        method(shard, msg, socks)
+    def control_home(self, shard, msg, socks):
+        for state, sock in zip(msg['clients'], socks):
+            if self.away.get(state['name']) is shard:
+                del self.away[state['name']]
+            c = adopt(self, sock, state)
+            self.lobby.enter(c)
+            self.receive(c)
+    def control_absent(self, shard, msg, socks):
+        self.absent[msg['name']] = Remote(self, shard)
+    def control_gone(self, shard, msg, socks):
+        if self.away.get(msg['name']) is shard:
+            del self.away[msg['name']]
+            self.absent.pop(msg['name'], None)
+    def control_over(self, shard, msg, socks):
+        shard.games -= 1
+        for name in msg['names']:
+            self.control_gone(shard, {'name': name}, ())
+    def control_restored(self, shard, msg, socks):
+        shard.restoring -= 1
+        if msg['names'] is None: # it had ended
+            shard.games -= 1
+            return
+        for name in msg['names']:
+            self.away[name] = shard
+            self.control_absent(shard, {'name': name}, ())
+    def lost(self, shard):
+        """shard's worker has gone, and its games with it"""
+        print("Worker %d exited, losing %d games" % (shard.pid, shard.games))
+        os.waitpid(shard.pid, 0)
+        shard.games = 0
+        shard.restoring = 0
+        for name, s in list(self.away.items()):
+            if s is shard:
+                del self.away[name]
+                self.absent.pop(name, None)
+    def flush(self):
+        super(Lobby, self).flush()
+        for shard in self.shards:
+            if shard.link.sock is not None:
+                shard.link.flush()
+    def halt(self):
+        for shard in self.shards:
+            shard.link.send('halt')
+            shard.link.finish()
+        super(Lobby, self).halt()
+        # Workers drain their own clients; give them a moment to
+        deadline = time.monotonic() + HALT_WAIT
+        for shard in self.shards:
+            while time.monotonic() < deadline and os.waitpid(shard.pid, os.WNOHANG) == (0, 0):
+                time.sleep(0.01)
+
+class Homeward(server.Room):
+    """A worker's stand-in for the lobby: clients entering it are handed
+    back to the lobby process"""
+    def enter(self, c):
+        hand_over(self.server, self.server.link, 'home', [c])
+
+class Worker(server.Server):
+    """Plays the games the lobby hands it"""
+    def __init__(self, sock, debug=0, **options):
+        super(Worker, self).__init__(None, debug=debug, **options)
+        self.lobby = Homeward(self)
+        self.link = Link(sock, self.control, self.unlinked)
+        self.link.watch(self.sel)
+        self.halting = False
+    def restore_games(self):
+        pass # the lobby shares them out
+    def control(self, msg, socks):
+        getattr(self, 'control_' + msg['type'])(msg, socks)
+    def control_game(self, msg, socks):
+        captains = [adopt(self, sock, state) for state, sock in zip(msg['clients'], socks)]
+        self.new_game(*captains)
+        for c in captains:
+            self.receive(c)
+    def control_rejoin(self, msg, socks):
+        for state, sock in zip(msg['clients'], socks):
+            c = adopt(self, sock, state)
+            game = self.absent.get(c.name)
+            if game is not None:
+                game.rejoin(c)
+            else: # the game has finished since
+                self.lobby.enter(c)
+            self.receive(c)
+    def control_restore(self, msg, socks):
+        game = self.restore_game(msg['path'])
+        self.link.send('restored', names=list(game.absent) if game is not None else None)
+    def control_halt(self, msg, socks):
+        self.halting = True
+    def unlinked(self):
+        self.debug('Lost the lobby')
+        self.halting = True
+    def forget(self, client):
+        super(Worker, self).forget(client)
+        if client.name in self.absent:
+            self.link.send('absent', name=client.name)
+        else:
+            self.link.send('gone', name=client.name)
+    def game_over(self, game):
+        names = list(game.absent)
+        super(Worker, self).game_over(game)
+        self.link.send('over', names=names)
+    def flush(self):
+        super(Worker, self).flush()
+        if self.link.sock is not None:
+            self.link.flush()
+    def tick(self, timeout=1.0):
+        return super(Worker, self).tick(timeout) or self.halting
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Howzat game server, with games shared out among worker processes')
+    parser.add_argument('-p', '--port', type=int, default=0x6666)
+    parser.add_argument('-w', '--workers', type=int, help='number of worker processes (default: one per core)')
+    parser.add_argument('-t', '--action-timeout', type=float, help='seconds to wait for a player\'s action before deciding it for them')
+    parser.add_argument('-i', '--idle-timeout', type=float, help='seconds after which a silent client is disconnected')
+    parser.add_argument('-l', '--log-dir', help='directory for game logs, from which unfinished games are resumed on restart')
+    parser.add_argument('-m', '--metrics', action='store_true', help='keep counters and latency histograms (see /metrics)')
+    parser.add_argument('-M', '--metrics-socket', help='Unix socket on which to serve the lobby\'s metrics as JSON, with <path>.<n> for worker n\'s (implies -m)')
+    args = parser.parse_args()
+    options = {'action_timeout': args.action_timeout, 'idle_timeout': args.idle_timeout, 'log_dir': args.log_dir,
+               'metrics': args.metrics, 'metrics_socket': args.metrics_socket}
+    s = Lobby(port=args.port, debug=True, workers=args.workers, **options)
+    while True:
+        if s.tick():
+            break
+    s.halt()
@@ -0,0 +1,252 @@
+#!/usr/bin/python3
+"""
+Headless bulk match simulation.
+
+Plays matches by the same rules as howzat.play_match (Ball.roll,
+Wicket.roll and Innings.bowl), but without commentary, scorecards or the
+coroutine machinery, and returns structured results instead.  Players'
+dice and captaincy decisions are consulted in exactly the same order as
+the full engine, so DeterministicPlayer teams produce identical matches.
+
+Only players whose methods return values directly (DeterministicPlayer,
+RandomPlayer) can be simulated; those that wait on a Reactor cannot.
+"""
+import argparse
+import time
+
+import howzat
+
+class InningsResult(object):
+    def __init__(self, team, chasing=None):
+        self.team = team
+        self.chasing = chasing
+        self.total = 0
+        self.wkts = 0
+        self.balls = 0 # legal deliveries
+        self.deliveries = 0
+        self.nb = 0
+        self.w = 0
+        self.b = 0
+        self.lb = 0
+        self.fow = [] # (batsman, total)
+    @property
+    def extras(self):
+        return self.nb + self.w + self.b + self.lb
+    @property
+    def odesc(self):
+        if self.balls % 6:
+            return "%d.%d" % divmod(self.balls, 6)
+        return "%d" % (self.balls // 6,)
+    def __str__(self):
+        if self.wkts == 10:
+            return "%s %d all out (%s ovs)" % (self.team.name, self.total, self.odesc)
+        return "%s %d/%d (%s ovs)" % (self.team.name, self.total, self.wkts, self.odesc)
+
+class MatchResult(object):
+    def __init__(self, first, second):
+        self.first = first
+        self.second = second
+        if first.total > second.total:
+            self.winner, self.loser = first.team, second.team
+            self.how, self.margin = 'runs', first.total - second.total
+        elif second.total > first.total:
+            self.winner, self.loser = second.team, first.team
+            self.how, self.margin = 'wickets', 10 - second.wkts
+        else:
+            self.winner = self.loser = None
+            self.how, self.margin = None, 0
+    @property
+    def tied(self):
+        return self.winner is None
+    def __str__(self):
+        if self.tied:
+            return "%s and %s tied" % (self.first.team.name, self.second.team.name)
+        return "%s beat %s by %d %s" % (self.winner.name, self.loser.name, self.margin, self.how)
+
+class QuietInnings(object):
+    """Just enough of howzat.Innings for Player.maybe_choose_bowler"""
+    def __init__(self, batting, fielding):
+        self.bteam = batting
+        self.fteam = fielding
+        self.bowling = None
+        self.resting = None
+        self.spells = dict((p, 0) for p in fielding.players)
+    def legal_bowlers(self):
+        return [p for p in self.fteam.players if self.spells[p] < 4 and p != self.resting]
+
+# Players whose rolls come straight from self.rng.randint
+RNG_RANDINT = (howzat.DeterministicPlayer.randint, howzat.RandomPlayer.randint)
+
+def dice(p):
+    """Return a function rolling a d6 for p, as p.do_roll_d6 would."""
+    if type(p).do_roll_d6 is not howzat.Player.do_roll_d6 or type(p).randint not in RNG_RANDINT:
+        return p.do_roll_d6
+    # Same draws as random.Random.randint(1, 6), without the layers of
+    # argument checking in randrange
+    bits = p.rng.getrandbits
+    def d6():
+        r = bits(3)
+        while r > 5:
+            r = bits(3)
+        return r + 1
+    return d6
+
+def toss(TA, TB):
+    call = TA.captain.call_toss()
+    coin = TB.captain.flip_coin()
+    if call == coin:
+        if TA.captain.choose_to_bat():
+            return TA, TB
+        return TB, TA
+    if TB.captain.choose_to_bat():
+        return TB, TA
+    return TA, TB
+
+def play_innings(batting, fielding, chasing=None):
+    res = InningsResult(batting, chasing)
+    inns = QuietInnings(batting, fielding)
+    bcapt = batting.captain
+    fcapt = fielding.captain
+    field = fielding.field
+    d6s = dict((p, dice(p)) for p in batting.players + fielding.players)
+    to_bat = list(batting.players)
+    def choose_batsman():
+        bat = bcapt.choose_batsman(to_bat)
+        to_bat.remove(bat)
+        return bat
+    non_striker = choose_batsman()
+    striker = choose_batsman()
+    overs = 0
+    while True:
+        # New over; see Innings.new_over
+        inns.bowling, inns.resting = inns.resting, inns.bowling
+        field[0], field[1] = field[1], field[0]
+        bowl = fcapt.maybe_choose_bowler(inns)
+        if bowl != inns.bowling:
+            bi = field.index(bowl)
+            field[0], field[bi] = field[bi], field[0]
+            inns.bowling = bowl
+        bowler = inns.bowling
+        if bowler.keeper:
+            keep = fcapt.choose_keeper([p for p in fielding.players if p != bowler])
+            if not keep.keeper:
+                ki = field.index(keep)
+                bowler.keeper = False
+                keep.keeper = True
+                field[ki], field[6] = field[6], field[ki]
+        striker, non_striker = non_striker, striker
+        inns.spells[bowler] += 1
+        overs += 1
+        d6 = d6s[bowler]
+        to_come = 6
+        while to_come:
+            # Ball.roll
+            res.deliveries += 1
+            bowl = d6()
+            extra = d6() if bowl == 1 else None
+            out = False
+            if extra == howzat.EXTRA_W:
+                runs = 0
+            else:
+                bat_d6 = d6s[striker]
+                bat = bat_d6()
+                if bat == 5:
+                    runs = 0
+                    # Wicket.roll
+                    if bowl == 3:
+                        fielder = field[(bat_d6() + bat_d6() - 1) % 11]
+                        out = d6s[fielder]() > 2
+                    else:
+                        out = bowl != 1
+                elif bat == 3:
+                    runs = 0
+                elif bat == 6 and extra is not None:
+                    runs = 0
+                else:
+                    runs = bat
+            # Ball.__init__ and Innings.bowl
+            if extra == howzat.EXTRA_NB:
+                res.nb += 1
+                res.total += runs + 1
+            elif extra == howzat.EXTRA_W:
+                res.w += 1
+                res.total += 1
+            else:
+                to_come -= 1
+                res.balls += 1
+                res.total += runs
+                if extra == howzat.EXTRA_B:
+                    res.b += runs
+                elif extra == howzat.EXTRA_LB:
+                    res.lb += runs
+            if out:
+                res.wkts += 1
+                res.fow.append((striker, res.total))
+                if not to_bat:
+                    return res
+                striker = choose_batsman()
+            elif runs % 2:
+                striker, non_striker = non_striker, striker
+            if chasing is not None and res.total > chasing:
+                return res
+        if overs == 20:
+            return res
+
+def simulate_match(TA, TB):
+    """Play a match between TA and TB, returning a MatchResult.
+
+    As with howzat.play_match, TA's captain calls the toss."""
+    TA, TB = toss(TA, TB)
+    first = play_innings(TA, TB)
+    second = play_innings(TB, TA, first.total)
+    return MatchResult(first, second)
+
+def simulate(n, make_teams):
+    """Generate the results of n matches, calling make_teams() for each
+    match to get a fresh (TA, TB) pair."""
+    for i in range(n):
+        yield simulate_match(*make_teams())
+
+def summarise(results):
+    played = 0
+    wins = {}
+    ties = 0
+    totals = [0, 0]
+    for r in results:
+        played += 1
+        if r.tied:
+            ties += 1
+        else:
+            wins[r.winner.name] = wins.get(r.winner.name, 0) + 1
+        totals[0] += r.first.total
+        totals[1] += r.second.total
+    return played, wins, ties, totals
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate Howzat matches without commentary')
+    parser.add_argument('-n', '--matches', type=int, default=1000)
+    parser.add_argument('-d', '--det', action='store_true', help='use DeterministicPlayer teams (every match is then identical)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='print each result')
+    parser.add_argument('team_a', nargs='?', default='TA')
+    parser.add_argument('team_b', nargs='?', default='TB')
+    args = parser.parse_args()
+    make = howzat.Team.det if args.det else howzat.Team.rand
+    def make_teams():
+        TA, TB = make(args.team_a), make(args.team_b)
+        # Team.rand names every team "Randoms"
+        TA.name, TB.name = args.team_a, args.team_b
+        return TA, TB
+    def results():
+        for r in simulate(args.matches, make_teams):
+            if args.verbose:
+                print("%s; %s; %s" % (r.first, r.second, r))
+            yield r
+    start = time.time()
+    played, wins, ties, totals = summarise(results())
+    elapsed = time.time() - start
+    for name, w in sorted(wins.items()):
+        print("%s won %d" % (name, w))
+    print("Tied %d" % (ties,))
+    if played:
+        print("Average scores: batting first %.1f, batting second %.1f" % (totals[0] / played, totals[1] / played))
+    print("Simulated %d matches in %.3fs (%.0f matches/s)" % (played, elapsed, played / elapsed if elapsed else 0))
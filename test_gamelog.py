@@ -0,0 +1,158 @@
+"""
+Restoring games from their logs (see gamelog.py), through server.Server
+with clients on socketpairs.  Run with python -m unittest or pytest.
+"""
+import json
+import os
+import random
+import shutil
+import socket
+import tempfile
+import unittest
+
+import server
+
+class Captain(object):
+    """The far end of a client's socketpair, answering every action"""
+    def __init__(self, srv, name):
+        self.name = name
+        self.sock, far = socket.socketpair()
+        c = server.Client(far, srv)
+        srv.clients[c.name] = c
+        self.sock.setblocking(False)
+        self.buf = b''
+        self.keeper = None
+    def send(self, **d):
+        self.sock.sendall((json.dumps(d) + '\n').encode('utf8'))
+    def msgs(self):
+        try:
+            while True:
+                data = self.sock.recv(65536)
+                if not data:
+                    break
+                self.buf += data
+        except BlockingIOError:
+            pass
+        lines = self.buf.split(b'\n')
+        self.buf = lines.pop()
+        return [json.loads(line) for line in lines]
+    def answer(self, m):
+        a = m['action']
+        if a == 'choose keeper':
+            self.keeper = m['legal'][-1]
+            self.send(type='action', action=a, keeper=self.keeper)
+        elif a == 'call toss':
+            self.send(type='action', action=a, tails=True)
+        elif a == 'choose first':
+            self.send(type='action', action=a, bat=True)
+        elif a == 'next bat':
+            self.send(type='action', action=a, batsman=m['legal'][0])
+        elif a == 'choose bowler':
+            self.send(type='action', action=a, bowler=[p for p in m['legal'] if p != self.keeper][0])
+        else:
+            self.send(type='action', action=a)
+
+class RestoreTest(unittest.TestCase):
+    def setUp(self):
+        # The server's dice, for a match that runs the same each time
+        self.rng = server.DELEGATE_RNG
+        server.DELEGATE_RNG = random.Random(1)
+        self.log_dir = tempfile.mkdtemp()
+        self.srv = server.Server(port=None, log_dir=self.log_dir)
+        self.alice = Captain(self.srv, 'alice')
+        self.bob = Captain(self.srv, 'bob')
+        for c in (self.alice, self.bob):
+            c.send(type='hello', username=c.name, extensions=['delegate'])
+        self.pump()
+        self.alice.send(type='invite', invitation='new', to='bob')
+        self.pump()
+        self.bob.send(type='accept', invitation='new', to='alice')
+        self.pump()
+        for c in (self.alice, self.bob):
+            for i in range(2, 12):
+                c.send(type='claim', player='%s%d' % (c.name, i))
+        self.pump()
+    def tearDown(self):
+        for c in (self.alice, self.bob):
+            c.sock.close()
+        self.srv.sel.close()
+        shutil.rmtree(self.log_dir)
+        server.DELEGATE_RNG = self.rng
+    def pump(self):
+        for i in range(5):
+            self.srv.tick(timeout=0)
+    def play(self, meddle, requests):
+        """Answer that many action requests, calling meddle(captain,
+        request) first; it returns True if it has dealt with the request
+        itself."""
+        while requests > 0:
+            self.pump()
+            for c in (self.alice, self.bob):
+                for m in c.msgs():
+                    self.assertNotEqual(m['type'], 'error', m)
+                    self.assertNotEqual(m['type'], 'match', m)
+                    if m['type'] == 'action':
+                        requests -= 1
+                        if not meddle(c, m):
+                            c.answer(m)
+    def logged(self):
+        name, = os.listdir(self.log_dir)
+        with open(os.path.join(self.log_dir, name)) as f:
+            return [json.loads(line) for line in f]
+    def restore(self):
+        """Crash, dropping everything on the floor, and restore the game
+        in a new server; it should be just as it was"""
+        game, = self.srv.games
+        before = game.snapshot()
+        self.srv.sel.close()
+        self.srv = server.Server(port=None, log_dir=self.log_dir)
+        game, = self.srv.games
+        self.assertEqual(game.snapshot(), before)
+
+    def test_delegate_between_triggers(self):
+        # alice delegates while bob is asked to roll, so the delegation is
+        # read at alice's next trigger, with no input of its own
+        done = []
+        def meddle(c, m):
+            if c is self.bob and m['action'] == 'roll' and not done:
+                done.append(m)
+                self.alice.send(type='delegate', span='innings')
+                self.pump()
+        self.play(meddle, 100)
+        self.assertTrue(done)
+        self.assertIn({'log': 'delegate', 'player': 'alice', 'span': 'innings'}, self.logged())
+        self.restore()
+
+    def test_revoke_between_triggers(self):
+        done = []
+        def meddle(c, m):
+            if c is self.bob and m['action'] == 'roll':
+                if not done:
+                    self.alice.send(type='delegate', span='innings')
+                elif len(done) == 10:
+                    self.alice.send(type='delegate', span=None)
+                done.append(m)
+                self.pump()
+        self.play(meddle, 100)
+        self.assertGreater(len(done), 11)
+        self.assertIn({'log': 'delegate', 'player': 'alice', 'span': None}, self.logged())
+        self.restore()
+
+    def test_delegate_pending_trigger(self):
+        # bob delegates the very roll he's asked for, which is logged as
+        # its reply
+        done = []
+        def meddle(c, m):
+            if c is self.bob and m['action'] == 'roll' and len(done) < 5:
+                done.append(m)
+                c.send(type='delegate', span='over', player=m['player'])
+                return True
+        self.play(meddle, 100)
+        self.assertEqual(len(done), 5)
+        replies = [r for r in self.logged() if r['log'] == 'input' and isinstance(r['value'], dict)
+                   and r['value'].get('type') == 'delegate']
+        self.assertEqual(len(replies), 5)
+        self.restore()
+
+if __name__ == '__main__':
+    unittest.main()
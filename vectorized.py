@@ -0,0 +1,215 @@
+#!/usr/bin/python3
+"""
+NumPy-vectorized innings simulation.
+
+Plays many independent innings at once, using the outcome tables of
+Ball.roll and Wicket.roll and the termination rules of Innings.bowl: each
+innings' deliveries are drawn up front, and running sums along them find
+where it ends (see play_block).  Each delivery is one draw from a table
+of all 6**4
+bowler/extras/batsman/catch d6 outcomes, so results are statistically,
+not ball-for-ball, equivalent to the full engine: dice come from a numpy
+Generator rather than each player's rng, and the fielder's 2d6 is not
+rolled since any fielder holds a catch on the same d6.
+
+Requires numpy, which the rest of the game does not.
+"""
+import argparse
+import time
+
+import numpy as np
+
+import howzat
+
+MAX_OVERS = 20
+# Deliveries drawn at a time for each innings still in play (at most 63,
+# for the packed EXTRAS sums), and innings played at once
+DELIVERIES = 32
+BLOCK = 4096
+
+def outcome_tables():
+    """Tabulate every equally likely (bowl, extra, bat, catch) roll.
+
+    Returns a dict of arrays indexed by 216 * (bowl - 1) + 36 * (extra - 1)
+    + 6 * (bat - 1) + (catch - 1), following Ball.roll and Wicket.roll.
+    The extras d6 is ignored unless bowl is 1, and so on."""
+    names = ('runs', 'bat', 'legal', 'out', 'nb', 'w', 'b', 'lb', 'swap')
+    rows = []
+    for bowl in range(1, 7):
+        for extra in range(1, 7):
+            for bat in range(1, 7):
+                for catch in range(1, 7):
+                    ex = extra if bowl == 1 else None
+                    out = False
+                    if ex == howzat.EXTRA_W or bat in (3, 5):
+                        runs = 0
+                    elif bat == 6 and ex is not None:
+                        # No sixes off potential Extras
+                        runs = 0
+                    else:
+                        runs = bat
+                    if ex != howzat.EXTRA_W and bat == 5:
+                        # Howzat?  Not out on a 1, dropped on a 1 or 2
+                        out = bowl != 1 and (bowl != 3 or catch > 2)
+                    nb = ex == howzat.EXTRA_NB
+                    w = ex == howzat.EXTRA_W
+                    b = runs if ex == howzat.EXTRA_B else 0
+                    lb = runs if ex == howzat.EXTRA_LB else 0
+                    rows.append((runs + nb + w, 0 if b or lb else runs,
+                                 not nb and not w, out, nb, w, b, lb,
+                                 bool(runs % 2) and not out))
+    return dict((n, np.array(col, dtype=np.int32 if n in ('runs', 'bat', 'b', 'lb') else bool))
+                for n, col in zip(names, zip(*rows)))
+
+TABLES = outcome_tables()
+# The running sums needed, packed so that one cumsum keeps them all:
+#   bits 0-9    runs, with bit 10 as its guard
+#   bits 11-18  legal balls, with bit 19 as its guard
+#   bits 20-23  wickets, with bit 24 as its guard
+#   bits 25-31  odd-run swaps, of which only the parity is used
+# Each count starts from an offset such that it carries into its guard
+# bit just as it ends the innings (see START, and simulate_innings for
+# the runs'), so the innings is over once any of GUARDS is set.  Until
+# then nothing carries out of a field.
+LEGAL, OUT, SWAP = 11, 20, 25
+GUARDS = 1 << LEGAL - 1 | 1 << OUT - 1 | 1 << SWAP - 1
+START = (256 - MAX_OVERS * 6) << LEGAL | (16 - 10) << OUT
+PACKED = (TABLES['runs'] | TABLES['legal'] << LEGAL | TABLES['out'] << OUT | TABLES['swap'] << SWAP).astype(np.int32)
+# Extras, summed over at most DELIVERIES at a time: 8 bits each of no
+# balls, wides, byes and leg byes
+EXTRAS = (TABLES['nb'] | TABLES['w'] << 8 | TABLES['b'] << 16 | TABLES['lb'] << 24).astype(np.int32)
+# A delivery's runs and balls to the striker, as one bincount weight
+CREDIT = (TABLES['bat'] + 1024 * TABLES['legal']).astype(np.float64)
+
+class Batch(object):
+    """Results for n innings, as arrays indexed by innings"""
+    def __init__(self, n, batsmen=True):
+        self.n = n
+        self.total = np.zeros(n, dtype=np.int32)
+        self.wkts = np.zeros(n, dtype=np.int32)
+        self.balls = np.zeros(n, dtype=np.int32) # legal deliveries
+        self.nb = np.zeros(n, dtype=np.int32)
+        self.w = np.zeros(n, dtype=np.int32)
+        self.b = np.zeros(n, dtype=np.int32)
+        self.lb = np.zeros(n, dtype=np.int32)
+        # Per batsman, in batting order; None if not kept
+        self.scored = np.zeros((n, 11), dtype=np.int32) if batsmen else None
+        self.faced = np.zeros((n, 11), dtype=np.int32) if batsmen else None
+
+def simulate_innings(n, chasing=None, rng=None, batsmen=True):
+    """Play n innings at once, returning a Batch.
+
+    chasing may be a scalar or an array of n first-innings totals.  With
+    batsmen False, the Batch has no per-batsman figures, which take about
+    half the time."""
+    if rng is None:
+        rng = np.random.default_rng()
+    res = Batch(n, batsmen)
+    # The runs' offset: past the target is past 1023, or never without one
+    if chasing is None:
+        start = np.full(n, START, dtype=np.int32)
+    else:
+        start = START + np.clip(1023 - np.broadcast_to(chasing, (n,)), 0, 1023).astype(np.int32)
+    for lo in range(0, n, BLOCK):
+        play_block(res, lo, start[lo:lo + BLOCK], rng)
+    return res
+
+def play_block(res, lo, start, rng):
+    """Play innings lo to lo + len(start) of res, from packed sums start.
+
+    Rather than a ball at a time, DELIVERIES are drawn for each innings
+    as a matrix, whose running sums along each row give the innings'
+    state before and after every delivery: where it ended, and who was
+    on strike for each.  Those still in play go on to another matrix.
+
+    The striker follows from the running sums too.  The two batsmen
+    stay put, and the strike moves between them: it has swapped after
+    each odd-run delivery and each over, so far.  Whoever is out is
+    replaced by the next batsman; numbered in order, the latest to come
+    in at each end is the greatest there so far."""
+    n = len(start)
+    cols = np.arange(DELIVERIES)
+    # The innings still in play: index in the block, running sums, and
+    # who is at each end
+    rows = np.arange(n)
+    sums = start.copy()
+    nb = np.zeros(n, dtype=np.int32)
+    w = np.zeros(n, dtype=np.int32)
+    b = np.zeros(n, dtype=np.int32)
+    lb = np.zeros(n, dtype=np.int32)
+    # Openers 0 and 1; Innings.new_over swaps them before the first ball
+    at = np.array([np.zeros(n, dtype=np.int8), np.ones(n, dtype=np.int8)])
+    credit = np.zeros(n * 11 + 12)
+    while len(rows):
+        c = rng.integers(0, len(PACKED), size=(len(rows), DELIVERIES), dtype=np.int16)
+        v = np.take(PACKED, c)
+        after = np.cumsum(v, axis=1, dtype=np.int32)
+        after += sums[:, None]
+        # Innings.bowl termination: all out, overs up, or target passed
+        done = (after & GUARDS) != 0
+        last = done.argmax(axis=1)
+        fin = done[np.arange(len(rows)), last]
+        last[~fin] = DELIVERIES - 1
+        bowled = cols <= last[:, None]
+        sums = after[np.arange(len(rows)), last]
+        extras = (np.take(EXTRAS, c) * bowled).sum(axis=1, dtype=np.int32)
+        nb += extras & 255
+        w += extras >> 8 & 255
+        b += extras >> 16 & 255
+        lb += extras >> 24
+        if res.scored is not None:
+            before = after - v
+            overs = ((before >> LEGAL & 511) - (256 - MAX_OVERS * 6)) // 6
+            ends = ((before >> SWAP) + overs & 1).astype(bool)
+            # Who comes in at this delivery's end, if it takes a wicket
+            came = (((after >> OUT & 31) - 5) * (v >> OUT & 1)).astype(np.int8)
+            striker = np.empty_like(came)
+            for e, here in ((0, ~ends), (1, ends)):
+                latest = np.maximum.accumulate(came * here, axis=1)
+                on = np.empty_like(latest)
+                on[:, 0] = at[e]
+                np.maximum(latest[:, :-1], at[e][:, None], out=on[:, 1:])
+                np.copyto(striker, on, where=here)
+                at[e] = np.maximum(latest[:, -1], at[e])
+            # Deliveries after the end credit nobody (whoever they'd be)
+            at_bat = rows[:, None] * 11 + striker
+            weights = np.take(CREDIT, c) * bowled
+            credit += np.bincount(at_bat.ravel(), weights.ravel(), minlength=len(credit))[:len(credit)]
+        if fin.any():
+            done_rows = lo + rows[fin]
+            final = sums[fin] - start[rows[fin]]
+            res.total[done_rows] = final & (1 << LEGAL) - 1
+            res.balls[done_rows] = final >> LEGAL & 511
+            res.wkts[done_rows] = final >> OUT & 31
+            for name, a in (('nb', nb), ('w', w), ('b', b), ('lb', lb)):
+                getattr(res, name)[done_rows] = a[fin]
+            keep = ~fin
+            rows, sums, nb, w, b, lb, at = rows[keep], sums[keep], nb[keep], w[keep], b[keep], lb[keep], at[:, keep]
+    if res.scored is not None:
+        credit = credit[:n * 11].reshape(n, 11).astype(np.int32)
+        res.scored[lo:lo + n] = credit & 1023
+        res.faced[lo:lo + n] = credit >> 10
+
+def simulate_matches(n, rng=None, batsmen=True):
+    """Play n matches, returning (first, second) Batches"""
+    if rng is None:
+        rng = np.random.default_rng()
+    first = simulate_innings(n, rng=rng, batsmen=batsmen)
+    second = simulate_innings(n, first.total, rng=rng, batsmen=batsmen)
+    return first, second
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Vectorized Howzat innings simulation')
+    parser.add_argument('-n', '--matches', type=int, default=100000)
+    parser.add_argument('-s', '--seed', type=int, default=None)
+    parser.add_argument('-t', '--totals', action='store_true', help="don't keep per-batsman figures")
+    args = parser.parse_args()
+    start = time.time()
+    first, second = simulate_matches(args.matches, np.random.default_rng(args.seed), not args.totals)
+    elapsed = time.time() - start
+    print("Batting first won %d, batting second won %d, tied %d" % (
+        np.count_nonzero(first.total > second.total),
+        np.count_nonzero(second.total > first.total),
+        np.count_nonzero(first.total == second.total)))
+    print("Average scores: batting first %.1f, batting second %.1f" % (first.total.mean(), second.total.mean()))
+    print("Simulated %d innings in %.3fs (%.0f innings/s)" % (2 * args.matches, elapsed, 2 * args.matches / elapsed if elapsed else 0))